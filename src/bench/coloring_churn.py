@@ -0,0 +1,115 @@
+import argparse
+import json
+import random
+import time
+
+from src import config
+from src.nodes.node_types import NodeColor
+from src.nodes.ColoringPolicy import POLICIES
+from src.nodes.NodeRegistry import NodeRegistry
+from src.utils import ip_tools
+
+
+class ChurnRun:
+    def __init__(self, policy_name, rng):
+        """
+        Leader's table driven by random joins and leaves, colors are applied like in LeaderMode.reconfigure_nodes()
+        """
+        self.rng = rng
+        self.nodes_table = NodeRegistry()
+        self.pending_colors = {}
+        self.policy = POLICIES[policy_name](self.nodes_table, self.assign_color)
+        # Color changes of nodes which already had a color (a joining node's first color is not counted)
+        self.reassignments = 0
+        self.first_assignments = 0
+        self.rebalance_ns = 0
+
+    def assign_color(self, node_id, data, color):
+        if data.color == color:
+            self.pending_colors.pop(node_id, None)
+        else:
+            self.pending_colors[node_id] = color
+
+    def join(self, weights):
+        node_id = self.rng.randrange(1, 1 << 32)
+        while node_id in self.nodes_table:
+            node_id = self.rng.randrange(1, 1 << 32)
+        if weights > 1:
+            config.NODE_WEIGHTS[ip_tools.long_to_ip(node_id)] = self.rng.randint(1, weights)
+        self.policy.node_added(node_id, self.nodes_table.add(node_id, NodeColor.INIT, 0))
+
+    def leave(self):
+        node_id = self.nodes_table.select(self.rng.randrange(len(self.nodes_table)))
+        self.policy.node_removed(node_id)
+        del self.nodes_table[node_id]
+        self.pending_colors.pop(node_id, None)
+
+    def recolor(self):
+        start = time.perf_counter_ns()
+        self.policy.rebalance()
+        self.rebalance_ns += time.perf_counter_ns() - start
+        for node_id, color in self.pending_colors.items():
+            index = self.nodes_table.index(node_id)
+            if self.nodes_table.colors[index] == NodeColor.INIT.value:
+                self.first_assignments += 1
+            else:
+                self.reassignments += 1
+            self.nodes_table.colors[index] = color.value
+        self.pending_colors.clear()
+
+
+def run_policy(policy_name, args):
+    """
+    Cold start of args.nodes nodes, then args.events joins and leaves (one recolor step per event)
+    """
+    config.NODE_WEIGHTS = {}
+    run = ChurnRun(policy_name, random.Random(args.seed))
+    for _ in range(args.nodes):
+        run.join(args.weights)
+    run.recolor()
+    startup = run.first_assignments
+    run.reassignments = 0
+    for _ in range(args.events):
+        if len(run.nodes_table) > 1 and run.rng.random() < 0.5:
+            run.leave()
+        else:
+            run.join(args.weights)
+        run.recolor()
+    return {"startup_assignments": startup,
+            "churn_reassignments": run.reassignments,
+            "reassignments_per_event": round(run.reassignments / max(args.events, 1), 4),
+            "balanced": run.policy.balanced(),
+            "rebalance_us_per_event": round(run.rebalance_ns / 1000 / max(args.events + 1, 1), 2)}
+
+
+def parse_colors(text):
+    """
+    "RED=0.2,GREEN=0.5,BLUE=0.3" -> {"RED": 0.2, ...}
+    """
+    colors = {}
+    for item in text.split(","):
+        name, _, ratio = item.partition("=")
+        colors[name.strip().upper()] = float(ratio)
+    return colors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Color reassignments of the coloring policies under churn")
+    parser.add_argument("--nodes", type=int, default=1000, help="Nodes before the churn starts")
+    parser.add_argument("--events", type=int, default=5000, help="Random joins and leaves")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--colors", type=parse_colors, default=None, help="e.g. RED=0.2,GREEN=0.5,BLUE=0.3")
+    parser.add_argument("--weights", type=int, default=1, help="Node weights are random between 1 and this")
+    args = parser.parse_args()
+
+    if args.colors is not None:
+        config.COLOR_RATIOS = args.colors
+    report = {"nodes": args.nodes, "events": args.events, "seed": args.seed, "colors": config.COLOR_RATIOS,
+              "weights": args.weights}
+    for policy_name in POLICIES:
+        report[policy_name] = run_policy(policy_name, args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sys
+import time
+
+from src import config
+from src.nodes.BaseNode import BaseNode
+from src.nodes.node_types import NodeColor, OperationMode
+from src.nodes.LeaderMode import LeaderMode
+from src.sim.VirtualClock import VirtualClock
+from src.utils import clock, ip_tools, protocol_msgs
+from src.utils.UDPServer import UDPServer
+from src.utils.protocol_msgs import MsgType, decode_msg, encode_msg
+from src.utils.sorted_structs import SortedDict
+
+# Results of every benchmark are nanoseconds per operation, lower is better
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baselines.json")
+SIZES = (1000, 10000, 100000)
+_BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark - function (repeat) -> {result name: ns per operation}
+    """
+    def register(func):
+        _BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def best_of(repeat, run):
+    """
+    :param run: Function returning elapsed ns of one run (setup is not measured)
+    :return: Fastest of the runs (least disturbed by the rest of the machine)
+    """
+    return min(run() for _ in range(repeat))
+
+
+def timed(func, *args):
+    start = time.perf_counter_ns()
+    func(*args)
+    return time.perf_counter_ns() - start
+
+
+class _CountingSender:
+    def __init__(self):
+        """
+        Replaces protocol_msgs.sender - datagrams are only counted, nothing leaves the process
+        """
+        self.packets_sent = 0
+
+    def sendto(self, payload, addr, broadcast=False):
+        self.packets_sent += 1
+
+
+def isolate():
+    """
+    Fresh virtual clock, wire state and sender, so benchmarks don't need an event loop or network
+    """
+    virtual_clock = VirtualClock()
+    clock.install(virtual_clock.now_ns, virtual_clock.call_later, virtual_clock.call_soon, virtual_clock.sleep)
+    protocol_msgs.wire = protocol_msgs.WireState()
+    protocol_msgs.sender = _CountingSender()
+    return virtual_clock
+
+
+def node_ids(count, seed=1):
+    return random.Random(seed).sample(range(1, 1 << 32), count)
+
+
+#################################################################################
+# SortedDict
+#################################################################################
+
+@benchmark("sorted_dict")
+def bench_sorted_dict(repeat):
+    results = {}
+    for size in SIZES:
+        keys = node_ids(size)
+
+        def insert():
+            table = SortedDict()
+            return timed(lambda: [table.__setitem__(key, None) for key in keys])
+
+        def delete():
+            table = SortedDict({key: None for key in keys})
+            return timed(lambda: [table.__delitem__(key) for key in keys])
+
+        table = SortedDict({key: None for key in keys})
+        results[f"sorted_dict.insert.{size}"] = best_of(repeat, insert) / size
+        results[f"sorted_dict.delete.{size}"] = best_of(repeat, delete) / size
+        results[f"sorted_dict.iterate.{size}"] = best_of(repeat, lambda: timed(lambda: list(table.items()))) / size
+    return results
+
+
+#################################################################################
+# Wire format
+#################################################################################
+
+def sample_messages():
+    """
+    Message type -> typical payload
+    """
+    changes = [(node_id, NodeColor.GREEN.value) for node_id in node_ids(20)]
+    return {
+        MsgType.KEEPALIVE: NodeColor.GREEN.value,
+        MsgType.COLOR_COMMAND: (12345, NodeColor.RED.value, 0x5EED),
+        MsgType.HEARTBEAT: (100, 0xDEADBEEF, 99, changes),
+        MsgType.SWIM_PING: (7, 0x0A000001, [(node_id, 1, 3) for node_id in node_ids(8)]),
+        MsgType.MONITOR_SNAPSHOT: (100, 0, 4, [(node_id, NodeColor.GREEN.value)
+                                               for node_id in node_ids(protocol_msgs.PAGE_NODES)]),
+        MsgType.METRICS_RESPONSE: {"counters": {"recolors": 10, "color_changes": 200}, "hist": {}},
+    }
+
+
+@benchmark("wire")
+def bench_wire(repeat):
+    isolate()
+    results = {}
+    ops = 5000
+    for version, prefix in ((protocol_msgs.WIRE_VERSION_BINARY, "wire"), (protocol_msgs.WIRE_VERSION_JSON, "wire_json")):
+        for msg_type, data in sample_messages().items():
+            payload = encode_msg(msg_type, data, version)
+            name = msg_type.name.lower()
+            results[f"{prefix}.encode.{name}"] = best_of(repeat, lambda: timed(
+                lambda: [encode_msg(msg_type, data, version) for _ in range(ops)])) / ops
+            results[f"{prefix}.decode.{name}"] = best_of(repeat, lambda: timed(
+                lambda: [decode_msg(payload) for _ in range(ops)])) / ops
+    return results
+
+
+#################################################################################
+# Message dispatch
+#################################################################################
+
+@benchmark("dispatch")
+def bench_dispatch(repeat):
+    """
+    BaseNode.process_msg() per message type in the steady state of the mode which handles it
+    """
+    leader_ip, slave_ip = "10.0.0.200", "10.0.0.100"
+    cases = (
+        (OperationMode.LEADER, MsgType.KEEPALIVE, NodeColor.GREEN.value),
+        (OperationMode.LEADER, MsgType.COLOR_ACK, 1),
+        (OperationMode.LEADER, MsgType.STATE_REQUEST, NodeColor.GREEN.value),
+        (OperationMode.LEADER, MsgType.LEADER_REQUEST, ""),
+        (OperationMode.LEADER, MsgType.ELECTION, ""),
+        (OperationMode.SLAVE, MsgType.KEEPALIVE, ""),
+        (OperationMode.SLAVE, MsgType.VICTORY, ""),
+        (OperationMode.SLAVE, MsgType.COLOR_COMMAND, (1, NodeColor.GREEN.value, 0x5EED)),
+        (OperationMode.SLAVE, MsgType.HEARTBEAT, (1, 0, 1, [])),
+        (OperationMode.SLAVE, MsgType.MONITOR_COLOR_REQUEST, ""),
+    )
+    results = {}
+    ops = 5000
+    for mode, msg_type, data in cases:
+        isolate()
+        if mode == OperationMode.LEADER:
+            node = BaseNode(leader_ip)
+            node.won_election()
+            sender_ip = slave_ip
+        else:
+            node = BaseNode(slave_ip)
+            node.slave_mode.set_leader(leader_ip)
+            sender_ip = leader_ip
+        protocol_msgs.wire.note_peer_version(sender_ip, config.WIRE_VERSION)
+        payload = encode_msg(msg_type, data, config.WIRE_VERSION)
+        addr = (sender_ip, config.DEFAULT_LISTENING_PORT)
+        # First message moves the node into the steady state (e.g. the slave is in the leader's table)
+        node.process_msg(addr, payload)
+        results[f"dispatch.{mode.name.lower()}.{msg_type.name.lower()}"] = best_of(repeat, lambda: timed(
+            lambda: [node.process_msg(addr, payload) for _ in range(ops)])) / ops
+    return results
+
+
+#################################################################################
+# LeaderMode
+#################################################################################
+
+def leader_with_nodes(ids):
+    """
+    Leader with colored nodes (every node speaks the current wire version)
+    """
+    leader = LeaderMode()
+    for node_id in ids:
+        protocol_msgs.wire.note_peer_version(ip_tools.long_to_ip(node_id), config.WIRE_VERSION)
+        leader.add_node(node_id, NodeColor.INIT, 0)
+    leader.reconfigure_nodes()
+    return leader
+
+
+@benchmark("leader")
+def bench_leader(repeat):
+    results = {}
+    for size in SIZES:
+        isolate()
+        ids = node_ids(size + 100)
+        leader = leader_with_nodes(ids[:size])
+        joining = ids[size:]
+        for node_id in joining:
+            protocol_msgs.wire.note_peer_version(ip_tools.long_to_ip(node_id), config.WIRE_VERSION)
+
+        def recolor_steps():
+            # Join and leave of one node, each followed by its recolor step
+            start = time.perf_counter_ns()
+            for node_id in joining:
+                leader.add_node(node_id, NodeColor.INIT, 0)
+                leader.reconfigure_nodes()
+                leader.remove_node(node_id)
+                leader.reconfigure_nodes()
+            return time.perf_counter_ns() - start
+
+        results[f"leader.recolor_step.{size}"] = best_of(repeat, recolor_steps) / (2 * len(joining))
+
+        def sweep():
+            # 1 % of the nodes of a settled table have missed their deadline
+            virtual_clock = isolate()
+            leader = leader_with_nodes(ids[:size])
+            for index, node_id in enumerate(ids[:size]):
+                leader.liveness.refresh(node_id, index + 1)
+            virtual_clock.now = size // 100
+            return timed(leader.validate_nodes_keepalive)
+
+        results[f"leader.validate_1pct_expired.{size}"] = best_of(min(repeat, 3), sweep)
+    return results
+
+
+#################################################################################
+# UDPServer
+#################################################################################
+
+async def _loopback_throughput(count, burst):
+    """
+    :return: ns per datagram from the first send until the UDP server has processed all of them, NaN if some
+             never arrived
+    Keepalives are sent by 2 * burst sockets (127.0.0.2, 127.0.0.3, ...) in turn - less than 2 * burst are in flight,
+    so no sender has two queued and the ingress queue coalesces none of them (every datagram is processed).
+    """
+    loop = asyncio.get_running_loop()
+    received = 0
+
+    def process(addr, data, parsed=None):
+        nonlocal received
+        received += 1
+
+    transport, server = await loop.create_datagram_endpoint(UDPServer, local_addr=("127.0.0.1", 0))
+    server.set_processing_func(process)
+    address = transport.get_extra_info("sockname")
+    socks = []
+    for index in range(2 * burst):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        socks.append(sock)
+        sock.setblocking(False)
+        sock.bind((f"127.0.0.{index + 2}", 0))
+    payload = encode_msg(MsgType.KEEPALIVE, NodeColor.GREEN.value, config.WIRE_VERSION)
+    start = time.perf_counter_ns()
+    try:
+        sent = 0
+        while sent < count:
+            # At most one burst is in flight (fits into the socket buffer), the server drains it meanwhile
+            if sent - received < burst:
+                for _ in range(min(burst, count - sent)):
+                    socks[sent % len(socks)].sendto(payload, address)
+                    sent += 1
+            await asyncio.sleep(0)
+        deadline = time.perf_counter_ns() + 5 * 10 ** 9
+        while received < count:
+            if time.perf_counter_ns() > deadline:
+                # Datagrams were dropped (by the kernel or shed by the server)
+                return math.nan
+            await asyncio.sleep(0)
+        return (time.perf_counter_ns() - start) / count
+    finally:
+        for sock in socks:
+            sock.close()
+        transport.close()
+
+
+@benchmark("udp")
+def bench_udp(repeat):
+    results = {}
+    for batch in (1, config.RECV_BATCH_SIZE):
+        config_batch = config.RECV_BATCH_SIZE
+        config.RECV_BATCH_SIZE = batch
+        try:
+            runs = [asyncio.run(_loopback_throughput(20000, 32)) for _ in range(repeat)]
+        finally:
+            config.RECV_BATCH_SIZE = config_batch
+        # A run which lost datagrams fails the measurement
+        results[f"udp.loopback_keepalive.batch_{batch}"] = math.nan if any(map(math.isnan, runs)) else min(runs)
+    return results
+
+
+#################################################################################
+# Baselines
+#################################################################################
+
+def compare(results, baseline, tolerance):
+    """
+    :return: Results slower than their baseline by more than tolerance (name -> (baseline, result, ratio)),
+             failed measurements (NaN) are always included
+    """
+    regressions = {}
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if math.isnan(value):
+            regressions[name] = (reference, value, value)
+            continue
+        if reference is None or reference <= 0:
+            continue
+        ratio = value / reference
+        if ratio > 1 + tolerance:
+            regressions[name] = (round(reference, 1), round(value, 1), round(ratio, 2))
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def save_baseline(path, results):
+    baseline = {"python": sys.version.split()[0], "platform": platform.platform(), "machine": platform.machine(),
+                "unit": "ns/op", "results": {**load_baseline(path), **results}}
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def run_benchmark(name, repeat):
+    return {key: round(value, 1) for key, value in _BENCHMARKS[name](repeat).items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path benchmarks with baselines (ns per operation)")
+    parser.add_argument("--only", nargs="*", choices=sorted(_BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of every measurement, the fastest counts")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline file (JSON)")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="Exit with 1 if a result regressed past the tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown against the baseline (0.5 = 50 %%)")
+    args = parser.parse_args()
+
+    config.LOG_LEVEL = "WARNING"
+    # benchmark -> its results
+    groups = {name: run_benchmark(name, args.repeat) for name in args.only or _BENCHMARKS}
+    results = {key: value for group in groups.values() for key, value in group.items()}
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    # Suspected regressions are measured once more, a single disturbed run (other load on the machine) doesn't fail
+    # (a failed measurement stays failed)
+    for name, group in groups.items():
+        if regressions.keys() & group.keys():
+            for key, value in run_benchmark(name, args.repeat).items():
+                if not math.isnan(results[key]):
+                    results[key] = min(results[key], value)
+    regressions = compare(results, baseline, args.tolerance)
+    report = {"results": results, "tolerance": args.tolerance,
+              "regressions": {name: dict(zip(("baseline", "result", "ratio"), values))
+                              for name, values in regressions.items()}}
+    print(json.dumps(report, indent=2))
+    if args.save:
+        save_baseline(args.baseline, {key: value for key, value in results.items() if not math.isnan(value)})
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from src.nodes.node_types import NodeColor
+from src.nodes.NodeRegistry import NodeRegistry
+from src.utils import ip_tools
+from src.utils.sorted_structs import SortedDict
+
+
+class _ObjectNodeData:
+    def __init__(self, ip, color, last_seen):
+        """
+        Previous layout of the leader's table - one object per node in a SortedDict
+        """
+        self.ip = ip
+        self.last_seen = last_seen
+        self.color = color
+
+
+class ObjectTable:
+    def __init__(self):
+        self.table = SortedDict()
+
+    def add(self, node_id, now):
+        self.table[node_id] = _ObjectNodeData(ip_tools.long_to_ip(node_id), NodeColor.GREEN, now)
+
+    def keepalive(self, node_id, now):
+        data = self.table.get(node_id)
+        data.last_seen = now
+        return data.color.value
+
+    def remove(self, node_id):
+        del self.table[node_id]
+
+    def snapshot(self):
+        return [(node_id, data.color.value) for node_id, data in self.table.items()]
+
+
+class RegistryTable:
+    def __init__(self):
+        self.table = NodeRegistry()
+
+    def add(self, node_id, now):
+        self.table.add(node_id, NodeColor.GREEN, now)
+
+    def keepalive(self, node_id, now):
+        # Same access as LeaderMode.got_keepalive_from_node()
+        index = self.table.find(node_id)
+        self.table.last_seen[index] = now
+        return self.table.colors[index]
+
+    def remove(self, node_id):
+        del self.table[node_id]
+
+    def snapshot(self):
+        return self.table.color_items()
+
+
+def measure(layout, node_ids, removed):
+    """
+    Memory of the filled table and time of the operations the leader does with it
+    """
+    gc.collect()
+    tracemalloc.start()
+    table = layout()
+    for node_id in node_ids:
+        table.add(node_id, 0)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+
+    # Timed without tracing
+    gc.collect()
+    start = time.perf_counter_ns()
+    table = layout()
+    for node_id in node_ids:
+        table.add(node_id, 0)
+    insert_ns = time.perf_counter_ns() - start
+
+    start = time.perf_counter_ns()
+    for now, node_id in enumerate(node_ids):
+        table.keepalive(node_id, now)
+    keepalive_ns = time.perf_counter_ns() - start
+    start = time.perf_counter_ns()
+    table.snapshot()
+    snapshot_ns = time.perf_counter_ns() - start
+    start = time.perf_counter_ns()
+    for node_id in removed:
+        table.remove(node_id)
+    remove_ns = time.perf_counter_ns() - start
+    count = len(node_ids)
+    return {"bytes_per_node": round(memory / count, 1),
+            "insert_us_per_node": round(insert_ns / 1000 / count, 3),
+            "keepalive_us_per_node": round(keepalive_ns / 1000 / count, 3),
+            "snapshot_ms": round(snapshot_ns / 1e6, 3),
+            "remove_us_per_node": round(remove_ns / 1000 / max(len(removed), 1), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and speed of the leader's node table layouts")
+    parser.add_argument("--nodes", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    node_ids = rng.sample(range(1, 1 << 32), args.nodes)
+    removed = rng.sample(node_ids, args.nodes // 10)
+    report = {"nodes": args.nodes, "seed": args.seed,
+              "objects": measure(ObjectTable, node_ids, removed),
+              "registry": measure(RegistryTable, node_ids, removed)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
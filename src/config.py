@@ -1,14 +1,105 @@
 RED_RATIO: float = 1/3
+# Share of nodes per color (NodeColor names) in order - the first color is the leader's (RED),
+# the last color gets the rest (colors take ranges of IPs in this order with the "prefix" policy)
+COLOR_RATIOS: dict = {"RED": RED_RATIO, "GREEN": 1 - RED_RATIO}
+# Absolute number of nodes (total weight with "sticky") of a color, replaces its ratio
+COLOR_QUOTAS: dict = {}
+# Weight of a node (IP -> weight, 1 if not listed), used by the "sticky" policy
+NODE_WEIGHTS: dict = {}
+# Coloring policy - "prefix" (lowest IPs are RED) or "sticky" (minimal reassignment when nodes join and leave)
+COLORING_POLICY: str = "prefix"
 DEFAULT_LISTENING_PORT: int = 9999
 DEFAULT_LISTENING_IP: str = '0.0.0.0'
 BROADCAST_IP: str = '10.0.1.255'
 KEEPALIVE_INTERVAL: int = 5
+# How long (seconds) each election state waits for an answer before moving on
+ELECTION_TIMEOUT: float = 0.3
+# Max delay (seconds) of a node's ELECTION broadcast, higher IPs broadcast sooner - lower nodes which hear them
+# stay silent, so only the highest responders broadcast
+ELECTION_STAGGER: float = 0.1
+# Prefix of the node's IP (can be a tuple of prefixes if nodes live on several subnets)
 IP_PREFIX: str = "10.0.1."
+# How long (seconds) a starting node waits for an interface with IP_PREFIX - a warning is logged after
+# IP_WAIT_WARNING, the node exits after IP_WAIT_TIMEOUT
+IP_WAIT_WARNING: float = 5.0
+IP_WAIT_TIMEOUT: float = 60.0
+# Highest wire protocol version this node speaks (1 = JSON only, 2 = binary, 3 = binary with acknowledged
+# color changes, 4 = leader's table replicated to the standby, negotiated per peer)
+WIRE_VERSION: int = 4
+# Hierarchical mode - networks of node groups, e.g. ("10.0.1.0/24", "10.0.2.0/24"). Every group elects its own
+# leader (broadcasts reach only the group), group leaders report group summaries to the top leader (the highest
+# group leader), which splits the RED nodes between the groups. Empty = one flat cluster
+HIERARCHY_GROUPS: tuple = ()
+# Event loop - "auto" uses uvloop if it is installed, "asyncio" the default loop, "uvloop" requires uvloop
+EVENT_LOOP: str = "auto"
+# Max number of datagrams read from the socket per event loop wakeup
+RECV_BATCH_SIZE: int = 64
+# Received datagrams are queued by priority class (control > keepalive > monitor), at most INGRESS_BUDGET of them
+# are processed per event loop iteration (datagrams received meanwhile are classified before the rest is processed)
+INGRESS_PRIORITY: bool = True
+INGRESS_BUDGET: int = 64
+# Max number of queued datagrams per class, further datagrams of a full class are shed (counted per class)
+INGRESS_QUEUE_LIMITS: dict = {"control": 1024, "keepalive": 4096, "monitor": 256}
+# Worker processes sharing the listening port (SO_REUSEPORT), each answers keepalives of its shard of slaves
+# while this node is the leader and reports only joins, deaths and slaves with other color than assigned
+# (0 = everything runs in one process)
+LEADER_WORKERS: int = 0
+
+# Color commands are retransmitted until acknowledged - first timeout (seconds), doubled after every attempt
+COLOR_RETRY_TIMEOUT: float = 0.25
+# Max number of transmissions of one color command (then the node's next keepalive repairs its color)
+COLOR_MAX_ATTEMPTS: int = 5
+# Leader replicates its table to the standby (highest slave, the next leader), which takes over with it
+LEADER_REPLICATION: bool = True
+
+# Leader broadcasts one HEARTBEAT per KEEPALIVE_INTERVAL instead of answering every slave keepalive
+LEADER_HEARTBEAT_BROADCAST: bool = False
+# Max number of color changes carried in one HEARTBEAT (slaves which miss them ask for their state)
+HEARTBEAT_MAX_DELTA: int = 200
+
+# Membership engine - "keepalive" (slaves send KEEPALIVE to leader) or "swim" (gossip failure detector)
+MEMBERSHIP_ENGINE: str = "keepalive"
+# SWIM - protocol period and direct ping timeout (seconds)
+SWIM_PROTOCOL_PERIOD: float = 1.0
+SWIM_ACK_TIMEOUT: float = 0.3
+# SWIM - number of members asked to ping the target indirectly
+SWIM_INDIRECT_PROBES: int = 3
+# SWIM - suspect is declared dead after this many protocol periods
+SWIM_SUSPECT_PERIODS: int = 3
+# SWIM - max membership updates piggybacked on one message, each update is sent MULT * log2(n) times
+SWIM_PIGGYBACK_MAX: int = 8
+SWIM_RETRANSMIT_MULT: float = 3
 
 # After how many nanoseconds is leader considered dead
 LEADER_DEAD_AFTER: int = int(2e+10)
 # After how many nanoseconds is slave node considered dead
 NODE_DEAD_AFTER: int = int(2e+10)
+# Failure detection of the leader (by slaves) and slaves (by the leader) - "fixed" (dead after LEADER_DEAD_AFTER /
+# NODE_DEAD_AFTER without keepalive) or "phi" (phi-accrual, adapts to the observed keepalive inter-arrival times)
+FAILURE_DETECTOR: str = "fixed"
+# Phi-accrual - peer is dead when phi reaches the threshold (8 = 1e-8 probability that it is alive, just late)
+PHI_THRESHOLD: float = 8.0
+# Phi-accrual - inter-arrival times kept per peer, fixed timeouts are used until there are PHI_MIN_SAMPLES of them
+PHI_WINDOW: int = 32
+PHI_MIN_SAMPLES: int = 3
+# Phi-accrual - lower bound of the standard deviation and pause added to the mean interval (seconds),
+# one lost keepalive is not a failure
+PHI_MIN_STD: float = 0.5
+PHI_ACCEPTABLE_PAUSE: float = 5.0
+
+# How often (seconds) monitor renews its subscription to the leader's color changes
+MONITOR_COLOR_POLL_RATE:int = 3
+# Subscription expires at the leader (and monitor looks for a new leader) after this many seconds without renewal/answer
+MONITOR_SUBSCRIPTION_TIMEOUT: int = 10
+# Log level of the application (DEBUG logs every message, sampled per type)
+LOG_LEVEL: str = "INFO"
+# Max number of records waiting for the background writer, the rest is dropped
+LOG_QUEUE_SIZE: int = 10000
+# Only every n-th received/sent message of given type is logged (types not listed are logged every time)
+LOG_SAMPLE_EVERY: dict = {"KEEPALIVE": 50, "HEARTBEAT": 50, "MONITOR_COLOR_REQUEST": 100,
+                          "MONITOR_COLOR_RESPONSE": 100, "SWIM_PING": 100, "SWIM_PING_REQ": 100, "SWIM_ACK": 100}
 
-# How fast is monitor sending color requests
-MONITOR_COLOR_POLL_RATE:int = 3
\ No newline at end of file
+# Port of the local metrics text endpoint (127.0.0.1 only, 0 disables it)
+METRICS_PORT: int = 9100
+# How often (seconds) monitor collects metrics from all nodes
+MONITOR_METRICS_POLL_RATE: int = 15
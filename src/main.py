@@ -2,8 +2,12 @@ import asyncio
 import src.config
 import src.nodes.BaseNode
 import src.utils.UDPServer
+import src.utils.protocol_msgs
 import os
 
+from src.utils import event_loop, ip_tools, log, metrics
+
+from src.nodes.LeaderWorkers import LeaderWorkerPool
 from src.nodes.MonitorNode import MonitorNode
 
 
@@ -11,32 +15,92 @@ from src.nodes.MonitorNode import MonitorNode
 # MAIN
 #################################################################################
 
+async def wait_for_ip(prefix, logger):
+    """
+    Returns our IP as soon as an interface with given prefix is up, None if there is none after config.IP_WAIT_TIMEOUT
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    warned = False
+    my_ip = ip_tools.get_ip(prefix)
+    while my_ip is None:
+        waited = loop.time() - start
+        if waited > src.config.IP_WAIT_TIMEOUT:
+            return None
+        if not warned and waited > src.config.IP_WAIT_WARNING:
+            log.warning(logger, "waiting_for_ip", prefix=prefix, waited_s=round(waited, 1),
+                        interfaces=[address.ip for address in ip_tools.get_interfaces()])
+            warned = True
+        await asyncio.sleep(0.05)
+        my_ip = ip_tools.get_ip(prefix, refresh=True)
+    return my_ip
+
+
 async def main():
+    # Records are written by a background thread, the event loop never blocks on stdout
+    log.setup(os.getenv("LOG_LEVEL"))
+    logger = log.get_logger("main")
     loop = asyncio.get_running_loop()
+    monitor_mode = os.getenv("MONITOR_MODE")
+    use_workers = src.config.LEADER_WORKERS > 0 and monitor_mode != "active"
+    # Node's IP given explicitly (several nodes on one machine, e.g. on 127.x.y.z) - it listens only on that IP
+    node_ip = os.getenv("NODE_IP")
+    if os.getenv("HIERARCHY_GROUPS"):
+        src.config.HIERARCHY_GROUPS = tuple(os.getenv("HIERARCHY_GROUPS").split(","))
 
     transport, udp_server = await loop.create_datagram_endpoint(
         src.utils.UDPServer.UDPServer,
-        local_addr=(src.config.DEFAULT_LISTENING_IP, src.config.DEFAULT_LISTENING_PORT))
+        local_addr=(node_ip or src.config.DEFAULT_LISTENING_IP, src.config.DEFAULT_LISTENING_PORT),
+        allow_broadcast=True, reuse_port=use_workers)
+    # All outgoing messages are sent through the listening socket
+    src.utils.protocol_msgs.sender.attach_transport(transport)
 
-    monitor_mode = os.getenv("MONITOR_MODE")
+    # Interface discovery is done once, the node's identity is known before the first message
+    my_ip = node_ip or await wait_for_ip(src.config.IP_PREFIX, logger)
+    if my_ip is None:
+        log.warning(logger, "no_ip", prefix=src.config.IP_PREFIX, timeout_s=src.config.IP_WAIT_TIMEOUT)
+        transport.close()
+        log.stop()
+        raise SystemExit(f"No interface with IP prefix {src.config.IP_PREFIX!r} "
+                         f"after {src.config.IP_WAIT_TIMEOUT} s (set config.IP_PREFIX or NODE_IP)")
+    log.info(logger, "started", ip=my_ip)
+
+    workers = None
     if monitor_mode == "active":
-        print("Running in MONITOR mode")
-        monitor_node = MonitorNode()
-        udp_server.set_processing_func(monitor_node.process_msg)
+        log.info(logger, "mode", mode="MONITOR")
+        monitor_node = MonitorNode(my_ip)
+        udp_server.set_processing_func(monitor_node.process_msg, my_ip, monitor_node.accepted_types())
         asyncio.create_task(monitor_node.timer_task())
+        render_metrics = monitor_node.render_metrics
     else:
-        print("Running in BASE mode")
-        base_node = src.nodes.BaseNode.BaseNode()
-        udp_server.set_processing_func(base_node.process_msg)
-        # This sleep is needed or the first send_leader_request_broadcast() won't work (???)
-        await asyncio.sleep(src.config.KEEPALIVE_INTERVAL)
+        log.info(logger, "mode", mode="BASE")
+        base_node = src.nodes.BaseNode.BaseNode(my_ip)
+        udp_server.set_processing_func(base_node.process_msg, my_ip, base_node.accepted_types())
+        if use_workers:
+            # Workers share the listening port and handle keepalives of their shard while we are the leader
+            workers = LeaderWorkerPool(src.config.LEADER_WORKERS, my_ip, base_node.process_msg,
+                                       base_node.shard_joined, base_node.shard_left, base_node.shard_color)
+            workers.start()
+            base_node.attach_workers(workers)
         asyncio.create_task(base_node.timer_task())
+        render_metrics = base_node.render_metrics
+
+    metrics_server = None
+    if src.config.METRICS_PORT:
+        metrics_server = await metrics.serve_text(render_metrics, src.config.METRICS_PORT, node_ip or "127.0.0.1")
 
     try:
         await asyncio.Future()
     finally:
+        if workers is not None:
+            workers.stop()
+        if metrics_server is not None:
+            metrics_server.close()
+        src.utils.protocol_msgs.sender.close()
         transport.close()
+        log.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop if it is installed (config.EVENT_LOOP)
+    event_loop.run(main())
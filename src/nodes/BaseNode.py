@@ -1,31 +1,17 @@
-import asyncio
+import functools
 
-import src.nodes.LeaderMode
+from src.nodes.ElectionEngine import ElectionEngine
+from src.nodes.GroupTier import GroupTier
+from src.nodes.LeaderMode import LeaderMode
+from src.nodes.LeaderReplica import LeaderReplica
+from src.nodes.node_types import NodeColor, OperationMode
 from src.nodes.SlaveMode import SlaveMode
-from src.utils import ip_tools
+from src.nodes.SwimMembership import SwimMembership
+from src.utils import clock, ip_tools, log, metrics
+from src.utils.MsgDispatcher import MsgDispatcher
 from src.utils.protocol_msgs import *
 
-
-#################################################################################
-# TYPES
-#################################################################################
-class NodeColor(Enum):
-    INIT = 1
-    RED = 2
-    GREEN = 3
-
-
-class ElectionState(Enum):
-    INIT = 1
-    SENT_LEADER_REQUEST = 2  # This node has sent a LEADER REQUEST message
-    SENT_ELECTION_BROADCAST = 3
-    ELECTION_MSG_RECEIVED = 4  # This node has received an ELECTION message
-    ELECTION_MSG_LONG_DELAY = 5  # This node has already been in state ELECTION_MSG_RECEIVED for one timeout period
-
-
-class OperationMode(Enum):
-    SLAVE = 1
-    LEADER = 2
+_logger = log.get_logger("node")
 
 
 #################################################################################
@@ -33,116 +19,284 @@ class OperationMode(Enum):
 #################################################################################
 
 class BaseNode:
-    def __init__(self):
-        self.my_ip = None
+    def __init__(self, my_ip=None):
+        # If not given, our IP is looked up when it is first needed
+        self.my_ip = my_ip
+        if my_ip is not None:
+            set_local_ip(my_ip)
         self.my_color: NodeColor = NodeColor.INIT
-        self.election_state: ElectionState = ElectionState.INIT
+        self.election: ElectionEngine = ElectionEngine(self.won_election, self.resolve_my_ip)
         # BaseNode calls member functions of those two classes (depending on which mode it operates in)
-        self.leader_mode: src.nodes.LeaderMode = src.nodes.LeaderMode.LeaderMode()  # TODO: Import issue
+        self.leader_mode: LeaderMode = LeaderMode()
         self.slave_mode: SlaveMode = SlaveMode()
+        # Copy of the leader's table if we are its standby (taken over when we win the election)
+        self.replica = LeaderReplica()
         # Starts as slave by default
         self.operation_mode: OperationMode = OperationMode.SLAVE
+        # Membership engine - None means slaves send keepalives to the leader
+        self.membership = None
+        if config.MEMBERSHIP_ENGINE == "swim":
+            self.membership = SwimMembership(self.member_joined, self.member_left)
+        # Keepalive worker processes (LeaderWorkers.LeaderWorkerPool), None if the node runs in one process
+        self.workers = None
+        # Top tier of the hierarchical mode (we are the leader of our group), None if the cluster is flat
+        self.tier = None
+        if config.HIERARCHY_GROUPS:
+            self.tier = GroupTier(self.leader_mode.group_summary, self.leader_mode.set_color_quota)
+        # Handlers of received messages per type and operation mode
+        self.dispatcher = MsgDispatcher((OperationMode.SLAVE, OperationMode.LEADER), self.resolve_my_ip,
+                                        self.membership.heard_from if self.membership is not None else None)
+        self.register_handlers()
+        self.dispatcher.set_mode(self.operation_mode)
 
-    def process_msg(self, sender_addr, msg):
-        sender_ip = sender_addr[0]
-        ### Get our IP (and ignore messages from same IP)
+    def resolve_my_ip(self):
         if self.my_ip is None:
             self.my_ip = ip_tools.get_ip(config.IP_PREFIX)
-        if sender_ip == self.my_ip:
-            return
-        #################################################
-        msg_code, data = decode_msg(msg)
-        msg_code = int(msg_code)
-        if msg_code != 8: # Suppress monitor request prints
-            print(f"Node {self.my_ip} received UDP message from {sender_addr}: {MsgType(msg_code).name}")
-        ##############################################
-        ### Process each message depending on the type
-
-        if msg_code == MsgType.ELECTION.value:
-            if ip_tools.is_higher_ip(sender_ip, self.my_ip):
-                # There is a node with higher IP in the election
-                self.election_state = ElectionState.ELECTION_MSG_RECEIVED
-            else:
-                # This node has lower IP than us, inform it
-                send_election_unicast(sender_ip)
-                # Sets election to INIT - will become leader earlier than nodes with ELECTION_MSG_RECEIVED
-                self.election_state = ElectionState.INIT
+            set_local_ip(self.my_ip)
+        return self.my_ip
+
+    def register_handlers(self):
+        dispatcher = self.dispatcher
+        dispatcher.register(MsgType.ELECTION, self.got_election)
+        # Another node has won the election (or response to our leader request)
+        dispatcher.register(MsgType.VICTORY, self.got_victory)
+        dispatcher.register(MsgType.LEADER_RESPONSE, self.got_victory)
+        dispatcher.register(MsgType.LEADER_REQUEST, self.got_leader_request, OperationMode.LEADER)
+        dispatcher.register(MsgType.SET_TO_RED, self.got_set_to_red)
+        dispatcher.register(MsgType.SET_TO_GREEN, self.got_set_to_green)
+        dispatcher.register(MsgType.SET_COLOR, self.got_set_color)
+        dispatcher.register(MsgType.COLOR_COMMAND, self.got_color_command, OperationMode.SLAVE)
+        dispatcher.register(MsgType.COLOR_ACK, self.got_color_ack, OperationMode.LEADER)
+        dispatcher.register(MsgType.KEEPALIVE, self.leader_mode.got_keepalive_from_node, OperationMode.LEADER)
+        dispatcher.register(MsgType.KEEPALIVE, self.got_keepalive_from_leader, OperationMode.SLAVE)
+        dispatcher.register(MsgType.HEARTBEAT, self.got_heartbeat, OperationMode.SLAVE)
+        dispatcher.register(MsgType.STATE_REQUEST, self.got_state_request, OperationMode.LEADER)
+        dispatcher.register(MsgType.STATE_RESPONSE, self.got_state_response, OperationMode.SLAVE)
+        dispatcher.register(MsgType.REPLICA_SNAPSHOT, self.got_replica_snapshot, OperationMode.SLAVE)
+        dispatcher.register(MsgType.REPLICA_DELTA, self.got_replica_delta, OperationMode.SLAVE)
+        dispatcher.register(MsgType.REPLICA_ACK, self.got_replica_ack, OperationMode.LEADER)
+        if self.tier is not None:
+            dispatcher.register(MsgType.GROUP_SUMMARY, self.got_group_summary, OperationMode.LEADER)
+            dispatcher.register(MsgType.GROUP_QUOTA, self.got_group_quota, OperationMode.LEADER)
+        if self.membership is not None:
+            for msg_type in (MsgType.SWIM_PING, MsgType.SWIM_PING_REQ, MsgType.SWIM_ACK):
+                dispatcher.register(msg_type, functools.partial(self.membership.process_msg, msg_type.value))
+        # This exists only for monitoring purposes - isn't used for the algorithm
+        dispatcher.register(MsgType.MONITOR_COLOR_REQUEST, self.got_monitor_color_request)
+        dispatcher.register(MsgType.MONITOR_SUBSCRIBE, self.got_monitor_subscribe, OperationMode.LEADER)
+        dispatcher.register(MsgType.METRICS_REQUEST, self.got_metrics_request)
+
+    def accepted_types(self):
+        """
+        :return: Message type codes this node handles (see UDPServer.set_processing_func())
+        """
+        return self.dispatcher.handled_types()
+
+    def process_msg(self, sender_addr, msg, parsed=None):
+        self.dispatcher.process_msg(sender_addr, msg, parsed)
 
+    ##############################################
+    ### Message handlers (sender IP, decoded data)
+
+    def got_election(self, sender_ip, data):
+        if self.operation_mode == OperationMode.LEADER and not ip_tools.is_higher_ip(sender_ip, self.my_ip):
+            # We are the leader and higher than the sender - VICTORY ends the election
+            self.election.answer_as_leader(sender_ip)
+        elif (self.slave_mode.leader is not None and self.slave_mode.leader_confirmed_recently()
+              and ip_tools.is_higher_ip(self.slave_mode.leader, sender_ip)):
+            # Our leader has just announced itself and answers the sender, joining the election would only
+            # start another round (ELECTION broadcasts of all higher nodes and VICTORY for each of them)
+            pass
+        else:
+            self.election.got_election(sender_ip, self.my_ip)
             # Election in progress, invalidate current leader data
-            self.operation_mode = OperationMode.SLAVE
+            self.set_operation_mode(OperationMode.SLAVE)
             self.slave_mode.clear_leader()
 
+    def got_victory(self, sender_ip, data):
+        self.follow_leader(sender_ip)
+        self.set_operation_mode(OperationMode.SLAVE)
+        self.election.stop()
 
-        elif (msg_code == MsgType.VICTORY.value) or (msg_code == MsgType.LEADER_RESPONSE.value):
-            # Another node has won the election (or response to our leader request)
-            self.slave_mode.set_leader(sender_ip)
-            self.operation_mode = OperationMode.SLAVE
-            self.election_state = ElectionState.INIT
+    def got_leader_request(self, sender_ip, data):
+        # We are the leader, inform sender of this fact
+        send_leader_response_unicast(sender_ip)
 
-        elif msg_code == MsgType.LEADER_REQUEST.value:
-            if self.operation_mode == OperationMode.LEADER:
-                # We are the leader, inform sender of this fact
-                send_leader_response_unicast(sender_ip)
+    def got_set_to_red(self, sender_ip, data):
+        self.set_my_color(NodeColor.RED)
 
-        elif msg_code == MsgType.SET_TO_RED.value:
-            self.set_my_color(NodeColor.RED)
+    def got_set_to_green(self, sender_ip, data):
+        self.set_my_color(NodeColor.GREEN)
 
-        elif msg_code == MsgType.SET_TO_GREEN.value:
-            self.set_my_color(NodeColor.GREEN)
+    def got_set_color(self, sender_ip, data):
+        self.set_my_color(NodeColor(data))
 
-        elif msg_code == MsgType.KEEPALIVE.value:
-            if self.operation_mode == OperationMode.LEADER:
-                self.leader_mode.got_keepalive_from_node(sender_ip, data)
-            else:
-                self.slave_mode.got_keepalive_from_leader()
+    def got_color_command(self, sender_ip, data):
+        seq, color, incarnation = data
+        if sender_ip != self.slave_mode.leader:
+            return
+        # Retransmissions are acknowledged again (the previous ack may have been lost), but applied only once
+        send_color_ack_unicast(sender_ip, seq)
+        if self.slave_mode.accept_command(seq, incarnation):
+            self.set_my_color(NodeColor(color))
 
-        elif msg_code == MsgType.MONITOR_COLOR_REQUEST.value:
-            # This exists only for monitoring purposes - isn't used for the algorithm
-            send_monitor_color_response_unicast(sender_ip, self.my_color.value)
+    def got_color_ack(self, sender_ip, data):
+        self.leader_mode.got_color_ack(sender_ip, data)
 
-        else:
-            print(f"Ignoring this message due to unknown message type: {msg_code}")
+    def got_keepalive_from_leader(self, sender_ip, data):
+        self.slave_mode.got_keepalive_from_leader()
+
+    def got_heartbeat(self, sender_ip, data):
+        if self.slave_mode.leader is None:
+            # Heartbeat comes from a living leader, no need to ask for one
+            self.follow_leader(sender_ip)
+            self.election.stop()
+        if sender_ip == self.slave_mode.leader:
+            color = self.slave_mode.got_heartbeat_from_leader(ip_tools.ip_to_long(self.my_ip),
+                                                              self.my_color.value, data)
+            if color is not None:
+                self.set_my_color(NodeColor(color))
+
+    def got_state_request(self, sender_ip, data):
+        self.leader_mode.got_state_request(sender_ip)
+
+    def got_state_response(self, sender_ip, data):
+        if sender_ip == self.slave_mode.leader:
+            self.set_my_color(NodeColor(self.slave_mode.got_state_response(data)))
+
+    def got_replica_snapshot(self, sender_ip, data):
+        if sender_ip == self.slave_mode.leader:
+            # Only the last page of the snapshot is acknowledged
+            self.ack_replica(sender_ip, self.replica.got_snapshot(sender_ip, data))
+
+    def got_replica_delta(self, sender_ip, data):
+        if sender_ip == self.slave_mode.leader:
+            self.ack_replica(sender_ip, self.replica.got_delta(sender_ip, data))
+
+    def ack_replica(self, leader_ip, version):
+        if version is not None:
+            send_replica_ack_unicast(leader_ip, version)
+
+    def got_replica_ack(self, sender_ip, data):
+        self.leader_mode.got_replica_ack(sender_ip, data)
+
+    def got_group_summary(self, sender_ip, data):
+        self.tier.got_summary(sender_ip, data, self.my_ip)
+
+    def got_group_quota(self, sender_ip, data):
+        self.tier.got_quota(sender_ip, data, self.my_ip)
+
+    def got_monitor_color_request(self, sender_ip, data):
+        send_monitor_color_response_unicast(sender_ip, self.my_color.value)
+
+    def got_monitor_subscribe(self, sender_ip, data):
+        self.leader_mode.got_monitor_subscribe(sender_ip, data, ip_tools.ip_to_long(self.my_ip))
+
+    def got_metrics_request(self, sender_ip, data):
+        send_metrics_response_unicast(sender_ip, metrics.registry.snapshot())
 
     async def timer_task(self):
+        if self.membership is not None:
+            self.membership.start(self.resolve_my_ip())
         while True:
-            print("Executing timer task...")
+            log.debug(_logger, "timer", mode=self.operation_mode.name)
 
-            ### Leader periodically checks if nodes are still alive
+            ### Leader checks liveness of nodes on its own timer (LeaderMode.arm_expiry_timer)
             if self.operation_mode == OperationMode.LEADER:
-                self.leader_mode.validate_nodes_keepalive()
+                if config.LEADER_HEARTBEAT_BROADCAST:
+                    self.leader_mode.send_heartbeat()
+                self.leader_mode.repair_standby()
+                if self.tier is not None:
+                    self.tier.tick(self.resolve_my_ip())
 
-            ### Slave either manages election or sends keepalive to leader
+            ### Slave either starts election (it runs on its own deadlines) or sends keepalive to leader
             elif self.operation_mode == OperationMode.SLAVE:
-                if self.slave_mode.leader is None:
-                    self.evaluate_election_state()
-                else:
+                if self.slave_mode.leader is not None and self.membership is None:
                     self.slave_mode.keepalive_to_leader(self.my_color.value)
+                if self.slave_mode.leader is None:
+                    self.election.start()
+
+            await clock.sleep(config.KEEPALIVE_INTERVAL)
 
-            ### TODO: Add separate interval for election?
-            await asyncio.sleep(config.KEEPALIVE_INTERVAL)
-
-    def evaluate_election_state(self):
-        if self.election_state is ElectionState.INIT:
-            # We don't have a leader - request a leader
-            send_leader_request_broadcast()
-            self.election_state = ElectionState.SENT_LEADER_REQUEST
-        elif self.election_state == ElectionState.SENT_LEADER_REQUEST:
-            # No response to LEADER REQUEST, start election
-            send_election_broadcast()
-            self.election_state = ElectionState.SENT_ELECTION_BROADCAST
-        elif self.election_state == ElectionState.SENT_ELECTION_BROADCAST:
-            # No other node has sent us ELECTION or VICTORY message before timeout, this node won the election
-            send_victory_broadcast()
-            self.operation_mode = OperationMode.LEADER
-            self.set_my_color(NodeColor.RED)
-        ############################################################################################################
-        elif self.election_state == ElectionState.ELECTION_MSG_RECEIVED:
-            # Node has been in the ELECTION_MSG_RECEIVED state for one timeout period
-            # (This means node with higher IP has previously sent us ELECTION message - our node has lower priority)
-            self.election_state = ElectionState.ELECTION_MSG_LONG_DELAY
-        elif self.election_state == ElectionState.ELECTION_MSG_LONG_DELAY:
-            # Node has not received any ELECTION messages for two timeout periods, the election process is restarted
-            self.election_state = ElectionState.INIT
+    def won_election(self):
+        self.set_operation_mode(OperationMode.LEADER)
+        self.set_my_color(NodeColor.RED)
+
+    def set_operation_mode(self, mode: OperationMode):
+        if self.operation_mode == OperationMode.LEADER and mode != OperationMode.LEADER:
+            # Table of a former leader would be stale
+            self.leader_mode.stop()
+            if self.tier is not None:
+                self.tier.stop()
+        elif self.operation_mode != OperationMode.LEADER and mode == OperationMode.LEADER:
+            if self.replica.leader is not None:
+                # We were the standby - start from the previous leader's table instead of rebuilding it
+                self.leader_mode.load_replica(self.replica.nodes, ip_tools.ip_to_long(self.my_ip))
+                self.replica.clear()
+            if self.membership is not None:
+                # Start from the converged membership view instead of waiting for the nodes
+                self.leader_mode.load_members(self.membership.alive_members())
+        if self.workers is not None and (self.operation_mode == OperationMode.LEADER) != (mode == OperationMode.LEADER):
+            self.workers.set_leader(mode == OperationMode.LEADER)
+        self.operation_mode = mode
+        self.dispatcher.set_mode(mode)
+
+    def follow_leader(self, leader_ip):
+        if leader_ip != self.replica.leader:
+            # Copy of another leader's table
+            self.replica.clear()
+        self.slave_mode.set_leader(leader_ip)
+
+    def attach_workers(self, workers):
+        self.workers = workers
+        self.leader_mode.workers = workers
+        workers.set_leader(self.operation_mode == OperationMode.LEADER)
+
+    def shard_joined(self, node_ip, node_color):
+        """
+        Keepalive worker has seen a new slave
+        """
+        if self.operation_mode == OperationMode.LEADER:
+            self.leader_mode.member_joined(node_ip, node_color or NodeColor.INIT.value)
+
+    def shard_left(self, node_ip):
+        """
+        Slave from a keepalive worker's shard is dead
+        """
+        if self.operation_mode == OperationMode.LEADER:
+            self.leader_mode.member_left(node_ip)
+
+    def shard_color(self, node_ip, node_color):
+        """
+        Slave from a keepalive worker's shard reports other color than assigned
+        """
+        if self.operation_mode == OperationMode.LEADER and node_color:
+            self.leader_mode.got_node_color(node_ip, node_color)
+
+    def member_joined(self, node_ip):
+        if self.operation_mode == OperationMode.LEADER:
+            self.leader_mode.member_joined(node_ip)
+
+    def member_left(self, node_ip):
+        forget_peer(node_ip)
+        if self.operation_mode == OperationMode.LEADER:
+            self.leader_mode.member_left(node_ip)
+        elif node_ip == self.slave_mode.leader:
+            log.info(_logger, "leader_dead", leader=node_ip)
+            self.slave_mode.clear_leader()
+            self.election.start()
 
     def set_my_color(self, color: NodeColor):
         self.my_color = color
+
+    def render_metrics(self):
+        """
+        Text of the local metrics endpoint, the first line is the node's state
+        """
+        labels = f'node="{self.my_ip}"'
+        state = (f'dsa_node_state{{{labels},mode="{self.operation_mode.name}",color="{self.my_color.name}",'
+                 f'leader="{self.slave_mode.leader or ""}"')
+        if self.tier is not None:
+            quota = self.leader_mode.coloring.first_quota
+            state += f',top="{self.tier.top or ""}",quota="{"" if quota is None else quota}"'
+        return state + "} 1\n" + metrics.render_text(metrics.registry.snapshot(), labels)
@@ -0,0 +1,124 @@
+import random
+
+from src import config
+from src.nodes.node_types import NodeColor
+from src.utils import clock, log, metrics, protocol_msgs
+from src.utils.DeadlineHeap import DeadlineHeap
+from src.utils.protocol_msgs import WIRE_VERSION_COLOR_ACK, send_color_command_unicast, send_set_color_unicast, \
+    send_set_to_green_unicast, send_set_to_red_unicast
+
+_logger = log.get_logger("delivery")
+
+
+class _Command:
+    __slots__ = ("seq", "ip", "color", "attempts")
+
+    def __init__(self, seq, ip, color, attempts):
+        self.seq = seq
+        self.ip = ip
+        self.color = color
+        self.attempts = attempts
+
+
+class ColorDelivery:
+    def __init__(self):
+        """
+        Leader's delivery of color changes - every change is a COLOR_COMMAND with a sequence number,
+        retransmitted with exponential back-off until the node acknowledges it (config.COLOR_RETRY_TIMEOUT,
+        config.COLOR_MAX_ATTEMPTS). Only the latest command of a node is in flight, a newer one replaces it.
+        Nodes which don't speak WIRE_VERSION_COLOR_ACK get the old fire-and-forget SET_TO_RED/... messages.
+        """
+        # Sequence number of the last command (slaves ignore commands older than the last one applied)
+        self.seq = 0
+        # Sent with every command - a leader restarted with the same IP starts its sequence again, slaves reset
+        # the last applied number when the incarnation changes
+        self.incarnation = random.getrandbits(32)
+        # Unacknowledged commands (node_id -> _Command) and their retransmission deadlines
+        self.in_flight = {}
+        self.deadlines = DeadlineHeap()
+        self.timer = None
+        self.timer_deadline = None
+
+    def send(self, node_id, ip, color):
+        """
+        Sends color change to the node
+        :param color: NodeColor
+        """
+        # Wire state is looked up on every send (the simulator swaps it per node)
+        if protocol_msgs.wire.version_for(ip) < WIRE_VERSION_COLOR_ACK:
+            self.in_flight.pop(node_id, None)
+            self.deadlines.remove(node_id)
+            if color == NodeColor.RED:
+                send_set_to_red_unicast(ip)
+            elif color == NodeColor.GREEN:
+                send_set_to_green_unicast(ip)
+            else:
+                send_set_color_unicast(ip, color.value)
+            return
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        command = _Command(self.seq, ip, color.value, 1)
+        self.in_flight[node_id] = command
+        send_color_command_unicast(ip, (command.seq, command.color, self.incarnation))
+        self.schedule(node_id, command)
+
+    def schedule(self, node_id, command):
+        timeout = config.COLOR_RETRY_TIMEOUT * (2 ** (command.attempts - 1))
+        self.deadlines.refresh(node_id, clock.now_ns() + int(timeout * 1e9))
+        self.arm_timer()
+
+    def got_ack(self, node_id, seq):
+        command = self.in_flight.get(node_id)
+        if command is not None and command.seq == seq:
+            del self.in_flight[node_id]
+            self.deadlines.remove(node_id)
+
+    def pending(self, node_id):
+        """
+        :return: True if a command to the node is waiting for acknowledgement
+        """
+        return node_id in self.in_flight
+
+    def forget(self, node_id):
+        """
+        Node was removed from the table
+        """
+        self.in_flight.pop(node_id, None)
+        self.deadlines.remove(node_id)
+
+    def arm_timer(self):
+        deadline = self.deadlines.next_deadline()
+        if deadline is None:
+            return
+        if self.timer is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer.cancel()
+        self.timer = clock.call_later(max(deadline - clock.now_ns(), 0) / 1e9, self.retransmit)
+        self.timer_deadline = deadline
+
+    def retransmit(self):
+        self.timer = None
+        self.timer_deadline = None
+        for node_id in self.deadlines.pop_expired(clock.now_ns()):
+            command = self.in_flight.get(node_id)
+            if command is None:
+                continue
+            if command.attempts >= config.COLOR_MAX_ATTEMPTS:
+                # Node is probably dead or unreachable - its next keepalive reports its color (reconciliation)
+                del self.in_flight[node_id]
+                metrics.registry.incr("color_commands_expired")
+                log.info(_logger, "command_expired", ip=command.ip, color=command.color)
+                continue
+            command.attempts += 1
+            metrics.registry.incr("color_retransmits")
+            send_color_command_unicast(command.ip, (command.seq, command.color, self.incarnation))
+            self.schedule(node_id, command)
+        self.arm_timer()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.timer_deadline = None
+        self.in_flight = {}
+        self.deadlines = DeadlineHeap()
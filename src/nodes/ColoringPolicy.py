@@ -0,0 +1,238 @@
+import abc
+import bisect
+import math
+
+from src import config
+from src.nodes.node_types import NodeColor
+
+
+def policy_colors():
+    """
+    :return: Colors of config.COLOR_RATIOS in order (NodeColor), the first one is the leader's color
+    """
+    return [NodeColor[name] for name in config.COLOR_RATIOS]
+
+
+def color_targets(total, first_quota=None):
+    """
+    Splits total (number of nodes or their total weight, leader included) between the colors
+    Every color gets its absolute quota (config.COLOR_QUOTAS) or ceil(total * ratio), the last color gets the rest.
+    :param first_quota: Quota of the first color which replaces its ratio (given by the top leader to a group)
+    :return: List of targets in the order of policy_colors()
+    """
+    targets = []
+    remaining = total
+    names = list(config.COLOR_RATIOS)
+    for index, name in enumerate(names):
+        if index == len(names) - 1:
+            target = remaining
+        elif index == 0 and first_quota is not None:
+            target = min(first_quota, remaining)
+        elif name in config.COLOR_QUOTAS:
+            target = min(config.COLOR_QUOTAS[name], remaining)
+        else:
+            target = min(math.ceil(total * config.COLOR_RATIOS[name]), remaining)
+        targets.append(target)
+        remaining -= target
+    return targets
+
+
+def node_weight(ip):
+    return config.NODE_WEIGHTS.get(ip, 1)
+
+
+#################################################################################
+# ColoringPolicy
+#################################################################################
+
+class ColoringPolicy(abc.ABC):
+    def __init__(self, nodes_table, assign):
+        """
+        Decides colors of the leader's nodes - the leader reports membership changes and once per recolor step
+        calls rebalance(), the policy calls assign() only for nodes whose color should change
+        (and for added nodes). The leader itself is not in the table, it always has the first color.
+        :param nodes_table: Leader's NodeRegistry
+        :param assign: Function (node_id, NodeView, NodeColor)
+        """
+        self.nodes_table = nodes_table
+        self.assign = assign
+        self.colors = policy_colors()
+        # Quota of the first color set by the leader (hierarchical mode), None = config.COLOR_RATIOS / COLOR_QUOTAS
+        self.first_quota = None
+
+    def size(self):
+        """
+        :return: Number of nodes (their total weight) the targets are computed from, leader included
+        """
+        return len(self.nodes_table) + 1
+
+    @abc.abstractmethod
+    def node_added(self, node_id, data):
+        """
+        Node was inserted into the table
+        """
+
+    @abc.abstractmethod
+    def node_removed(self, node_id):
+        """
+        Node is going to be removed from the table (it is still there)
+        """
+
+    @abc.abstractmethod
+    def rebalance(self):
+        """
+        Recolor step - moves nodes between colors until the targets are met
+        """
+
+    @abc.abstractmethod
+    def balanced(self):
+        """
+        :return: True if the current assignment meets the policy's targets
+        """
+
+
+class PrefixColoring(ColoringPolicy):
+    def __init__(self, nodes_table, assign):
+        """
+        Original algorithm - colors take consecutive ranges of IPs, from the LOWEST IP in the order of the colors
+        (leader is counted in the first range). Node weights are ignored.
+        Only nodes which a range boundary passes over change color, but every join or leave below a boundary
+        moves it - one node at the edge is recolored.
+        """
+        super().__init__(nodes_table, assign)
+        # Rank of the first node of every color but the first one - nodes with rank < boundaries[0] have the first
+        # color, nodes with boundaries[i - 1] <= rank < boundaries[i] color i, the rest the last color
+        self.boundaries = [0] * (len(self.colors) - 1)
+
+    def target_boundaries(self):
+        targets = color_targets(self.size(), self.first_quota)
+        # Remove 1 because leader has the first color
+        boundary = -1
+        boundaries = []
+        for target in targets[:-1]:
+            boundary += target
+            boundaries.append(min(max(boundary, 0), len(self.nodes_table)))
+        return boundaries
+
+    def node_added(self, node_id, data):
+        rank = self.nodes_table.rank(node_id)
+        segment = bisect.bisect_right(self.boundaries, rank)
+        # Node was inserted into a range, all following boundaries move by one
+        for index in range(segment, len(self.boundaries)):
+            self.boundaries[index] += 1
+        self.assign(node_id, data, self.colors[segment])
+
+    def node_removed(self, node_id):
+        rank = self.nodes_table.rank(node_id)
+        for index in range(bisect.bisect_right(self.boundaries, rank), len(self.boundaries)):
+            self.boundaries[index] -= 1
+
+    def rebalance(self):
+        targets = self.target_boundaries()
+        # Boundaries are moved so that they never cross - first those which go down (from the lowest),
+        # then those which go up (from the highest), only nodes a boundary passes over change color
+        for index, target in enumerate(targets):
+            while self.boundaries[index] > target:
+                self.boundaries[index] -= 1
+                node_id, data = self.nodes_table.peekitem(self.boundaries[index])
+                self.assign(node_id, data, self.colors[index + 1])
+        for index in range(len(targets) - 1, -1, -1):
+            while self.boundaries[index] < targets[index]:
+                node_id, data = self.nodes_table.peekitem(self.boundaries[index])
+                self.assign(node_id, data, self.colors[index])
+                self.boundaries[index] += 1
+
+    def balanced(self):
+        return self.boundaries == self.target_boundaries()
+
+
+class StickyColoring(ColoringPolicy):
+    def __init__(self, nodes_table, assign):
+        """
+        Minimal reassignment - a node keeps its color as long as its color doesn't exceed its target.
+        Joining nodes keep the color they report (e.g. assigned by the previous leader) or get the color
+        furthest below its target. Only surplus of a color is moved, the most recently assigned nodes first.
+        Targets are computed from node weights (config.NODE_WEIGHTS), the leader weighs 1.
+        """
+        super().__init__(nodes_table, assign)
+        self.color_index = {color: index for index, color in enumerate(self.colors)}
+        # Nodes of every color grouped by weight, in the order of assignment (weight -> {node_id: None})
+        self.members = [{} for _ in self.colors]
+        # node_id -> (color index, weight)
+        self.node_colors = {}
+        # Total weight of every color, leader has the first color
+        self.loads = [0] * len(self.colors)
+        self.loads[0] = 1
+        self.total = 1
+        # Heaviest node seen - targets can't be met more precisely
+        self.max_weight = 1
+
+    def node_added(self, node_id, data):
+        weight = node_weight(data.ip)
+        self.total += weight
+        self.max_weight = max(self.max_weight, weight)
+        index = self.color_index.get(data.color)
+        if index is None:
+            index = self.most_missing(color_targets(self.total, self.first_quota))
+        self.place(node_id, index, weight)
+        self.assign(node_id, data, self.colors[index])
+
+    def node_removed(self, node_id):
+        index, weight = self.node_colors.pop(node_id)
+        self.take(node_id, index, weight)
+        self.total -= weight
+
+    def place(self, node_id, index, weight):
+        self.node_colors[node_id] = (index, weight)
+        self.members[index].setdefault(weight, {})[node_id] = None
+        self.loads[index] += weight
+
+    def take(self, node_id, index, weight):
+        group = self.members[index][weight]
+        del group[node_id]
+        if not group:
+            del self.members[index][weight]
+        self.loads[index] -= weight
+
+    def size(self):
+        return self.total
+
+    def most_missing(self, targets):
+        return max(range(len(self.colors)), key=lambda index: targets[index] - self.loads[index])
+
+    def rebalance(self):
+        targets = color_targets(self.total, self.first_quota)
+        colors = range(len(self.colors))
+        while True:
+            # Node moves from the color furthest above its target to the one furthest below it, deviations
+            # smaller than the heaviest node are tolerated (they can't be fixed without moving nodes back and forth)
+            index = max(colors, key=lambda i: self.loads[i] - targets[i])
+            target_index = self.most_missing(targets)
+            surplus = self.loads[index] - targets[index]
+            deficit = targets[target_index] - self.loads[target_index]
+            if surplus <= 0 or deficit <= 0 or (surplus < self.max_weight and deficit < self.max_weight):
+                return
+            # Weight which brings both colors closest to their targets, the move has to improve them
+            best = None
+            for weight in self.members[index]:
+                if weight < surplus + deficit and (best is None or abs(surplus - weight) + abs(deficit - weight)
+                                                   < abs(surplus - best) + abs(deficit - best)):
+                    best = weight
+            if best is None:
+                return
+            node_id = next(reversed(self.members[index][best]))
+            self.take(node_id, index, best)
+            self.place(node_id, target_index, best)
+            self.assign(node_id, self.nodes_table[node_id], self.colors[target_index])
+
+    def balanced(self):
+        targets = color_targets(self.total, self.first_quota)
+        return all(abs(load - target) < self.max_weight for load, target in zip(self.loads, targets))
+
+
+# Policies selectable by config.COLORING_POLICY
+POLICIES = {"prefix": PrefixColoring, "sticky": StickyColoring}
+
+
+def create_policy(nodes_table, assign):
+    return POLICIES[config.COLORING_POLICY](nodes_table, assign)
@@ -0,0 +1,154 @@
+from enum import Enum
+
+from src import config
+from src.utils import clock, groups, ip_tools, metrics
+from src.utils.protocol_msgs import send_election_broadcast, send_election_unicast, send_leader_request_broadcast, \
+    send_victory_broadcast, send_victory_unicast
+
+
+#################################################################################
+# TYPES
+#################################################################################
+
+class ElectionState(Enum):
+    INIT = 1
+    SENT_LEADER_REQUEST = 2  # This node has sent a LEADER REQUEST message
+    SENT_ELECTION_BROADCAST = 3
+    ELECTION_MSG_RECEIVED = 4  # This node has received an ELECTION message
+    ELECTION_MSG_LONG_DELAY = 5  # This node has already been in state ELECTION_MSG_RECEIVED for one timeout period
+    ELECTION_PENDING = 6  # This node will broadcast ELECTION unless a higher node does it first
+
+
+def election_range(ip):
+    """
+    Addresses of the nodes our election runs among - our group's network (config.HIERARCHY_GROUPS), else all
+    networks of config.IP_PREFIX, else (IP outside the prefix, e.g. given by NODE_IP) the /24 of our IP
+    :return: Lowest and highest address as longs
+    """
+    group = groups.group_of(ip)
+    if group is not None:
+        network = groups.networks()[group]
+        return int(network.network_address), int(network.broadcast_address)
+    address = ip_tools.ip_to_long(ip)
+    prefixes = config.IP_PREFIX if isinstance(config.IP_PREFIX, tuple) else (config.IP_PREFIX,)
+    ranges = [ip_tools.prefix_range(prefix) for prefix in prefixes]
+    if any(low <= address <= high for low, high in ranges):
+        return min(low for low, _ in ranges), max(high for _, high in ranges)
+    return address & 0xFFFFFF00, address | 0xFF
+
+
+#################################################################################
+# ElectionEngine
+#################################################################################
+
+class ElectionEngine:
+    def __init__(self, on_victory, resolve_local_ip):
+        """
+        Bully election driven by its own per-state deadlines (config.ELECTION_TIMEOUT), independent of the keepalive timer
+        :param on_victory: Called when this node wins the election
+        :param resolve_local_ip: Returns our IP (rank of our ELECTION broadcast)
+        """
+        self.on_victory = on_victory
+        self.resolve_local_ip = resolve_local_ip
+        self.state: ElectionState = ElectionState.INIT
+        self.timer = None
+        # When the current election started (monotonic ns), None if there is no election
+        self.started_at = None
+        # When we (as the leader) last broadcast VICTORY
+        self.last_victory = None
+
+    def enter(self, state: ElectionState):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.state = state
+        if state != ElectionState.INIT:
+            if self.started_at is None:
+                self.started_at = clock.now_ns()
+            timeout = self.stagger() if state == ElectionState.ELECTION_PENDING else config.ELECTION_TIMEOUT
+            self.timer = clock.call_later(timeout, self.deadline_expired, state)
+
+    def stagger(self):
+        """
+        Delay of our ELECTION broadcast - nodes with a higher IP (whole address, ranked within election_range())
+        broadcast sooner, a lower node hears them (ELECTION_MSG_RECEIVED) before its own broadcast and stays silent
+        """
+        ip = self.resolve_local_ip()
+        low, high = election_range(ip)
+        span = max(high - low, 1)
+        return config.ELECTION_STAGGER * (high - ip_tools.ip_to_long(ip)) / span
+
+    def start(self):
+        """
+        We don't have a leader - request a leader (does nothing if the election is already running)
+        """
+        if self.state == ElectionState.INIT:
+            send_leader_request_broadcast()
+            self.enter(ElectionState.SENT_LEADER_REQUEST)
+
+    def stop(self):
+        """
+        Leader is known, election is over
+        """
+        self.enter(ElectionState.INIT)
+        self.finished()
+
+    def finished(self):
+        if self.started_at is not None:
+            metrics.registry.record("election_ms", (clock.now_ns() - self.started_at) // 1000000)
+            metrics.registry.incr("elections")
+            self.started_at = None
+
+    def deadline_expired(self, state: ElectionState):
+        if state != self.state:
+            return
+        self.timer = None
+        if state == ElectionState.SENT_LEADER_REQUEST:
+            # No response to LEADER REQUEST, start election once higher nodes had the chance to do it
+            self.enter(ElectionState.ELECTION_PENDING)
+        elif state == ElectionState.ELECTION_PENDING:
+            # No higher node has broadcast ELECTION meanwhile
+            send_election_broadcast()
+            self.enter(ElectionState.SENT_ELECTION_BROADCAST)
+        elif state == ElectionState.SENT_ELECTION_BROADCAST:
+            # No other node has sent us ELECTION or VICTORY message before timeout, this node won the election
+            send_victory_broadcast()
+            self.enter(ElectionState.INIT)
+            self.finished()
+            self.on_victory()
+        elif state == ElectionState.ELECTION_MSG_RECEIVED:
+            # Node with higher IP has sent us ELECTION message, but there is no VICTORY yet
+            self.enter(ElectionState.ELECTION_MSG_LONG_DELAY)
+        elif state == ElectionState.ELECTION_MSG_LONG_DELAY:
+            # Node has not received any ELECTION messages for two timeout periods, the election process is restarted
+            self.enter(ElectionState.INIT)
+            self.start()
+
+    def answer_as_leader(self, sender_ip):
+        """
+        We are the leader and higher than the sender - one VICTORY broadcast per timeout ends the election for everybody,
+        senders which come later get a unicast (a broadcast for each of them would restart the election cascade)
+        """
+        now = clock.now_ns()
+        if self.last_victory is None or now - self.last_victory >= config.ELECTION_TIMEOUT * 1e9:
+            self.last_victory = now
+            send_victory_broadcast()
+        else:
+            send_victory_unicast(sender_ip)
+
+    def got_election(self, sender_ip, my_ip):
+        if ip_tools.is_higher_ip(sender_ip, my_ip):
+            # There is a node with higher IP in the election
+            self.enter(ElectionState.ELECTION_MSG_RECEIVED)
+        elif self.state == ElectionState.SENT_ELECTION_BROADCAST:
+            # Sender has missed our broadcast, inform it directly
+            send_election_unicast(sender_ip)
+        elif self.state in (ElectionState.ELECTION_MSG_RECEIVED, ElectionState.ELECTION_MSG_LONG_DELAY,
+                            ElectionState.ELECTION_PENDING):
+            # Node higher than us is running the election and answers the sender (or our broadcast is scheduled)
+            pass
+        else:
+            # One broadcast answers all lower nodes at once (instead of a unicast to each of them) and starts our own
+            # election - all nodes above the sender got its ELECTION, only the highest of them should answer,
+            # so the broadcast is staggered by rank
+            self.enter(ElectionState.ELECTION_PENDING)
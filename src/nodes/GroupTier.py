@@ -0,0 +1,135 @@
+from src import config
+from src.nodes.ColoringPolicy import color_targets
+from src.utils import clock, groups, ip_tools, log, metrics
+from src.utils.protocol_msgs import send_group_quota_unicast, send_group_summary_tier, send_group_summary_unicast
+
+_logger = log.get_logger("tier")
+
+
+#################################################################################
+# TYPES
+#################################################################################
+
+class GroupState:
+    __slots__ = ("leader", "size", "red", "deadline")
+
+    def __init__(self, leader, size, red, deadline):
+        """
+        Last summary of one group held by the top leader
+        """
+        self.leader = leader
+        self.size = size
+        self.red = red
+        self.deadline = deadline
+
+
+#################################################################################
+# GroupTier
+#################################################################################
+
+class GroupTier:
+    def __init__(self, summarize, set_quota):
+        """
+        Top tier of the hierarchical mode (config.HIERARCHY_GROUPS) - active on the leader of every group.
+        Group leaders send a summary of their group (size, RED count) to the top leader every KEEPALIVE_INTERVAL,
+        the top leader answers with the group's RED quota, so the global ratio holds. Its load depends on
+        the number of groups, not nodes.
+        The top leader is the highest group leader (bully without election messages) - a group leader which
+        doesn't follow a living top leader acts as one and announces itself by a summary broadcast to all groups,
+        lower group leaders follow the highest announcement they hear.
+        :param summarize: Returns (size, RED count) of our group
+        :param set_quota: Called with the RED quota of our group
+        """
+        self.summarize = summarize
+        self.set_quota = set_quota
+        # Top leader we follow (our own IP if we are the top leader)
+        self.top = None
+        self.top_deadline = None
+        # Top leader only - group index -> GroupState
+        self.groups = {}
+        # RED quotas of the groups computed from self.groups (group index -> quota)
+        self.quotas = {}
+
+    def tick(self, my_ip):
+        """
+        Called every KEEPALIVE_INTERVAL while we are the leader of our group
+        """
+        group = groups.group_of(my_ip)
+        if group is None:
+            return
+        now = clock.now_ns()
+        if self.top is not None and self.top != my_ip and now > self.top_deadline:
+            log.info(_logger, "top_leader_dead", top=self.top)
+            self.top = None
+        size, red = self.summarize()
+        if self.top is not None and self.top != my_ip:
+            send_group_summary_unicast(self.top, (group, size, red))
+            return
+        if self.top is None:
+            log.info(_logger, "top_leader", top=my_ip)
+            metrics.registry.incr("top_leader_takeovers")
+        self.top = my_ip
+        self.groups[group] = GroupState(my_ip, size, red, now + config.NODE_DEAD_AFTER)
+        for index, state in list(self.groups.items()):
+            if state.deadline <= now:
+                log.info(_logger, "group_removed", group=index, leader=state.leader)
+                del self.groups[index]
+        self.split()
+        # Announcement - lower group leaders follow us, a higher one takes over
+        send_group_summary_tier((group, size, red))
+        self.set_quota(self.quotas[group])
+
+    def got_summary(self, sender_ip, summary, my_ip):
+        group, size, red = summary
+        now = clock.now_ns()
+        if ip_tools.is_higher_ip(sender_ip, self.top or my_ip):
+            # Higher group leader - it is the top leader, it gets our summary right away
+            self.follow(sender_ip, now)
+            my_size, my_red = self.summarize()
+            send_group_summary_unicast(sender_ip, (groups.group_of(my_ip), my_size, my_red))
+        elif sender_ip == self.top:
+            # Announcement of our top leader
+            self.top_deadline = now + config.LEADER_DEAD_AFTER
+        elif self.top is None or self.top == my_ip:
+            self.top = my_ip
+            self.groups[group] = GroupState(sender_ip, size, red, now + config.NODE_DEAD_AFTER)
+            self.split()
+            send_group_quota_unicast(sender_ip, (group, self.quotas[group]))
+        # Otherwise a lower group leader which doesn't know the top leader yet - it will hear its announcement
+
+    def got_quota(self, sender_ip, data, my_ip):
+        group, quota = data
+        if group != groups.group_of(my_ip):
+            return
+        if sender_ip != self.top and not ip_tools.is_higher_ip(sender_ip, self.top or my_ip):
+            return
+        self.follow(sender_ip, clock.now_ns())
+        self.set_quota(quota)
+
+    def follow(self, top_ip, now):
+        if top_ip != self.top:
+            log.info(_logger, "top_leader", top=top_ip)
+            self.groups = {}
+            self.quotas = {}
+        self.top = top_ip
+        self.top_deadline = now + config.LEADER_DEAD_AFTER
+
+    def split(self):
+        """
+        Splits the global RED target between the known groups in proportion to their sizes
+        """
+        sizes = {index: state.size for index, state in self.groups.items()}
+        quotas = groups.split_quota(color_targets(sum(sizes.values()))[0], sizes)
+        if quotas != self.quotas:
+            log.info(_logger, "quotas", quotas=quotas, red=sum(state.red for state in self.groups.values()))
+            metrics.registry.incr("quota_changes")
+            self.quotas = quotas
+
+    def stop(self):
+        """
+        We are no longer the leader of our group
+        """
+        self.top = None
+        self.top_deadline = None
+        self.groups = {}
+        self.quotas = {}
@@ -1,22 +1,36 @@
+import logging
 import time
-import math
 from src import config
-import src.nodes.BaseNode as Base
+from src.nodes.node_types import NodeColor
+from src.nodes.ColorDelivery import ColorDelivery
+from src.nodes.ColoringPolicy import create_policy
+from src.nodes.LeaderReplica import NO_VERSION
+from src.nodes.NodeRegistry import NodeRegistry
+from src.utils import clock, ip_tools, log, metrics, protocol_msgs
+from src.utils.DeadlineHeap import DeadlineHeap
+from src.utils.FailureDetector import create_detector
 from src.utils.protocol_msgs import *
-from src.utils.sorted_structs import SortedDict
+
+_logger = log.get_logger("leader")
+
+# Snapshot or delta not confirmed by the standby for this long (ns) is sent again by repair_standby()
+_REPLICA_ACK_TIMEOUT = 1_000_000_000
 
 
 #################################################################################
 # TYPES
 #################################################################################
 
-class NodeData:
-    def __init__(self, color, last_seen):
-        self.last_seen = last_seen
-        self.color = color
-
-    def __repr__(self):
-        return f"NodeData({self.last_seen}, {self.color})"
+def member_hash(node_id, color_value):
+    """
+    32-bit hash of one (node, color) assignment - the membership digest is the sum of these,
+    so it can be updated in O(1) when a node joins, leaves or changes color
+    """
+    h = (node_id * 0x9E3779B1 + color_value * 0x85EBCA6B) & 0xFFFFFFFF
+    h ^= h >> 16
+    h = (h * 0x7FEB352D) & 0xFFFFFFFF
+    h ^= h >> 15
+    return h
 
 
 #################################################################################
@@ -25,50 +39,407 @@ class NodeData:
 
 class LeaderMode:
     def __init__(self):
-        self.nodes_table = SortedDict()
-
-    def got_keepalive_from_node(self, node_id, node_color):
-        send_keepalive_unicast(node_id)
-        if not self.nodes_table.contains_key(node_id):
-            data = NodeData(Base.NodeColor(node_color), time.time_ns())
-            self.nodes_table[node_id] = data
-            print("Added NEW node with key", node_id)
-            self.reconfigure_nodes()
-            print(self.nodes_table)
+        # Nodes sorted by IP - key is the IP converted by ip_tools.ip_to_long()
+        self.nodes_table = NodeRegistry()
+        # Decides which nodes change color (config.COLORING_POLICY)
+        self.coloring = create_policy(self.nodes_table, self.assign_color)
+        # Colors assigned since the last recolor step, but not yet sent (node_id -> NodeColor)
+        self.pending_colors = {}
+        # Sent color changes waiting for acknowledgement
+        self.delivery = ColorDelivery()
+        # Liveness deadlines of nodes (monotonic ns) given by the failure detector (config.FAILURE_DETECTOR)
+        self.liveness = DeadlineHeap()
+        self.detector = create_detector(config.NODE_DEAD_AFTER)
+        self.expiry_timer = None
+        self.expiry_timer_deadline = None
+        self.recolor_handle = None
+        # Subscribed monitors (monitor IP -> subscription deadline in monotonic ns)
+        self.monitors = {}
+        # Keepalive worker processes (LeaderWorkers.LeaderWorkerPool) told every assigned color, None without workers
+        self.workers = None
+        self.init_heartbeat_state()
+        self.init_standby_state()
+
+    def init_heartbeat_state(self):
+        # Version of the membership and color table, incremented by every recolor step which changed something
+        self.epoch = 0
+        self.digest = 0
+        self.membership_changed = False
+        # Color changes since the last HEARTBEAT (node_id -> color value) and epoch of that HEARTBEAT
+        self.heartbeat_delta = {}
+        self.heartbeat_base_epoch = 0
+        # Membership and color changes of the current recolor step pushed to monitors and the standby
+        # (node_id -> color value, 0 = removed)
+        self.monitor_delta = {}
+
+    def init_standby_state(self):
+        # Node our table is replicated to (IP) and epoch of its copy (the confirmed one or the snapshot being sent)
+        self.standby = None
+        self.standby_base = NO_VERSION
+        self.standby_sent_at = None
+        # Snapshot the standby hasn't confirmed yet ([(node_id, color)] at epoch standby_base) - it is sent again
+        # with the same epoch until it is
+        self.standby_snapshot = None
+        # Recolor steps after standby_base the standby hasn't confirmed ([(epoch, changes)]) - they are sent again
+        # as one delta from standby_base
+        self.standby_steps = []
+
+    def got_keepalive_from_node(self, node_ip, node_color):
+        if not config.LEADER_HEARTBEAT_BROADCAST:
+            send_keepalive_unicast(node_ip)
+        node_id = ip_tools.ip_to_long(node_ip)
+        current_time = clock.now_ns()
+        table = self.nodes_table
+        index = table.find(node_id)
+        if index is None:
+            self.add_node(node_id, NodeColor(node_color), current_time)
+            log.info(_logger, "node_added", ip=node_ip)
+            # Joins received in the same loop iteration share one recolor step
+            self.schedule_reconfigure()
         else:
-            self.nodes_table[node_id].last_seen = time.time_ns()
+            table.last_seen[index] = current_time
+            self.reconcile_color(node_id, node_ip, node_color, index)
+        self.liveness.refresh(node_id, self.detector.heartbeat(node_id, current_time))
+        self.arm_expiry_timer()
+
+    def got_node_color(self, node_ip, node_color):
+        """
+        Keepalive worker reports a node of its shard whose keepalive carries other color than assigned
+        """
+        node_id = ip_tools.ip_to_long(node_ip)
+        index = self.nodes_table.find(node_id)
+        if index is not None:
+            self.reconcile_color(node_id, node_ip, node_color, index)
+
+    def reconcile_color(self, node_id, node_ip, node_color, index):
+        table = self.nodes_table
+        if node_color != table.colors[index] and node_id not in self.pending_colors \
+                and not self.delivery.pending(node_id):
+            # Node reports other color than assigned (its command was lost) - repaired right away
+            metrics.registry.incr("color_repairs")
+            self.delivery.send(node_id, node_ip, NodeColor(table.colors[index]))
+
+    def got_color_ack(self, node_ip, seq):
+        self.delivery.got_ack(ip_tools.ip_to_long(node_ip), seq)
+
+    def got_replica_ack(self, node_ip, version):
+        if node_ip != self.standby:
+            return
+        if self.standby_snapshot is not None:
+            if version == self.standby_base:
+                # Whole snapshot arrived, changes made since it was taken follow
+                self.standby_snapshot = None
+                if self.standby_steps:
+                    self.send_replica_delta()
+            return
+        epochs = [epoch for epoch, _ in self.standby_steps]
+        if version in epochs:
+            del self.standby_steps[:epochs.index(version) + 1]
+            self.standby_base = version
+        elif version != self.standby_base:
+            # Copy doesn't follow our epochs (empty or from another leader)
+            self.send_replica_snapshot()
 
     def validate_nodes_keepalive(self):
-        current_time = time.time_ns()
+        # Only nodes whose deadline has passed are touched
+        start = time.perf_counter_ns()
+        self.expiry_timer = None
+        self.expiry_timer_deadline = None
+        dead_nodes = self.liveness.pop_expired(clock.now_ns())
+        if dead_nodes:
+            metrics.registry.incr("nodes_expired", len(dead_nodes))
+            for key in dead_nodes:
+                log.info(_logger, "node_removed", ip=ip_tools.long_to_ip(key))
+                self.remove_node(key)
+            # All removals of this sweep are handled by one recolor step
+            self.reconfigure_nodes()
+        self.arm_expiry_timer()
+        metrics.registry.record("validate_ns", time.perf_counter_ns() - start)
+
+    def member_joined(self, node_ip, node_color=None):
+        """
+        Membership engine (or a keepalive worker) reports a new node
+        :param node_color: Color value reported by the node, if known
+        """
+        node_id = ip_tools.ip_to_long(node_ip)
+        if node_id not in self.nodes_table:
+            color = NodeColor.INIT if node_color is None else NodeColor(node_color)
+            self.add_node(node_id, color, clock.now_ns())
+            log.info(_logger, "node_added", ip=node_ip)
+            self.schedule_reconfigure()
+        else:
+            # Node loaded from the replica - its liveness is tracked by the membership engine (or the worker)
+            self.liveness.remove(node_id)
+            if node_color is not None:
+                self.reconcile_color(node_id, node_ip, node_color, self.nodes_table.find(node_id))
+
+    def member_left(self, node_ip):
+        """
+        Membership engine reports a dead node
+        """
+        node_id = ip_tools.ip_to_long(node_ip)
+        if node_id in self.nodes_table:
+            log.info(_logger, "node_removed", ip=node_ip)
+            self.remove_node(node_id)
+            self.schedule_reconfigure()
+
+    def load_members(self, node_ips):
+        """
+        Fills the table from the membership engine's current view when this node becomes the leader
+        """
+        for node_ip in node_ips:
+            self.member_joined(node_ip)
+
+    def load_replica(self, nodes, my_id):
+        """
+        Fills the table from the standby's copy of the previous leader's table when this node becomes the leader -
+        nodes keep their colors and have NODE_DEAD_AFTER to show up, one recolor step reconciles the rest
+        :param nodes: node_id -> color value (LeaderReplica.nodes)
+        :param my_id: This node's IP as long (it was a slave in the copy)
+        """
+        current_time = clock.now_ns()
+        for node_id, color in nodes.items():
+            if node_id != my_id:
+                self.add_node(node_id, NodeColor(color), current_time)
+                self.liveness.refresh(node_id, current_time + config.NODE_DEAD_AFTER)
+        metrics.registry.incr("replica_takeovers")
+        log.info(_logger, "replica_loaded", nodes=len(self.nodes_table))
+        self.arm_expiry_timer()
+        self.schedule_reconfigure()
+
+    def got_state_request(self, node_ip):
+        index = self.nodes_table.find(ip_tools.ip_to_long(node_ip))
+        if index is not None:
+            # Unknown nodes are added by their next keepalive
+            send_state_response_unicast(node_ip, (self.epoch, self.digest, self.nodes_table.colors[index]))
 
-        for key in self.nodes_table:
-            data = self.nodes_table[key]
-            if current_time - data.last_seen > config.NODE_DEAD_AFTER:
-                del self.nodes_table[key]
-                print("Removed DEAD node with key", key)
-                self.reconfigure_nodes()
-                print(self.nodes_table)
+    def send_heartbeat(self):
+        """
+        One broadcast per interval replaces the keepalive replies to every node
+        """
+        changes = list(self.heartbeat_delta.items())
+        base_epoch = self.heartbeat_base_epoch
+        if len(changes) > config.HEARTBEAT_MAX_DELTA:
+            # Too many changes for one datagram - nodes whose digest doesn't match ask for their state
+            changes = []
+            base_epoch = self.epoch
+        send_heartbeat_broadcast((self.epoch, self.digest, base_epoch, changes))
+        self.heartbeat_base_epoch = self.epoch
+        self.heartbeat_delta.clear()
+
+    def got_monitor_subscribe(self, monitor_ip, monitor_version, my_id):
+        """
+        Monitor subscribes (or renews its subscription) - it gets a snapshot if its view is not current,
+        an empty delta otherwise (so it knows we are alive). Snapshots and deltas are sent in pages.
+        """
+        self.monitors[monitor_ip] = clock.now_ns() + int(config.MONITOR_SUBSCRIPTION_TIMEOUT * 1e9)
+        if monitor_version != self.epoch:
+            nodes = self.nodes_table.color_items()
+            # Leader is always RED
+            nodes.append((my_id, NodeColor.RED.value))
+            send_monitor_snapshot_unicast(monitor_ip, self.epoch, nodes)
+        else:
+            send_monitor_delta_unicast(monitor_ip, self.epoch, self.epoch, [])
+
+    def push_monitor_delta(self, base_epoch, changes):
+        """
+        Sends changes of the last recolor step to subscribed monitors, drops expired subscriptions
+        """
+        if not self.monitors:
+            return
+        now = clock.now_ns()
+        for monitor_ip, deadline in list(self.monitors.items()):
+            if deadline <= now:
+                del self.monitors[monitor_ip]
+            else:
+                send_monitor_delta_unicast(monitor_ip, base_epoch, self.epoch, changes)
+
+    def replicate(self, base_epoch, changes):
+        """
+        Sends changes of the last recolor step to the standby - the highest slave, which wins the next election.
+        New standby (or one which has fallen behind) gets the whole table (both are sent in pages).
+        """
+        if not self.nodes_table or not config.LEADER_REPLICATION:
+            self.init_standby_state()
+            return
+        standby = ip_tools.long_to_ip(self.nodes_table.select(-1))
+        # Wire state is looked up on every send (the simulator swaps it per node)
+        if protocol_msgs.wire.version_for(standby) < WIRE_VERSION_REPLICA:
+            self.init_standby_state()
+            return
+        last_epoch = self.standby_steps[-1][0] if self.standby_steps else self.standby_base
+        if standby != self.standby or last_epoch != base_epoch:
+            self.standby = standby
+            self.send_replica_snapshot()
+            return
+        self.standby_steps.append((self.epoch, changes))
+        if self.standby_snapshot is None:
+            self.standby_sent_at = clock.now_ns()
+            send_replica_delta_unicast(standby, base_epoch, self.epoch, changes)
+
+    def send_replica_snapshot(self):
+        self.standby_snapshot = self.nodes_table.color_items()
+        self.standby_base = self.epoch
+        self.standby_steps = []
+        self.standby_sent_at = clock.now_ns()
+        send_replica_snapshot_unicast(self.standby, self.standby_base, self.standby_snapshot)
+        metrics.registry.incr("replica_snapshots")
+
+    def send_replica_delta(self):
+        """
+        Sends all unconfirmed steps as one delta from the standby's copy
+        """
+        changes = {}
+        for _, step_changes in self.standby_steps:
+            changes.update(step_changes)
+        self.standby_sent_at = clock.now_ns()
+        send_replica_delta_unicast(self.standby, self.standby_base, self.standby_steps[-1][0], list(changes.items()))
+
+    def repair_standby(self):
+        """
+        Called every KEEPALIVE_INTERVAL - what the standby hasn't confirmed is sent again. An unconfirmed snapshot
+        keeps its epoch, so the standby fills in only the pages it has missed, unconfirmed deltas go as one delta.
+        """
+        if self.standby_snapshot is None and not self.standby_steps:
+            return
+        if clock.now_ns() - self.standby_sent_at < _REPLICA_ACK_TIMEOUT:
+            return
+        if self.standby_snapshot is not None:
+            self.standby_sent_at = clock.now_ns()
+            send_replica_snapshot_unicast(self.standby, self.standby_base, self.standby_snapshot)
+            metrics.registry.incr("replica_snapshot_resends")
+        else:
+            self.send_replica_delta()
+            metrics.registry.incr("replica_delta_resends")
+
+    def group_summary(self):
+        """
+        :return: (size, number of nodes of the first color) of our group, leader included (hierarchical mode)
+        """
+        first = self.coloring.colors[0].value
+        return self.coloring.size(), self.nodes_table.color_counts().get(first, 0) + 1
+
+    def set_color_quota(self, quota):
+        """
+        Quota of the first color (RED) for our group given by the top leader (hierarchical mode)
+        """
+        if quota != self.coloring.first_quota:
+            log.info(_logger, "quota", quota=quota, size=self.coloring.size())
+            self.coloring.first_quota = quota
+            self.schedule_reconfigure()
+
+    def schedule_reconfigure(self):
+        if self.recolor_handle is None:
+            self.recolor_handle = clock.call_soon(self.reconfigure_nodes)
+
+    def arm_expiry_timer(self):
+        """
+        Schedules validate_nodes_keepalive() at the earliest liveness deadline
+        """
+        deadline = self.liveness.next_deadline()
+        if deadline is None:
+            return
+        if self.expiry_timer is not None:
+            if self.expiry_timer_deadline <= deadline:
+                return
+            self.expiry_timer.cancel()
+        delay = max(deadline - clock.now_ns(), 0) / 1e9
+        self.expiry_timer = clock.call_later(delay, self.validate_nodes_keepalive)
+        self.expiry_timer_deadline = deadline
+
+    def stop(self):
+        """
+        Drops all leader state (node is no longer the leader)
+        """
+        if self.expiry_timer is not None:
+            self.expiry_timer.cancel()
+        if self.recolor_handle is not None:
+            self.recolor_handle.cancel()
+        self.expiry_timer = None
+        self.expiry_timer_deadline = None
+        self.recolor_handle = None
+        self.delivery.stop()
+        self.nodes_table = NodeRegistry()
+        self.coloring = create_policy(self.nodes_table, self.assign_color)
+        self.pending_colors = {}
+        self.liveness = DeadlineHeap()
+        self.detector = create_detector(config.NODE_DEAD_AFTER)
+        self.monitors = {}
+        self.init_heartbeat_state()
+        self.init_standby_state()
+
+    def add_node(self, node_id, color, last_seen):
+        """
+        Inserts node into the table, the coloring policy assigns its color
+        :param color: Color the node reports (NodeColor)
+        """
+        data = self.nodes_table.add(node_id, color, last_seen, self.epoch)
+        self.digest = (self.digest + member_hash(node_id, color.value)) & 0xFFFFFFFF
+        self.monitor_delta[node_id] = color.value
+        self.membership_changed = True
+        self.coloring.node_added(node_id, data)
+
+    def remove_node(self, node_id):
+        """
+        Removes node from the table
+        """
+        self.coloring.node_removed(node_id)
+        self.digest = (self.digest - member_hash(node_id, self.nodes_table.colors[self.nodes_table.index(node_id)])) \
+            & 0xFFFFFFFF
+        self.membership_changed = True
+        del self.nodes_table[node_id]
+        self.pending_colors.pop(node_id, None)
+        self.delivery.forget(node_id)
+        self.heartbeat_delta.pop(node_id, None)
+        self.monitor_delta[node_id] = 0
+        self.liveness.remove(node_id)
+        self.detector.remove(node_id)
+        forget_peer(ip_tools.long_to_ip(node_id))
+
+    def assign_color(self, node_id, data, color):
+        if data.color == color:
+            # Node already has this color (possibly assigned and reverted within one recolor step)
+            self.pending_colors.pop(node_id, None)
+        else:
+            self.pending_colors[node_id] = color
 
     def reconfigure_nodes(self):
-        # Coloring algorithm - Leader is always RED, then nodes from the LOWEST IP are colored RED, the rest is colored GREEN
-        total_nodes = len(self.nodes_table) + 1
-        print("total_nodes", total_nodes)
-        to_color_red = math.ceil(total_nodes * config.RED_RATIO)
-        print("to_color_red", to_color_red)
-
-        # Remove 1 because leader is RED by default
-        to_color_red -= 1
-
-        for node_id in self.nodes_table:
-            #print(node_id)
-            node_color = self.nodes_table[node_id].color
-            if to_color_red > 0:
-                if node_color != Base.NodeColor.RED:
-                    #print("coloring red", node_color)
-                    send_set_to_red_unicast(node_id)
-                    self.nodes_table[node_id].color = Base.NodeColor.RED
-                to_color_red -= 1
-            elif (to_color_red <= 0) and (node_color != Base.NodeColor.GREEN):
-                #print("coloring green", node_color)
-                send_set_to_green_unicast(node_id)
-                self.nodes_table[node_id].color = Base.NodeColor.GREEN
+        if self.recolor_handle is not None:
+            # Called directly, the scheduled step is not needed anymore
+            self.recolor_handle.cancel()
+            self.recolor_handle = None
+        # Leader always has the first color (RED), the policy decides which nodes change color
+        self.coloring.rebalance()
+
+        changed = self.membership_changed or self.pending_colors
+        new_epoch = (self.epoch + 1) & 0xFFFFFFFF
+        if changed:
+            metrics.registry.incr("recolors")
+            metrics.registry.incr("color_changes", len(self.pending_colors))
+            log.info(_logger, "recolor", nodes=len(self.nodes_table) + 1, changes=len(self.pending_colors),
+                     epoch=new_epoch)
+        table = self.nodes_table
+        for node_id, color in self.pending_colors.items():
+            index = table.index(node_id)
+            self.delivery.send(node_id, ip_tools.long_to_ip(node_id), color)
+            self.digest = (self.digest - member_hash(node_id, table.colors[index])
+                           + member_hash(node_id, color.value)) & 0xFFFFFFFF
+            self.heartbeat_delta[node_id] = color.value
+            self.monitor_delta[node_id] = color.value
+            table.colors[index] = color.value
+            table.epochs[index] = new_epoch
+        self.pending_colors.clear()
+        if changed:
+            self.epoch = new_epoch
+            self.membership_changed = False
+            base_epoch = (self.epoch - 1) & 0xFFFFFFFF
+            changes = list(self.monitor_delta.items())
+            self.monitor_delta.clear()
+            self.push_monitor_delta(base_epoch, changes)
+            self.replicate(base_epoch, changes)
+            if self.workers is not None:
+                self.workers.send_assigned(changes)
+        if _logger.isEnabledFor(logging.DEBUG):
+            # The whole table is formatted only at DEBUG level
+            _logger.debug("table", extra={"table": [(ip_tools.long_to_ip(node_id), NodeColor(color).name)
+                                                    for node_id, color in self.nodes_table.color_items()]})
@@ -0,0 +1,74 @@
+from src.utils import log
+from src.utils.PageAssembler import PageAssembler
+
+_logger = log.get_logger("replica")
+
+NO_VERSION = 0xFFFFFFFF
+
+
+#################################################################################
+# LeaderReplica
+#################################################################################
+
+class LeaderReplica:
+    def __init__(self):
+        """
+        Standby's copy of the leader's table (node_id -> color value) - the leader replicates it to the node
+        which wins the next election (the highest slave), which then takes over without rebuilding the table
+        """
+        self.leader = None
+        # Leader's epoch the copy corresponds to
+        self.version = NO_VERSION
+        self.nodes = {}
+        # Pages of snapshots ((leader IP, epoch)) and deltas ((base epoch, epoch)) received so far
+        self.snapshot_pages = PageAssembler(2)
+        self.delta_pages = PageAssembler(4)
+
+    def got_snapshot(self, leader_ip, snapshot):
+        """
+        :param snapshot: One page (epoch, page, pages, [(node_id, color)])
+        :return: Version of the copy (acknowledged to the leader), None until all pages arrived
+        """
+        epoch, page, pages, items = snapshot
+        nodes = self.snapshot_pages.add((leader_ip, epoch), page, pages, items)
+        if nodes is None:
+            return None
+        self.version = epoch
+        self.leader = leader_ip
+        self.delta_pages.clear()
+        self.nodes = dict(nodes)
+        log.debug(_logger, "snapshot", leader=leader_ip, epoch=self.version, nodes=len(self.nodes))
+        return self.version
+
+    def got_delta(self, leader_ip, delta):
+        """
+        :param delta: One page (base epoch, epoch, page, pages, [(node_id, color)]), color 0 = removed
+        :return: Version of the copy (if the delta doesn't follow it, the leader resends the steps after it or sends
+                 a snapshot), None until all pages arrived
+        """
+        base_epoch, epoch, page, pages, items = delta
+        if leader_ip != self.leader:
+            return NO_VERSION
+        changes = self.delta_pages.add((base_epoch, epoch), page, pages, items)
+        if changes is None:
+            return None
+        if epoch == self.version:
+            # Already applied
+            return epoch
+        if base_epoch != self.version:
+            # Some delta (or our ack) was lost
+            return self.version
+        for node_id, color in changes:
+            if color:
+                self.nodes[node_id] = color
+            else:
+                self.nodes.pop(node_id, None)
+        self.version = epoch
+        return epoch
+
+    def clear(self):
+        self.leader = None
+        self.version = NO_VERSION
+        self.nodes = {}
+        self.snapshot_pages.clear()
+        self.delta_pages.clear()
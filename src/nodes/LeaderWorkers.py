@@ -0,0 +1,282 @@
+import asyncio
+import multiprocessing
+import socket
+import struct
+
+from src import config
+from src.utils import clock, event_loop, ip_tools, log, protocol_msgs
+from src.utils.DeadlineHeap import DeadlineHeap
+from src.utils.FailureDetector import create_detector
+
+_logger = log.get_logger("workers")
+
+# Not exported by the socket module on every Python build (value from linux/in.h)
+_IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)
+# struct in_pktinfo - interface index, local address, header destination address
+_PKTINFO_SIZE = 12
+_ANCDATA_SIZE = socket.CMSG_SPACE(_PKTINFO_SIZE)
+
+# Records on the worker <-> coordinator channel (SOCK_SEQPACKET socketpair - keeps record boundaries, signals close)
+_FORWARD = ord('F')  # Worker -> coordinator: (sender IP as long, sender port) followed by the datagram
+_JOIN = ord('J')  # Worker -> coordinator: (node IP as long, color reported in the keepalive)
+_LEAVE = ord('L')  # Worker -> coordinator: (node IP as long, 0)
+_COLOR = ord('C')  # Worker -> coordinator: (node IP as long, color the node reports - other than assigned)
+_MODE = ord('M')  # Coordinator -> worker: 1 = this node is the leader, 0 = it isn't
+_ASSIGNED = ord('A')  # Coordinator -> worker: colors of a recolor step, (node IP as long, color, 0 = removed) items
+_FORWARD_HEAD = struct.Struct("!BIH")
+_MEMBER = struct.Struct("!BIB")
+_CONTROL = struct.Struct("!BB")
+_ASSIGNED_ITEM = struct.Struct("!IB")
+# Max items of one _ASSIGNED record (a recolor step at startup changes every node)
+_ASSIGNED_RECORD_ITEMS = 4096
+
+
+def open_reuseport_socket():
+    """
+    UDP socket on the listening port shared with the other processes of the node (SO_REUSEPORT).
+    The kernel delivers every broadcast to all of them and each unicast to one of them, chosen by a hash
+    of the sender's address - keepalives of one slave always end up in the same process.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    # Destination address of every datagram tells broadcasts from unicasts
+    sock.setsockopt(socket.IPPROTO_IP, _IP_PKTINFO, 1)
+    sock.bind((config.DEFAULT_LISTENING_IP, config.DEFAULT_LISTENING_PORT))
+    sock.setblocking(False)
+    return sock
+
+
+#################################################################################
+# KeepaliveWorker (runs in a worker process)
+#################################################################################
+
+class KeepaliveWorker:
+    def __init__(self, index, my_ip, channel):
+        """
+        Owns the liveness of the slaves whose datagrams the kernel hashes to this process.
+        While the node is the leader, keepalives are answered here and only joins, deaths and keepalives reporting
+        other color than the coordinator assigned go to the coordinator (it repairs the color).
+        Other unicast datagrams are forwarded to the coordinator, broadcasts are dropped (it receives them itself).
+        :param channel: Socket of the socketpair connected to the coordinator
+        """
+        self.index = index
+        self.my_ip = my_ip
+        self.my_addr = socket.inet_aton(my_ip)
+        self.channel = channel
+        self.sock = None
+        self.leader = False
+        # Nodes of this shard (IP as long) and their liveness deadlines
+        self.members = set()
+        self.liveness = DeadlineHeap()
+        self.detector = create_detector(config.NODE_DEAD_AFTER)
+        # Colors assigned by the coordinator (IP as long -> color value) - of all nodes, the shard is not known there
+        self.assigned = {}
+        self.expiry_timer = None
+        self.expiry_timer_deadline = None
+        self.stopped = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        protocol_msgs.set_local_ip(self.my_ip)
+        self.sock = open_reuseport_socket()
+        # Records to the coordinator are rare (joins and deaths) - blocking sends keep them from being dropped
+        self.channel.setblocking(True)
+        loop.add_reader(self.sock.fileno(), self.read_datagrams)
+        loop.add_reader(self.channel.fileno(), self.read_control)
+        log.info(_logger, "worker_started", worker=self.index)
+        try:
+            await self.stopped
+        finally:
+            loop.remove_reader(self.sock.fileno())
+            loop.remove_reader(self.channel.fileno())
+            self.sock.close()
+
+    def read_datagrams(self):
+        for _ in range(config.RECV_BATCH_SIZE):
+            try:
+                data, ancdata, _flags, addr = self.sock.recvmsg(65535, _ANCDATA_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not self.is_unicast(ancdata) or addr[0] == self.my_ip:
+                continue
+            if self.leader and protocol_msgs.peek_msg_type(data) == protocol_msgs.MsgType.KEEPALIVE.value:
+                self.got_keepalive(addr, data)
+            else:
+                self.channel.send(_FORWARD_HEAD.pack(_FORWARD, ip_tools.ip_to_long(addr[0]), addr[1]) + data)
+
+    def is_unicast(self, ancdata):
+        for level, kind, data in ancdata:
+            if level == socket.IPPROTO_IP and kind == _IP_PKTINFO:
+                return data[8:12] == self.my_addr
+        return True
+
+    def got_keepalive(self, addr, data):
+        try:
+            _, node_color = protocol_msgs.decode_msg(data, addr[0])
+        except protocol_msgs.DecodeError as e:
+            log.warning(_logger, "decode_failed", peer=addr[0], error=str(e))
+            return
+        if not config.LEADER_HEARTBEAT_BROADCAST:
+            reply = protocol_msgs.encode_msg(protocol_msgs.MsgType.KEEPALIVE, "", protocol_msgs.wire.version_for(addr[0]))
+            try:
+                self.sock.sendto(reply, (addr[0], config.DEFAULT_LISTENING_PORT))
+            except OSError as e:
+                log.warning(_logger, "send_failed", peer=addr[0], error=str(e))
+        node_id = ip_tools.ip_to_long(addr[0])
+        if node_id not in self.members:
+            self.members.add(node_id)
+            self.channel.send(_MEMBER.pack(_JOIN, node_id, node_color or 0))
+        elif node_color and node_color != self.assigned.get(node_id, node_color):
+            # Command was lost (or its delivery gave up) - reported with every keepalive until the color is repaired
+            self.channel.send(_MEMBER.pack(_COLOR, node_id, node_color))
+        self.liveness.refresh(node_id, self.detector.heartbeat(node_id, clock.now_ns()))
+        self.arm_expiry_timer()
+
+    def arm_expiry_timer(self):
+        deadline = self.liveness.next_deadline()
+        if deadline is None:
+            return
+        if self.expiry_timer is not None:
+            if self.expiry_timer_deadline <= deadline:
+                return
+            self.expiry_timer.cancel()
+        self.expiry_timer = clock.call_later(max(deadline - clock.now_ns(), 0) / 1e9, self.expire_nodes)
+        self.expiry_timer_deadline = deadline
+
+    def expire_nodes(self):
+        self.expiry_timer = None
+        self.expiry_timer_deadline = None
+        for node_id in self.liveness.pop_expired(clock.now_ns()):
+            self.members.discard(node_id)
+            self.detector.remove(node_id)
+            self.channel.send(_MEMBER.pack(_LEAVE, node_id, 0))
+        self.arm_expiry_timer()
+
+    def read_control(self):
+        record = self.channel.recv(1 + _ASSIGNED_RECORD_ITEMS * _ASSIGNED_ITEM.size)
+        if not record:
+            # Coordinator is gone
+            self.stopped.set_result(None)
+            return
+        if record[0] == _ASSIGNED:
+            for node_id, color in _ASSIGNED_ITEM.iter_unpack(memoryview(record)[1:]):
+                if color:
+                    self.assigned[node_id] = color
+                else:
+                    self.assigned.pop(node_id, None)
+            return
+        _, leader = _CONTROL.unpack(record)
+        # Shard is rebuilt from keepalives whenever leadership changes (like the coordinator's table)
+        if self.expiry_timer is not None:
+            self.expiry_timer.cancel()
+        self.expiry_timer = None
+        self.expiry_timer_deadline = None
+        self.members = set()
+        self.assigned = {}
+        self.liveness = DeadlineHeap()
+        self.detector = create_detector(config.NODE_DEAD_AFTER)
+        self.leader = bool(leader)
+
+
+def run_worker(index, my_ip, channel):
+    """
+    Entry point of a worker process
+    """
+    log.setup()
+    event_loop.run(KeepaliveWorker(index, my_ip, channel).run())
+
+
+#################################################################################
+# LeaderWorkerPool (runs in the coordinator - the node's main process)
+#################################################################################
+
+class LeaderWorkerPool:
+    def __init__(self, count, my_ip, process_msg, on_join, on_leave, on_color):
+        """
+        Worker processes sharing the listening port with the coordinator
+        :param process_msg: Called with datagrams forwarded by workers (same signature as BaseNode.process_msg)
+        :param on_join: Called with (node IP, color value) when a worker sees a new slave
+        :param on_leave: Called with node IP when a slave of a worker's shard is dead
+        :param on_color: Called with (node IP, color value) when a slave reports other color than assigned
+        """
+        self.count = count
+        self.my_ip = my_ip
+        self.process_msg = process_msg
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self.on_color = on_color
+        self.processes = []
+        self.channels = []
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        # Spawned (not forked) - the child must not inherit the running event loop
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.count):
+            parent_channel, child_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = context.Process(target=run_worker, args=(index, self.my_ip, child_channel), daemon=True)
+            process.start()
+            child_channel.close()
+            parent_channel.setblocking(False)
+            loop.add_reader(parent_channel.fileno(), self.read_channel, parent_channel)
+            self.processes.append(process)
+            self.channels.append(parent_channel)
+
+    def read_channel(self, channel):
+        while True:
+            try:
+                record = channel.recv(65535 + _FORWARD_HEAD.size)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not record:
+                asyncio.get_running_loop().remove_reader(channel.fileno())
+                return
+            kind = record[0]
+            if kind == _FORWARD:
+                _, node_id, port = _FORWARD_HEAD.unpack_from(record)
+                self.process_msg((ip_tools.long_to_ip(node_id), port), memoryview(record)[_FORWARD_HEAD.size:])
+            elif kind == _JOIN:
+                _, node_id, color = _MEMBER.unpack(record)
+                self.on_join(ip_tools.long_to_ip(node_id), color)
+            elif kind == _LEAVE:
+                _, node_id, _ = _MEMBER.unpack(record)
+                self.on_leave(ip_tools.long_to_ip(node_id))
+            elif kind == _COLOR:
+                _, node_id, color = _MEMBER.unpack(record)
+                self.on_color(ip_tools.long_to_ip(node_id), color)
+
+    def set_leader(self, leader):
+        """
+        Workers answer keepalives only while this node is the leader
+        """
+        self.send_control(_CONTROL.pack(_MODE, 1 if leader else 0))
+
+    def send_assigned(self, changes):
+        """
+        Tells the workers colors assigned in a recolor step, so they report slaves whose keepalive disagrees
+        :param changes: [(node_id, color value)], 0 = removed
+        """
+        for start in range(0, len(changes), _ASSIGNED_RECORD_ITEMS):
+            items = changes[start:start + _ASSIGNED_RECORD_ITEMS]
+            self.send_control(bytes((_ASSIGNED,)) + b"".join(_ASSIGNED_ITEM.pack(*item) for item in items))
+
+    def send_control(self, record):
+        for channel in self.channels:
+            try:
+                channel.send(record)
+            except OSError as e:
+                log.warning(_logger, "control_failed", error=str(e))
+
+    def stop(self):
+        loop = asyncio.get_running_loop()
+        for channel in self.channels:
+            loop.remove_reader(channel.fileno())
+            channel.close()
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self.channels = []
+        self.processes = []
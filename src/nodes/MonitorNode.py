@@ -1,36 +1,192 @@
+import logging
+
 from src import config
-from src.nodes.BaseNode import NodeColor
-from src.utils import ip_tools
-from src.utils.protocol_msgs import MsgType, decode_msg, send_monitor_color_request_broadcast
-from src.utils.sorted_structs import SortedDict
-import asyncio
+from src.nodes.node_types import NodeColor, OperationMode
+from src.nodes.NodeRegistry import NodeRegistry
+from src.utils import clock, ip_tools, log, metrics
+from src.utils.MsgDispatcher import MsgDispatcher
+from src.utils.PageAssembler import PageAssembler
+from src.utils.protocol_msgs import MsgType, send_metrics_request_broadcast, \
+    send_monitor_subscribe_broadcast, send_monitor_subscribe_unicast
+
+_logger = log.get_logger("monitor")
+
+# Version sent in MONITOR_SUBSCRIBE when we have no view yet (leader always answers with a snapshot)
+NO_VERSION = 0xFFFFFFFF
+# Max number of buffered out-of-order deltas, then the monitor asks for a snapshot
+MAX_EARLY_DELTAS = 32
 
 
 #################################################################################
 # MonitorNode
 #################################################################################
 class MonitorNode:
-    def __init__(self):
-        self.my_ip = None
-        self.node_dict = SortedDict()
+    def __init__(self, my_ip=None):
+        # If not given, our IP is looked up when it is first needed
+        self.my_ip = my_ip
+        # Leader's view - nodes sorted by IP converted by ip_tools.ip_to_long() with their colors
+        self.nodes = NodeRegistry()
+        # Leader we are subscribed to, version of our view and when the leader was last heard (monotonic ns)
+        self.leader = None
+        self.version = NO_VERSION
+        self.last_heard = None
+        # Deltas which arrived before the delta they follow (base version -> delta)
+        self.early_deltas = {}
+        # Pages of snapshots ((leader IP, version)) and deltas ((base version, version)) received so far
+        self.snapshot_pages = PageAssembler(2)
+        self.delta_pages = PageAssembler(MAX_EARLY_DELTAS)
+        # Metrics snapshots received since the last metrics request (node IP -> snapshot)
+        self.node_metrics = {}
+        # Result of the last completed metrics round - aggregate and per-node snapshots
+        self.cluster_metrics = None
+        self.last_round_metrics = {}
+        self.last_metrics_poll = None
+        # The monitor handles only its own message types, the UDP server drops all other traffic of the cluster
+        self.dispatcher = MsgDispatcher((OperationMode.MONITOR,), self.resolve_my_ip)
+        self.dispatcher.register(MsgType.MONITOR_SNAPSHOT, self.got_monitor_snapshot)
+        self.dispatcher.register(MsgType.MONITOR_DELTA, self.got_monitor_delta)
+        self.dispatcher.register(MsgType.METRICS_RESPONSE, self.got_metrics_response)
+        self.dispatcher.set_mode(OperationMode.MONITOR)
 
-    def process_msg(self, sender_addr, msg):
-        sender_ip = sender_addr[0]
-        ### Get our IP (and ignore messages from same IP)
+    def resolve_my_ip(self):
         if self.my_ip is None:
             self.my_ip = ip_tools.get_ip(config.IP_PREFIX)
-        if sender_ip == self.my_ip:
-            return
-        #################################################
-        msg_code, data = decode_msg(msg)
-        msg_code = int(msg_code)
-        ##############################################
+        return self.my_ip
+
+    def accepted_types(self):
+        """
+        :return: Message type codes the monitor handles (see UDPServer.set_processing_func())
+        """
+        return self.dispatcher.handled_types()
 
-        if msg_code == MsgType.MONITOR_COLOR_RESPONSE.value:
-            self.node_dict[sender_ip] = NodeColor(data).name
-            print(self.node_dict)
+    def process_msg(self, sender_addr, msg, parsed=None):
+        self.dispatcher.process_msg(sender_addr, msg, parsed)
+
+    def got_monitor_snapshot(self, sender_ip, data):
+        if self.leader is None or sender_ip == self.leader or ip_tools.is_higher_ip(sender_ip, self.leader):
+            version, page, pages, items = data
+            nodes = self.snapshot_pages.add((sender_ip, version), page, pages, items)
+            if nodes is not None:
+                self.got_snapshot(sender_ip, (version, nodes))
+
+    def got_monitor_delta(self, sender_ip, data):
+        if sender_ip == self.leader:
+            base_version, version, page, pages, items = data
+            changes = self.delta_pages.add((base_version, version), page, pages, items)
+            if changes is not None:
+                self.got_delta((base_version, version, changes))
+
+    def got_metrics_response(self, sender_ip, data):
+        self.node_metrics[sender_ip] = data
 
     async def timer_task(self):
         while True:
-            send_monitor_color_request_broadcast()
-            await asyncio.sleep(config.MONITOR_COLOR_POLL_RATE)
+            self.subscribe()
+            now = clock.now_ns()
+            if self.last_metrics_poll is None or now - self.last_metrics_poll >= config.MONITOR_METRICS_POLL_RATE * 1e9:
+                self.last_metrics_poll = now
+                self.collect_metrics()
+            await clock.sleep(config.MONITOR_COLOR_POLL_RATE)
+
+    def subscribe(self):
+        """
+        Renews the subscription at our leader, looks for a leader (broadcast) if it doesn't answer
+        """
+        if self.leader is not None and clock.now_ns() - self.last_heard < config.MONITOR_SUBSCRIPTION_TIMEOUT * 1e9:
+            send_monitor_subscribe_unicast(self.leader, self.version)
+        else:
+            if self.leader is not None:
+                log.info(_logger, "leader_lost", leader=self.leader)
+            self.leader = None
+            self.version = NO_VERSION
+            self.early_deltas.clear()
+            self.delta_pages.clear()
+            send_monitor_subscribe_broadcast(NO_VERSION)
+
+    def got_snapshot(self, leader_ip, snapshot):
+        version, nodes = snapshot
+        self.leader = leader_ip
+        self.version = version
+        self.last_heard = clock.now_ns()
+        self.early_deltas.clear()
+        self.delta_pages.clear()
+        self.nodes = NodeRegistry.from_colors(nodes)
+        log.info(_logger, "snapshot", leader=leader_ip, version=version)
+        self.log_summary()
+
+    def got_delta(self, delta):
+        base_version, version, changes = delta
+        self.last_heard = clock.now_ns()
+        if base_version != self.version:
+            if version != self.version and self.version != NO_VERSION:
+                # Delta overtook an earlier one (or the earlier one was lost - then the next subscription
+                # renewal gets a snapshot, because our version is not current)
+                self.early_deltas[base_version] = delta
+                if len(self.early_deltas) > MAX_EARLY_DELTAS:
+                    self.early_deltas.clear()
+                    send_monitor_subscribe_unicast(self.leader, self.version)
+            return
+        self.apply_delta(version, changes)
+        while self.version in self.early_deltas:
+            _, version, changes = self.early_deltas.pop(self.version)
+            self.apply_delta(version, changes)
+
+    def apply_delta(self, version, changes):
+        self.version = version
+        for node_id, color in changes:
+            index = self.nodes.find(node_id)
+            if color == 0:
+                if index is not None:
+                    del self.nodes[node_id]
+                    log.info(_logger, "removed", ip=ip_tools.long_to_ip(node_id), nodes=len(self.nodes))
+            else:
+                # Only changes are logged, not the whole table
+                if index is None:
+                    self.nodes.add(node_id, NodeColor(color), 0)
+                else:
+                    self.nodes.colors[index] = color
+                log.info(_logger, "color", ip=ip_tools.long_to_ip(node_id), color=NodeColor(color).name,
+                         nodes=len(self.nodes))
+
+    def log_summary(self):
+        counts = {NodeColor(color).name: count for color, count in sorted(self.nodes.color_counts().items())}
+        log.info(_logger, "summary", nodes=len(self.nodes), colors=counts)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("table", extra={"table": [(ip_tools.long_to_ip(key), NodeColor(color).name)
+                                                    for key, color in self.nodes.color_items()]})
+
+    def collect_metrics(self):
+        """
+        Aggregates answers to the previous metrics request and sends a new one
+        """
+        if self.node_metrics:
+            self.last_round_metrics = self.node_metrics
+            self.cluster_metrics = metrics.merge_snapshots(self.node_metrics.values())
+            self.node_metrics = {}
+            self.log_metrics()
+        send_metrics_request_broadcast()
+
+    def log_metrics(self):
+        histograms = {name: metrics.Histogram.from_snapshot(data)
+                      for name, data in self.cluster_metrics["hist"].items()}
+        handler = metrics.Histogram()
+        for name, histogram in histograms.items():
+            if name.startswith("handler_ns"):
+                handler.merge(histogram)
+        rtt = histograms.get("keepalive_rtt_us", metrics.Histogram())
+        log.info(_logger, "metrics", nodes=len(self.last_round_metrics),
+                 received=sum(self.cluster_metrics["recv"].values()), sent=sum(self.cluster_metrics["sent"].values()),
+                 handler_p99_ns=handler.percentile(0.99), keepalive_rtt_p99_us=rtt.percentile(0.99),
+                 elections=self.cluster_metrics["counters"].get("elections", 0),
+                 recolors=self.cluster_metrics["counters"].get("recolors", 0))
+
+    def render_metrics(self):
+        """
+        Text of the local metrics endpoint - cluster aggregate followed by every node
+        """
+        if self.cluster_metrics is None:
+            return ""
+        parts = [metrics.render_text(self.cluster_metrics, 'node="cluster"')]
+        for node_ip in sorted(self.last_round_metrics, key=ip_tools.ip_to_long):
+            parts.append(metrics.render_text(self.last_round_metrics[node_ip], f'node="{node_ip}"'))
+        return "".join(parts)
@@ -0,0 +1,189 @@
+import bisect
+from array import array
+
+from src.nodes.node_types import NodeColor
+from src.utils import ip_tools
+
+
+#################################################################################
+# NodeView
+#################################################################################
+
+class NodeView:
+    __slots__ = ("registry", "node_id")
+
+    def __init__(self, registry, node_id):
+        """
+        Access to one node of a NodeRegistry - holds only the node id, the fields live in the registry's columns
+        """
+        self.registry = registry
+        self.node_id = node_id
+
+    @property
+    def ip(self):
+        return ip_tools.long_to_ip(self.node_id)
+
+    @property
+    def color(self):
+        return NodeColor(self.registry.colors[self.registry.index(self.node_id)])
+
+    @color.setter
+    def color(self, color):
+        self.registry.colors[self.registry.index(self.node_id)] = color.value
+
+    @property
+    def last_seen(self):
+        return self.registry.last_seen[self.registry.index(self.node_id)]
+
+    @last_seen.setter
+    def last_seen(self, last_seen):
+        self.registry.last_seen[self.registry.index(self.node_id)] = last_seen
+
+    @property
+    def epoch(self):
+        return self.registry.epochs[self.registry.index(self.node_id)]
+
+    @epoch.setter
+    def epoch(self, epoch):
+        self.registry.epochs[self.registry.index(self.node_id)] = epoch
+
+    def __repr__(self):
+        return f"NodeView({self.ip}, {self.last_seen}, {self.color})"
+
+
+#################################################################################
+# NodeRegistry
+#################################################################################
+
+class NodeRegistry:
+    def __init__(self):
+        """
+        Table of nodes stored by columns - parallel arrays sorted by node id (IP converted
+        by ip_tools.ip_to_long()), so position of a node is its rank. 17 bytes per node, no per-node objects.
+        Lookup is a binary search, insert and delete move the tail of every column (memmove).
+        Reads the same as a SortedDict node_id -> NodeView (get, rank, peekitem, items, ...).
+        """
+        self.ids = array("I")
+        # Color value (NodeColor) of every node
+        self.colors = array("B")
+        # Monotonic ns of the last keepalive
+        self.last_seen = array("q")
+        # Leader's epoch in which the node got its current color
+        self.epochs = array("I")
+
+    @classmethod
+    def from_colors(cls, nodes):
+        """
+        Builds the registry at once (the columns are filled in order, no inserts)
+        :param nodes: Iterable of (node id, color value)
+        """
+        registry = cls()
+        nodes = sorted(nodes)
+        registry.ids = array("I", (node_id for node_id, _ in nodes))
+        registry.colors = array("B", (color for _, color in nodes))
+        registry.last_seen = array("q", bytes(8 * len(nodes)))
+        registry.epochs = array("I", bytes(4 * len(nodes)))
+        return registry
+
+    def index(self, node_id):
+        """
+        :return: Position of the node in the columns (KeyError if it isn't in the table)
+        """
+        index = bisect.bisect_left(self.ids, node_id)
+        if index == len(self.ids) or self.ids[index] != node_id:
+            raise KeyError(node_id)
+        return index
+
+    def find(self, node_id):
+        """
+        :return: Position of the node in the columns, None if it isn't in the table
+        """
+        index = bisect.bisect_left(self.ids, node_id)
+        if index == len(self.ids) or self.ids[index] != node_id:
+            return None
+        return index
+
+    def add(self, node_id, color, last_seen, epoch=0):
+        """
+        Inserts a new node
+        :param color: NodeColor
+        :return: NodeView of the node
+        """
+        index = bisect.bisect_left(self.ids, node_id)
+        if index < len(self.ids) and self.ids[index] == node_id:
+            raise KeyError(f"Node {node_id} is already in the table")
+        self.ids.insert(index, node_id)
+        self.colors.insert(index, color.value)
+        self.last_seen.insert(index, last_seen)
+        self.epochs.insert(index, epoch)
+        return NodeView(self, node_id)
+
+    def __delitem__(self, node_id):
+        index = self.index(node_id)
+        del self.ids[index]
+        del self.colors[index]
+        del self.last_seen[index]
+        del self.epochs[index]
+
+    def __getitem__(self, node_id):
+        self.index(node_id)
+        return NodeView(self, node_id)
+
+    def get(self, node_id, default=None):
+        return default if self.find(node_id) is None else NodeView(self, node_id)
+
+    def __contains__(self, node_id):
+        return self.find(node_id) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rank(self, node_id):
+        """
+        Returns the number of nodes with lower id (position of the node if it exists)
+        """
+        return bisect.bisect_left(self.ids, node_id)
+
+    def select(self, index):
+        """
+        Returns id of the node at given position (negative indexes count from the end)
+        """
+        return self.ids[index]
+
+    def peekitem(self, index):
+        """
+        Returns (node id, NodeView) of the node at given position
+        """
+        node_id = self.ids[index]
+        return node_id, NodeView(self, node_id)
+
+    def keys(self):
+        """
+        Node ids in sorted order - iterates over a copy, so nodes may be added and removed meanwhile
+        """
+        return iter(self.ids[:])
+
+    def __iter__(self):
+        return self.keys()
+
+    def values(self):
+        return (NodeView(self, node_id) for node_id in self.ids[:])
+
+    def items(self):
+        return ((node_id, NodeView(self, node_id)) for node_id in self.ids[:])
+
+    def color_items(self):
+        """
+        :return: List of (node id, color value) of all nodes (snapshots sent to monitors and the standby)
+        """
+        return list(zip(self.ids, self.colors))
+
+    def color_counts(self):
+        """
+        :return: Number of nodes of every color value
+        """
+        colors = self.colors.tobytes()
+        return {color: colors.count(color) for color in set(colors)}
+
+    def __repr__(self):
+        return f"NodeRegistry({[(ip_tools.long_to_ip(node_id), color) for node_id, color in self.color_items()]})"
@@ -1,6 +1,9 @@
-import time
 from src import config
-from src.utils.protocol_msgs import send_keepalive_unicast
+from src.utils import clock, log, metrics
+from src.utils.FailureDetector import create_detector
+from src.utils.protocol_msgs import forget_peer, send_keepalive_unicast, send_state_request_unicast
+
+_logger = log.get_logger("slave")
 
 
 #################################################################################
@@ -10,26 +13,115 @@ class SlaveMode:
     def __init__(self):
         self.leader = None
         self.last_keepalive_from_leader = None
+        # Leader is considered dead after this time (monotonic ns) given by the failure detector
+        self.detector = create_detector(config.LEADER_DEAD_AFTER)
+        self.leader_deadline = None
+        # When our last keepalive was sent (for the round-trip time of leader's reply)
+        self.keepalive_sent = None
+        # Leader's epoch and digest this node's state corresponds to
+        self.synced_epoch = None
+        self.synced_digest = None
+        # Sequence number of the last color command applied (commands of one leader are applied in order) and the
+        # leader's incarnation it belongs to
+        self.last_command_seq = None
+        self.leader_incarnation = None
 
     def got_keepalive_from_leader(self):
-        self.last_keepalive_from_leader = time.time_ns()
+        self.last_keepalive_from_leader = clock.now_ns()
+        if self.leader is not None:
+            self.leader_deadline = self.detector.heartbeat(self.leader, self.last_keepalive_from_leader)
+        if self.keepalive_sent is not None:
+            metrics.registry.record("keepalive_rtt_us", (self.last_keepalive_from_leader - self.keepalive_sent) // 1000)
+            self.keepalive_sent = None
+
+    def got_heartbeat_from_leader(self, my_id, my_color, heartbeat):
+        """
+        :return: Color value assigned to this node by the heartbeat (None if it doesn't carry one)
+        """
+        epoch, digest, base_epoch, changes = heartbeat
+        self.got_keepalive_from_leader()
+        if digest == self.synced_digest:
+            self.synced_epoch = epoch
+            return None
+        if base_epoch == self.synced_epoch and base_epoch != epoch:
+            # Heartbeat carries all changes since our epoch
+            self.synced_epoch = epoch
+            self.synced_digest = digest
+            for node_id, color in changes:
+                if node_id == my_id:
+                    return color
+            return None
+        # We have missed some changes
+        send_state_request_unicast(self.leader, my_color)
+        return None
+
+    def got_state_response(self, state):
+        """
+        :return: Color value assigned to this node
+        """
+        self.synced_epoch, self.synced_digest, color = state
+        return color
+
+    def accept_command(self, seq, incarnation):
+        """
+        :param incarnation: Leader's incarnation sent with the command (None from older leaders)
+        :return: True if the color command is newer than the last one applied (not a retransmission or reordered)
+        """
+        if incarnation != self.leader_incarnation:
+            # Leader restarted with the same IP - its sequence starts again
+            self.leader_incarnation = incarnation
+            self.last_command_seq = None
+        if self.last_command_seq is not None and seq <= self.last_command_seq:
+            return False
+        self.last_command_seq = seq
+        return True
 
     def keepalive_to_leader(self, my_color):
-        current_timestamp = time.time_ns()
-        if self.last_keepalive_from_leader is not None:
-            if current_timestamp - self.last_keepalive_from_leader > config.LEADER_DEAD_AFTER:
-                # Leader is dead
-                print(current_timestamp - self.last_keepalive_from_leader, ">", config.LEADER_DEAD_AFTER)
-                print("My leader is dead")
-                self.clear_leader()
-                return
+        current_timestamp = clock.now_ns()
+        if self.leader_deadline is not None and current_timestamp > self.leader_deadline:
+            # Leader is dead
+            log.info(_logger, "leader_dead", leader=self.leader,
+                     silent_ns=current_timestamp - self.last_keepalive_from_leader,
+                     phi=round(self.detector.phi(self.leader, current_timestamp), 2))
+            forget_peer(self.leader)
+            self.clear_leader()
+            return
 
+        self.keepalive_sent = current_timestamp
         send_keepalive_unicast(self.leader, my_color)
 
+    def leader_confirmed_recently(self):
+        """
+        Leader has announced itself (VICTORY, LEADER RESPONSE, keepalive) within the last election timeout
+        """
+        return (self.last_keepalive_from_leader is not None
+                and clock.now_ns() - self.last_keepalive_from_leader < config.ELECTION_TIMEOUT * 1e9)
+
     def clear_leader(self):
+        if self.leader is not None:
+            self.detector.remove(self.leader)
         self.leader = None
         self.last_keepalive_from_leader = None
+        self.leader_deadline = None
+        self.keepalive_sent = None
+        self.synced_epoch = None
+        self.synced_digest = None
+        self.last_command_seq = None
+        self.leader_incarnation = None
 
     def set_leader(self, leader_id):
+        if leader_id != self.leader:
+            if self.leader is not None:
+                self.detector.remove(self.leader)
+            # Statistics of the new leader start with its announcement
+            self.leader_deadline = self.detector.heartbeat(leader_id, clock.now_ns())
+            # Commands of the new leader have their own sequence
+            self.last_command_seq = None
+            self.leader_incarnation = None
+        elif self.leader_incarnation is None:
+            # Repeated announcement of a leader which sends no incarnation (older version) - it may have restarted
+            self.last_command_seq = None
         self.leader = leader_id
-        self.last_keepalive_from_leader = time.time_ns()
+        self.last_keepalive_from_leader = clock.now_ns()
+        self.synced_epoch = None
+        self.synced_digest = None
@@ -0,0 +1,262 @@
+import math
+import random
+from enum import Enum
+
+from src import config
+from src.utils import clock, ip_tools
+from src.utils.protocol_msgs import MsgType, send_swim_ping_broadcast, send_swim_ping_unicast, \
+    send_swim_ping_req_unicast, send_swim_ack_unicast
+
+
+#################################################################################
+# TYPES
+#################################################################################
+
+class MemberState(Enum):
+    ALIVE = 1
+    SUSPECT = 2
+    DEAD = 3
+
+
+class Member:
+    __slots__ = ("ip", "state", "incarnation", "suspect_deadline")
+
+    def __init__(self, ip, state, incarnation):
+        self.ip = ip
+        self.state = state
+        self.incarnation = incarnation
+        self.suspect_deadline = None
+
+    def __repr__(self):
+        return f"Member({self.ip}, {self.state.name}, {self.incarnation})"
+
+
+class Probe:
+    __slots__ = ("target", "seq", "acked")
+
+    def __init__(self, target, seq):
+        self.target = target
+        self.seq = seq
+        self.acked = False
+
+
+#################################################################################
+# SwimMembership
+#################################################################################
+
+class SwimMembership:
+    def __init__(self, on_join, on_leave):
+        """
+        SWIM membership engine - every protocol period one random member is pinged directly, if it doesn't answer,
+        k other members ping it on our behalf (ping-req). Members which don't answer are suspected, suspects which
+        don't refute are declared dead. Membership changes are piggybacked on the protocol messages, so the load
+        of every node is constant regardless of cluster size.
+        :param on_join: Called with IP of a member which became alive
+        :param on_leave: Called with IP of a member which was declared dead
+        """
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self.random = random.Random()
+        self.my_ip = None
+        self.my_id = None
+        self.incarnation = 0
+        # IP -> Member (dead members are kept, so old rumors about them are ignored)
+        self.members = {}
+        # Alive and suspect members (for random selection) and their positions in the list
+        self.live_list = []
+        self.live_index = {}
+        self.probe_order = []
+        self.probe = None
+        self.seq = 0
+        # Our ping seq -> (requester IP, requester's seq) for pings sent on behalf of other members
+        self.relays = {}
+        # Rumors to piggyback - IP -> [state, incarnation, remaining transmissions]
+        self.updates = {}
+        self.timer = None
+
+    def start(self, my_ip):
+        if self.timer is not None:
+            return
+        self.my_ip = my_ip
+        self.my_id = ip_tools.ip_to_long(my_ip)
+        self.timer = clock.call_later(0, self.protocol_period)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def alive_members(self):
+        return list(self.live_list)
+
+    def is_alive(self, ip):
+        return ip in self.live_index
+
+    #################################################################################
+    # Protocol period
+    #################################################################################
+
+    def protocol_period(self):
+        self.timer = clock.call_later(config.SWIM_PROTOCOL_PERIOD, self.protocol_period)
+        self.expire_suspects()
+        self.relays.clear()
+
+        if not self.live_list:
+            # We don't know anybody yet, everybody who hears this ping answers and learns about us
+            send_swim_ping_broadcast(self.make_payload(0, 0))
+            return
+
+        target = self.next_probe_target()
+        self.probe = Probe(target, self.next_seq())
+        send_swim_ping_unicast(target, self.make_payload(self.probe.seq, ip_tools.ip_to_long(target)))
+        clock.call_later(config.SWIM_ACK_TIMEOUT, self.probe_timeout, self.probe)
+
+    def next_probe_target(self):
+        # Randomized round-robin - every member is probed once per len(live_list) periods
+        while True:
+            if not self.probe_order:
+                self.probe_order = list(self.live_list)
+                self.random.shuffle(self.probe_order)
+            target = self.probe_order.pop()
+            if target in self.live_index:
+                return target
+
+    def probe_timeout(self, probe):
+        if probe.acked or probe is not self.probe:
+            return
+        helpers = [ip for ip in self.random.sample(self.live_list, min(len(self.live_list),
+                                                                        config.SWIM_INDIRECT_PROBES + 1))
+                   if ip != probe.target][:config.SWIM_INDIRECT_PROBES]
+        for helper in helpers:
+            send_swim_ping_req_unicast(helper, self.make_payload(probe.seq, ip_tools.ip_to_long(probe.target)))
+        clock.call_later(config.SWIM_PROTOCOL_PERIOD - config.SWIM_ACK_TIMEOUT, self.probe_failed, probe)
+
+    def probe_failed(self, probe):
+        if probe.acked:
+            return
+        member = self.members.get(probe.target)
+        if member is not None and member.state == MemberState.ALIVE:
+            self.apply_update(probe.target, MemberState.SUSPECT, member.incarnation)
+
+    def expire_suspects(self):
+        now = clock.now_ns()
+        for ip in list(self.live_list):
+            member = self.members[ip]
+            if member.state == MemberState.SUSPECT and member.suspect_deadline <= now:
+                self.apply_update(ip, MemberState.DEAD, member.incarnation)
+
+    #################################################################################
+    # Messages
+    #################################################################################
+
+    def heard_from(self, ip):
+        """
+        Any protocol message (SWIM or the cluster's own, not monitoring traffic) from an unknown node means it is alive
+        """
+        member = self.members.get(ip)
+        if member is None:
+            self.apply_update(ip, MemberState.ALIVE, 0)
+        elif member.state == MemberState.DEAD and ip not in self.updates:
+            # Node we consider dead is still talking, spread the rumor again so it can refute it
+            self.gossip(ip, MemberState.DEAD, member.incarnation)
+
+    def process_msg(self, msg_code, sender_ip, data):
+        if self.my_ip is None:
+            # Not started yet
+            return
+        seq, target_id, updates = data
+        self.heard_from(sender_ip)
+        for node_id, state, incarnation in updates:
+            self.apply_update(ip_tools.long_to_ip(node_id), MemberState(state), incarnation)
+
+        if msg_code == MsgType.SWIM_PING.value:
+            send_swim_ack_unicast(sender_ip, self.make_payload(seq, self.my_id))
+
+        elif msg_code == MsgType.SWIM_PING_REQ.value:
+            relay_seq = self.next_seq()
+            self.relays[relay_seq] = (sender_ip, seq)
+            send_swim_ping_unicast(ip_tools.long_to_ip(target_id), self.make_payload(relay_seq, target_id))
+
+        elif msg_code == MsgType.SWIM_ACK.value:
+            probe = self.probe
+            if probe is not None and probe.seq == seq:
+                probe.acked = True
+            relay = self.relays.pop(seq, None)
+            if relay is not None:
+                send_swim_ack_unicast(relay[0], self.make_payload(relay[1], target_id))
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return self.seq
+
+    def make_payload(self, seq, target_id):
+        """
+        Protocol message payload with piggybacked rumors (the ones sent the fewest times go first)
+        """
+        rumors = sorted(self.updates.items(), key=lambda item: -item[1][2])[:config.SWIM_PIGGYBACK_MAX]
+        piggyback = []
+        for ip, rumor in rumors:
+            piggyback.append((ip_tools.ip_to_long(ip), rumor[0].value, rumor[1]))
+            rumor[2] -= 1
+            if rumor[2] <= 0:
+                del self.updates[ip]
+        return seq, target_id, piggyback
+
+    #################################################################################
+    # Membership updates
+    #################################################################################
+
+    def apply_update(self, ip, state, incarnation):
+        if ip == self.my_ip:
+            if state != MemberState.ALIVE and incarnation >= self.incarnation:
+                # Refute the rumor about us
+                self.incarnation = incarnation + 1
+                self.gossip(ip, MemberState.ALIVE, self.incarnation)
+            return
+
+        member = self.members.get(ip)
+        if member is None:
+            if state == MemberState.DEAD:
+                return
+            member = Member(ip, MemberState.DEAD, incarnation)
+            self.members[ip] = member
+            self.set_state(member, state, incarnation)
+            return
+
+        if state == MemberState.ALIVE:
+            accept = incarnation > member.incarnation
+        elif state == MemberState.SUSPECT:
+            accept = (member.state == MemberState.ALIVE and incarnation >= member.incarnation) or \
+                     (member.state == MemberState.SUSPECT and incarnation > member.incarnation)
+        else:
+            accept = member.state != MemberState.DEAD
+        if accept:
+            self.set_state(member, state, incarnation)
+
+    def set_state(self, member, state, incarnation):
+        was_live = member.state != MemberState.DEAD
+        member.state = state
+        member.incarnation = incarnation
+        if state == MemberState.SUSPECT:
+            member.suspect_deadline = clock.now_ns() + int(config.SWIM_SUSPECT_PERIODS * config.SWIM_PROTOCOL_PERIOD * 1e9)
+        self.gossip(member.ip, state, incarnation)
+
+        if state == MemberState.DEAD and was_live:
+            self.remove_live(member.ip)
+            self.on_leave(member.ip)
+        elif state != MemberState.DEAD and not was_live:
+            self.live_index[member.ip] = len(self.live_list)
+            self.live_list.append(member.ip)
+            self.on_join(member.ip)
+
+    def remove_live(self, ip):
+        # Swap with the last item, O(1)
+        index = self.live_index.pop(ip)
+        last = self.live_list.pop()
+        if last != ip:
+            self.live_list[index] = last
+            self.live_index[last] = index
+
+    def gossip(self, ip, state, incarnation):
+        transmissions = max(1, math.ceil(config.SWIM_RETRANSMIT_MULT * math.log2(len(self.live_list) + 2)))
+        self.updates[ip] = [state, incarnation, transmissions]
@@ -0,0 +1,20 @@
+from enum import Enum
+
+
+#################################################################################
+# TYPES
+#################################################################################
+
+class NodeColor(Enum):
+    INIT = 1
+    RED = 2
+    GREEN = 3
+    # Used only if configured in config.COLOR_RATIOS
+    BLUE = 4
+    YELLOW = 5
+
+
+class OperationMode(Enum):
+    SLAVE = 1
+    LEADER = 2
+    MONITOR = 3  # Only MonitorNode
@@ -0,0 +1,226 @@
+import random
+
+from src.nodes.BaseNode import BaseNode
+from src.nodes.node_types import NodeColor, OperationMode
+from src.nodes.ColoringPolicy import color_targets
+from src.nodes.MonitorNode import MonitorNode
+from src.sim.SimNetwork import SimNetwork, SimSender
+from src.sim.VirtualClock import VirtualClock
+from src.utils import clock, groups, ip_tools, metrics, protocol_msgs
+
+
+#################################################################################
+# TYPES
+#################################################################################
+
+class SimNode:
+    def __init__(self, sim, ip, node_class=BaseNode):
+        """
+        One simulated node (BaseNode or MonitorNode) with its own wire state, sender and metrics
+        """
+        self.sim = sim
+        self.ip = ip
+        self.alive = True
+        self.wire = protocol_msgs.WireState()
+        self.sender = SimSender(sim.network, self)
+        self.metrics = metrics.Metrics()
+        self.activate()
+        self.node = node_class(ip)
+        if getattr(self.node, "membership", None) is not None:
+            self.node.membership.random.seed(sim.rng.random())
+
+    def activate(self):
+        protocol_msgs.wire = self.wire
+        protocol_msgs.sender = self.sender
+        metrics.registry = self.metrics
+
+    def deliver(self, sender_addr, payload):
+        self.node.process_msg(sender_addr, payload)
+
+
+#################################################################################
+# ClusterSimulator
+#################################################################################
+
+class ClusterSimulator:
+    def __init__(self, node_count, seed=0, latency=0.0005, jitter=0.0005, loss=0.0, first_ip="10.0.0.1"):
+        """
+        Runs node_count BaseNodes in one process on virtual time and a simulated lossy network.
+        Installs its own clock into src.utils.clock, so only one simulator can run at a time.
+        In the hierarchical mode (config.HIERARCHY_GROUPS) nodes are spread evenly over the groups' networks.
+        """
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        clock.install(self.clock.now_ns, self.clock.call_later, self.clock.call_soon, self.clock.sleep)
+        self.network = SimNetwork(self.clock, self.rng, latency, jitter, loss)
+        self.nodes = {}
+        self.monitors = {}
+        # Killed nodes (their metrics still count)
+        self.killed = []
+        first = ip_tools.ip_to_long(first_ip)
+        networks = groups.networks()
+        for i in range(node_count):
+            if networks:
+                network = networks[i % len(networks)]
+                self.add_node(str(network.network_address + i // len(networks) + 1))
+            else:
+                self.add_node(ip_tools.long_to_ip(first + i))
+
+    def add_node(self, ip):
+        sim_node = SimNode(self, ip)
+        self.nodes[ip] = sim_node
+        self.network.attach(sim_node)
+        return sim_node
+
+    def add_monitor(self, ip="10.255.255.254"):
+        sim_node = SimNode(self, ip, MonitorNode)
+        self.monitors[ip] = sim_node
+        self.network.attach(sim_node)
+        return sim_node
+
+    def start(self, spread=1.0):
+        """
+        Starts timer tasks of all nodes at random moments within spread seconds
+        """
+        for sim_node in list(self.nodes.values()) + list(self.monitors.values()):
+            self.clock.schedule(sim_node, self.rng.uniform(0, spread), self.start_node, sim_node)
+
+    def start_node(self, sim_node):
+        self.clock.start_task(sim_node, sim_node.node.timer_task())
+
+    def kill(self, ip):
+        sim_node = self.nodes.pop(ip)
+        sim_node.alive = False
+        self.killed.append(sim_node)
+        self.network.detach(sim_node)
+
+    def now(self):
+        return self.clock.now / 1e9
+
+    def run(self, seconds):
+        self.clock.run_until(self.clock.now + int(seconds * 1e9))
+
+    def run_until(self, predicate, timeout, step=0.05):
+        """
+        Runs until predicate() holds (checked every step seconds)
+        :return: Simulated seconds it took, None on timeout
+        """
+        start = self.clock.now
+        while self.clock.now - start < timeout * 1e9:
+            self.run(step)
+            if predicate():
+                return (self.clock.now - start) / 1e9
+        return None
+
+    #################################################################################
+    # Cluster state
+    #################################################################################
+
+    def leaders(self, nodes=None):
+        """
+        :param nodes: IP -> SimNode (one group), all nodes if not given
+        """
+        nodes = self.nodes if nodes is None else nodes
+        return [ip for ip, sim_node in nodes.items() if sim_node.node.operation_mode == OperationMode.LEADER]
+
+    def leader_agreed(self, nodes=None):
+        """
+        Exactly one leader and every slave follows it
+        """
+        nodes = self.nodes if nodes is None else nodes
+        leaders = self.leaders(nodes)
+        if len(leaders) != 1:
+            return False
+        return all(sim_node.node.slave_mode.leader == leaders[0]
+                   for ip, sim_node in nodes.items() if ip != leaders[0])
+
+    def colors_converged(self, nodes=None):
+        """
+        Leader is RED, its table holds exactly the living slaves, meets the coloring policy's targets
+        (config.COLORING_POLICY) and every slave has the color from the table
+        """
+        nodes = self.nodes if nodes is None else nodes
+        if not self.leader_agreed(nodes):
+            return False
+        leader = self.leaders(nodes)[0]
+        leader_mode = self.nodes[leader].node.leader_mode
+        if self.nodes[leader].node.my_color != NodeColor.RED or leader_mode.pending_colors:
+            return False
+        table = leader_mode.nodes_table
+        if len(table) != len(nodes) - 1 or not leader_mode.coloring.balanced():
+            return False
+        for ip, sim_node in nodes.items():
+            if ip == leader:
+                continue
+            data = table.get(ip_tools.ip_to_long(ip))
+            if data is None or sim_node.node.my_color != data.color:
+                return False
+        return True
+
+    def groups(self):
+        """
+        :return: Group index -> {IP: SimNode} of the living nodes (hierarchical mode)
+        """
+        result = {}
+        for ip, sim_node in self.nodes.items():
+            result.setdefault(groups.group_of(ip), {})[ip] = sim_node
+        return result
+
+    def top_leader(self):
+        """
+        :return: Highest group leader, None if some group has no agreed leader
+        """
+        group_leaders = []
+        for nodes in self.groups().values():
+            if not self.leader_agreed(nodes):
+                return None
+            group_leaders.append(self.leaders(nodes)[0])
+        return max(group_leaders, key=ip_tools.ip_to_long, default=None)
+
+    def hierarchy_converged(self):
+        """
+        Colors of every group converged (see colors_converged()), all group leaders follow the top leader
+        (the highest of them) and every group has its share of the global RED target (config.COLOR_RATIOS)
+        """
+        node_groups = self.groups()
+        if not all(self.colors_converged(nodes) for nodes in node_groups.values()):
+            return False
+        top = self.top_leader()
+        if any(self.nodes[self.leaders(nodes)[0]].node.tier.top != top for nodes in node_groups.values()):
+            return False
+        sizes = {index: len(nodes) for index, nodes in node_groups.items()}
+        quotas = groups.split_quota(color_targets(len(self.nodes))[0], sizes)
+        return all(sum(sim_node.node.my_color == NodeColor.RED for sim_node in nodes.values()) == quotas[index]
+                   for index, nodes in node_groups.items())
+
+    def color_counts(self):
+        """
+        :return: Color name -> number of living nodes
+        """
+        counts = {}
+        for sim_node in self.nodes.values():
+            counts[sim_node.node.my_color.name] = counts.get(sim_node.node.my_color.name, 0) + 1
+        return counts
+
+    def leader_table(self):
+        leaders = self.leaders()
+        if len(leaders) != 1:
+            return None
+        return self.nodes[leaders[0]].node.leader_mode.nodes_table
+
+    def counter_total(self, name):
+        """
+        Sum of a metrics counter over all nodes (dead ones included)
+        """
+        return sum(sim_node.metrics.counters.get(name, 0) for sim_node in (*self.nodes.values(), *self.killed))
+
+    def monitor_view_matches(self, monitor_ip):
+        """
+        Monitor's view equals the leader's table (plus the RED leader)
+        """
+        table = self.leader_table()
+        if table is None:
+            return False
+        expected = dict(table.color_items())
+        expected[ip_tools.ip_to_long(self.leaders()[0])] = NodeColor.RED.value
+        return dict(self.monitors[monitor_ip].node.nodes.color_items()) == expected
@@ -0,0 +1,77 @@
+from collections import Counter
+
+from src import config
+from src.utils import groups, protocol_msgs
+
+
+class SimSender:
+    def __init__(self, network, node):
+        """
+        Replaces protocol_msgs.sender of a simulated node
+        """
+        self.network = network
+        self.node = node
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    def sendto(self, payload, addr, broadcast=False):
+        self.packets_sent += 1
+        self.bytes_sent += len(payload)
+        self.network.send(self.node, payload, addr, broadcast)
+
+    def stats(self):
+        return {"packets_sent": self.packets_sent, "bytes_sent": self.bytes_sent}
+
+
+class SimNetwork:
+    def __init__(self, clock, rng, latency, jitter, loss):
+        """
+        Simulated network - every datagram is delayed by latency + exponential jitter (seconds)
+        and dropped with probability loss. Broadcast to the broadcast address of a group (config.HIERARCHY_GROUPS)
+        reaches the group's nodes, any other broadcast reaches all nodes.
+        """
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        # IP -> SimNode
+        self.endpoints = {}
+        # Group index -> {IP: SimNode}
+        self.group_endpoints = {}
+        # Counters
+        self.sent_by_type = Counter()
+        self.datagrams_delivered = 0
+        self.datagrams_lost = 0
+
+    def attach(self, node):
+        self.endpoints[node.ip] = node
+        self.group_endpoints.setdefault(groups.group_of(node.ip), {})[node.ip] = node
+
+    def detach(self, node):
+        self.endpoints.pop(node.ip, None)
+        self.group_endpoints.get(groups.group_of(node.ip), {}).pop(node.ip, None)
+
+    def send(self, src, payload, addr, broadcast):
+        self.sent_by_type[protocol_msgs.peek_msg_type(payload)] += 1
+        if broadcast:
+            group = groups.group_of_broadcast(addr[0]) if config.HIERARCHY_GROUPS else None
+            endpoints = self.endpoints if group is None else self.group_endpoints.get(group, {})
+            targets = [node for node in endpoints.values() if node is not src]
+        else:
+            target = self.endpoints.get(addr[0])
+            targets = [] if target is None else [target]
+
+        sender_addr = (src.ip, config.DEFAULT_LISTENING_PORT)
+        for target in targets:
+            if self.loss and self.rng.random() < self.loss:
+                self.datagrams_lost += 1
+                continue
+            delay = self.latency
+            if self.jitter:
+                delay += self.rng.expovariate(1 / self.jitter)
+            self.datagrams_delivered += 1
+            self.clock.schedule(target, delay, target.deliver, sender_addr, payload)
+
+    def sent_of(self, *msg_types):
+        return sum(self.sent_by_type[msg_type.value] for msg_type in msg_types)
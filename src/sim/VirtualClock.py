@@ -0,0 +1,85 @@
+import heapq
+import itertools
+
+
+class SimHandle:
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimSleep:
+    __slots__ = ("delay",)
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def __await__(self):
+        # The task driver (VirtualClock.start_task) receives the delay and resumes the coroutine after it
+        yield self.delay
+
+
+class VirtualClock:
+    def __init__(self):
+        """
+        Simulated time and event queue - callbacks run in the context of the node which scheduled them
+        """
+        self.now = 0
+        self.current = None
+        self.events_processed = 0
+        self._queue = []
+        self._counter = itertools.count()
+
+    def now_ns(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        return self.schedule(self.current, delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.schedule(self.current, 0, callback, *args)
+
+    def sleep(self, delay):
+        return SimSleep(delay)
+
+    def schedule(self, context, delay, callback, *args):
+        """
+        Schedules callback to run in given node context (context.activate() is called before the callback)
+        """
+        handle = SimHandle()
+        when = self.now + max(int(delay * 1e9), 0)
+        heapq.heappush(self._queue, (when, next(self._counter), handle, context, callback, args))
+        return handle
+
+    def start_task(self, context, coro):
+        """
+        Runs a timer task coroutine which awaits clock.sleep()
+        """
+        def step():
+            try:
+                delay = coro.send(None)
+            except StopIteration:
+                return
+            self.schedule(context, delay, step)
+
+        return self.schedule(context, 0, step)
+
+    def run_until(self, until_ns):
+        queue = self._queue
+        while queue and queue[0][0] <= until_ns:
+            when, _, handle, context, callback, args = heapq.heappop(queue)
+            if handle.cancelled:
+                continue
+            self.now = when
+            if context is not None:
+                if not context.alive:
+                    continue
+                context.activate()
+            self.current = context
+            self.events_processed += 1
+            callback(*args)
+        self.now = max(self.now, until_ns)
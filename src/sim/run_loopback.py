@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+from src import config
+from src.nodes.node_types import NodeColor, OperationMode
+from src.nodes.ColoringPolicy import color_targets
+from src.utils import groups
+
+_STATE_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def node_state(ip):
+    """
+    :return: Labels of the dsa_node_state line of the node's metrics endpoint, None if it doesn't answer
+    """
+    try:
+        with socket.create_connection((ip, config.METRICS_PORT), timeout=1.0) as sock:
+            sock.sendall(b"\n")
+            first_line = sock.makefile().readline()
+    except OSError:
+        return None
+    if not first_line.startswith("dsa_node_state"):
+        return None
+    return dict(_STATE_LABEL.findall(first_line))
+
+
+def converged(node_groups):
+    """
+    Every group has one leader followed by its members, all group leaders follow the highest of them (the top leader)
+    and every group has its share of the global RED target
+    :param node_groups: Group index -> {IP: state}
+    """
+    if any(state is None for states in node_groups.values() for state in states.values()):
+        return False
+    leaders = []
+    for states in node_groups.values():
+        group_leaders = [ip for ip, state in states.items() if state["mode"] == OperationMode.LEADER.name]
+        if len(group_leaders) != 1 or any(state["leader"] != group_leaders[0]
+                                          for ip, state in states.items() if ip != group_leaders[0]):
+            return False
+        leaders.append(group_leaders[0])
+    top = max(leaders, key=lambda ip: socket.inet_aton(ip))
+    if any(node_groups[index][ip]["top"] != top for index, ip in enumerate(leaders)):
+        return False
+    sizes = {index: len(states) for index, states in node_groups.items()}
+    quotas = groups.split_quota(color_targets(sum(sizes.values()))[0], sizes)
+    return all(sum(state["color"] == NodeColor.RED.name for state in states.values()) == quotas[index]
+               for index, states in node_groups.items())
+
+
+def poll(node_groups_ips, timeout):
+    """
+    :return: Seconds until the cluster converged (None on timeout) and the last states
+    """
+    start = time.monotonic()
+    while True:
+        states = {index: {ip: node_state(ip) for ip in ips} for index, ips in node_groups_ips.items()}
+        if converged(states):
+            return round(time.monotonic() - start, 1), states
+        if time.monotonic() - start > timeout:
+            return None, states
+        time.sleep(0.5)
+
+
+def summary(states):
+    result = {}
+    for index, group_states in states.items():
+        alive = {ip: state for ip, state in group_states.items() if state is not None}
+        leader = next((ip for ip, state in alive.items() if state["mode"] == OperationMode.LEADER.name), None)
+        result[config.HIERARCHY_GROUPS[index]] = {
+            "leader": leader, "top": alive[leader]["top"] if leader is not None else None,
+            "red": sum(state["color"] == NodeColor.RED.name for state in alive.values()), "nodes": len(alive)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hierarchical cluster of real node processes on loopback addresses")
+    parser.add_argument("--groups", type=int, default=3)
+    parser.add_argument("--nodes", type=int, default=4, help="Nodes per group (max 14)")
+    parser.add_argument("--timeout", type=float, default=90.0, help="Max seconds of one phase")
+    parser.add_argument("--kill-top", action="store_true", help="Kill the top leader after convergence")
+    args = parser.parse_args()
+
+    # Group g is 127.0.<g + 1>.0/28 - loopback has no broadcast, broadcasts are sent to every address of the group
+    config.HIERARCHY_GROUPS = tuple(f"127.0.{index + 1}.0/28" for index in range(args.groups))
+    node_groups_ips = {index: [f"127.0.{index + 1}.{host + 1}" for host in range(min(args.nodes, 14))]
+                       for index in range(args.groups)}
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    processes = {}
+    for ips in node_groups_ips.values():
+        for ip in ips:
+            env = dict(os.environ, NODE_IP=ip, HIERARCHY_GROUPS=",".join(config.HIERARCHY_GROUPS),
+                       LOG_LEVEL="WARNING")
+            processes[ip] = subprocess.Popen([sys.executable, "-m", "src.main"], cwd=root, env=env,
+                                             stdout=subprocess.DEVNULL)
+    report = {"groups": config.HIERARCHY_GROUPS, "nodes": len(processes)}
+    try:
+        report["convergence_s"], states = poll(node_groups_ips, args.timeout)
+        report["cluster"] = summary(states)
+        if args.kill_top and report["convergence_s"] is not None:
+            top = next(iter(report["cluster"].values()))["top"]
+            processes.pop(top).terminate()
+            for ips in node_groups_ips.values():
+                if top in ips:
+                    ips.remove(top)
+            report["killed_top"] = top
+            report["failover_convergence_s"], states = poll(node_groups_ips, args.timeout)
+            report["cluster_after_failover"] = summary(states)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+    print(json.dumps(report, indent=2))
+    if report["convergence_s"] is None or (args.kill_top and report.get("failover_convergence_s") is None):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import contextlib
+import json
+import os
+import time
+
+from src import config
+from src.sim.ClusterSimulator import ClusterSimulator
+from src.utils import ip_tools
+from src.utils.protocol_msgs import MsgType
+
+
+def recolor_messages(sim):
+    return sim.network.sent_of(MsgType.SET_TO_RED, MsgType.SET_TO_GREEN, MsgType.SET_COLOR, MsgType.COLOR_COMMAND)
+
+
+def monitor_messages(sim):
+    return sim.network.sent_of(MsgType.MONITOR_SUBSCRIBE, MsgType.MONITOR_SNAPSHOT, MsgType.MONITOR_DELTA,
+                               MsgType.MONITOR_COLOR_REQUEST, MsgType.MONITOR_COLOR_RESPONSE)
+
+
+def run_scenario(args):
+    """
+    Cold start -> kill some slaves -> kill the leader, measures every phase
+    """
+    sim = ClusterSimulator(args.nodes, seed=args.seed, latency=args.latency, jitter=args.jitter, loss=args.loss)
+    report = {"nodes": args.nodes, "seed": args.seed, "loss": args.loss,
+              "membership_engine": config.MEMBERSHIP_ENGINE, "coloring_policy": config.COLORING_POLICY,
+              "failure_detector": config.FAILURE_DETECTOR}
+    monitor = sim.add_monitor().ip if args.monitor else None
+    cpu_start = time.process_time()
+
+    ### Cold start
+    sim.start(args.spread)
+    report["election_convergence_s"] = sim.run_until(sim.leader_agreed, args.timeout)
+    report["color_convergence_s"] = sim.run_until(sim.colors_converged, args.timeout)
+    if report["color_convergence_s"] is not None:
+        report["color_convergence_s"] += report["election_convergence_s"] or 0
+    report["startup_recolor_msgs"] = recolor_messages(sim)
+    sim.run(args.settle)
+
+    ### Slave failures - how long until the leader drops them
+    leader = sim.leaders()[0] if sim.leader_agreed() else None
+    if leader is not None and args.kill_slaves:
+        slaves = [ip for ip in sim.nodes if ip != leader]
+        victims = sim.rng.sample(slaves, min(args.kill_slaves, len(slaves)))
+        recolor_before = recolor_messages(sim)
+        for ip in victims:
+            sim.kill(ip)
+        victim_ids = [ip_tools.ip_to_long(ip) for ip in victims]
+        report["slave_detection_latency_s"] = sim.run_until(
+            lambda: not any(node_id in sim.leader_table() for node_id in victim_ids), args.timeout)
+        sim.run_until(sim.colors_converged, args.timeout)
+        report["slave_failure_recolor_msgs"] = recolor_messages(sim) - recolor_before
+        sim.run(args.settle)
+
+    ### Leader failure - detection, new election and recoloring
+    if leader is not None:
+        recolor_before = recolor_messages(sim)
+        sim.kill(leader)
+        report["leader_detection_latency_s"] = sim.run_until(
+            lambda: all(n.node.slave_mode.leader != leader for n in sim.nodes.values()), args.timeout)
+        report["failover_convergence_s"] = sim.run_until(sim.leader_agreed, args.timeout)
+        if report["failover_convergence_s"] is not None:
+            report["failover_convergence_s"] += report["leader_detection_latency_s"] or 0
+        report["failover_color_convergence_s"] = sim.run_until(sim.colors_converged, args.timeout)
+        if report["failover_color_convergence_s"] is not None and report["failover_convergence_s"] is not None:
+            report["failover_color_convergence_s"] += report["failover_convergence_s"]
+        report["failover_recolor_msgs"] = recolor_messages(sim) - recolor_before
+
+    if monitor is not None:
+        sim.run(args.settle)
+        report["monitor_view_matches"] = sim.monitor_view_matches(monitor)
+        report["monitor_msgs"] = monitor_messages(sim)
+
+    # Slaves removed by the leader's failure detector - more than the killed slaves means false evictions
+    report["nodes_expired"] = sim.counter_total("nodes_expired")
+    cpu = time.process_time() - cpu_start
+    report["simulated_s"] = round(sim.now(), 3)
+    report["cpu_s"] = round(cpu, 3)
+    report["cpu_per_simulated_s"] = round(cpu / max(sim.now(), 1e-9), 6)
+    report["events"] = sim.clock.events_processed
+    report["datagrams_delivered"] = sim.network.datagrams_delivered
+    report["datagrams_lost"] = sim.network.datagrams_lost
+    report["sent_by_type"] = {MsgType(code).name: count for code, count in sorted(sim.network.sent_by_type.items())}
+    return report
+
+
+def received_per_s(sim_node, seconds, *msg_types):
+    received = sim_node.metrics.received
+    codes = [msg_type.value for msg_type in msg_types] or list(received)
+    return round(sum(received.get(code, 0) for code in codes) / seconds, 2)
+
+
+def run_hierarchy_scenario(args):
+    """
+    Hierarchical mode - cold start -> steady state load of the leaders -> kill the top leader
+    """
+    sim = ClusterSimulator(args.nodes, seed=args.seed, latency=args.latency, jitter=args.jitter, loss=args.loss)
+    report = {"nodes": args.nodes, "groups": len(config.HIERARCHY_GROUPS), "seed": args.seed, "loss": args.loss,
+              "coloring_policy": config.COLORING_POLICY}
+    cpu_start = time.process_time()
+
+    ### Cold start
+    sim.start(args.spread)
+    report["hierarchy_convergence_s"] = sim.run_until(sim.hierarchy_converged, args.timeout)
+    report["startup_recolor_msgs"] = recolor_messages(sim)
+    report["colors"] = sim.color_counts()
+    sim.run(args.settle)
+
+    ### Steady state - messages received per second by the top leader and the other group leaders
+    top = sim.top_leader()
+    if top is not None:
+        group_leaders = [sim.leaders(nodes)[0] for nodes in sim.groups().values()]
+        before = {ip: dict(sim.nodes[ip].metrics.received) for ip in group_leaders}
+        for ip in group_leaders:
+            sim.nodes[ip].metrics.received.clear()
+        sim.run(args.settle)
+        report["top_leader"] = top
+        report["top_leader_recv_per_s"] = received_per_s(sim.nodes[top], args.settle)
+        report["top_leader_summaries_per_s"] = received_per_s(sim.nodes[top], args.settle, MsgType.GROUP_SUMMARY)
+        others = [ip for ip in group_leaders if ip != top]
+        if others:
+            report["group_leader_recv_per_s"] = round(
+                sum(received_per_s(sim.nodes[ip], args.settle) for ip in others) / len(others), 2)
+        for ip, received in before.items():
+            for code, count in received.items():
+                sim.nodes[ip].metrics.received[code] = sim.nodes[ip].metrics.received.get(code, 0) + count
+
+        ### Top leader failure - its group elects a new leader, the highest group leader becomes the top leader
+        recolor_before = recolor_messages(sim)
+        sim.kill(top)
+        report["top_failover_convergence_s"] = sim.run_until(sim.hierarchy_converged, args.timeout)
+        report["top_failover_recolor_msgs"] = recolor_messages(sim) - recolor_before
+        report["new_top_leader"] = sim.top_leader()
+        report["colors_after_failover"] = sim.color_counts()
+
+    cpu = time.process_time() - cpu_start
+    report["simulated_s"] = round(sim.now(), 3)
+    report["cpu_s"] = round(cpu, 3)
+    report["datagrams_delivered"] = sim.network.datagrams_delivered
+    report["sent_by_type"] = {MsgType(code).name: count for code, count in sorted(sim.network.sent_by_type.items())}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic discrete-event simulation of the cluster")
+    parser.add_argument("--nodes", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--loss", type=float, default=0.0, help="Datagram loss probability")
+    parser.add_argument("--latency", type=float, default=0.0005, help="Base one-way latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.0005, help="Mean of exponential jitter (s)")
+    parser.add_argument("--spread", type=float, default=1.0, help="Nodes start within this many seconds")
+    parser.add_argument("--settle", type=float, default=10.0, help="Pause between phases (s)")
+    parser.add_argument("--kill-slaves", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120.0, help="Max simulated time of one phase (s)")
+    parser.add_argument("--engine", choices=["keepalive", "swim"], default=config.MEMBERSHIP_ENGINE)
+    parser.add_argument("--heartbeat", action="store_true", help="Enable LEADER_HEARTBEAT_BROADCAST")
+    parser.add_argument("--monitor", action="store_true", help="Add a MonitorNode and check its view")
+    parser.add_argument("--coloring", choices=["prefix", "sticky"], default=config.COLORING_POLICY)
+    parser.add_argument("--detector", choices=["fixed", "phi"], default=config.FAILURE_DETECTOR)
+    parser.add_argument("--groups", type=int, default=0,
+                        help="Hierarchical mode with this many groups (networks 10.0.1.0/24, 10.0.2.0/24, ...)")
+    args = parser.parse_args()
+
+    config.MEMBERSHIP_ENGINE = args.engine
+    config.LEADER_HEARTBEAT_BROADCAST = args.heartbeat
+    config.COLORING_POLICY = args.coloring
+    config.FAILURE_DETECTOR = args.detector
+    if args.groups:
+        config.HIERARCHY_GROUPS = tuple(f"10.0.{index + 1}.0/24" for index in range(args.groups))
+    else:
+        # Flat cluster's nodes are 10.0.0.1, 10.0.0.2, ... (ELECTION broadcasts are staggered by rank in this range)
+        config.IP_PREFIX = "10.0."
+    # Node output is not interesting here and would dominate the run time
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = run_hierarchy_scenario(args) if args.groups else run_scenario(args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
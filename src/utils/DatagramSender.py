@@ -0,0 +1,75 @@
+import socket
+
+from src.utils import log
+
+_logger = log.get_logger("sender")
+
+
+class DatagramSender:
+    def __init__(self):
+        """
+        Owns all outgoing traffic of the node - sends go through the asyncio DatagramTransport of the UDP server
+        (non-blocking), or through one long-lived unicast and one broadcast socket when there is no transport.
+        Every datagram is one sendto - Python has no sendmmsg, the transport buffers them in order when the socket
+        is not writable.
+        """
+        self.transport = None
+        self._unicast_sock = None
+        self._broadcast_sock = None
+        # Counters
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.sockets_opened = 0
+
+    def attach_transport(self, transport):
+        """
+        Sends will go through given transport (it has to be created with allow_broadcast=True)
+        """
+        self.transport = transport
+
+    def sendto(self, payload, addr, broadcast=False):
+        try:
+            if self.transport is not None and not self.transport.is_closing():
+                self.transport.sendto(payload, addr)
+            elif broadcast:
+                self._get_broadcast_sock().sendto(payload, addr)
+            else:
+                self._get_unicast_sock().sendto(payload, addr)
+        except OSError as e:
+            self.send_errors += 1
+            log.warning(_logger, "send_failed", peer=addr[0], error=str(e))
+            return
+        self.packets_sent += 1
+        self.bytes_sent += len(payload)
+
+    def _get_unicast_sock(self):
+        if self._unicast_sock is None:
+            self._unicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sockets_opened += 1
+        return self._unicast_sock
+
+    def _get_broadcast_sock(self):
+        if self._broadcast_sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self._broadcast_sock = sock
+            self.sockets_opened += 1
+        return self._broadcast_sock
+
+    def stats(self):
+        return {
+            "packets_sent": self.packets_sent,
+            "bytes_sent": self.bytes_sent,
+            "send_errors": self.send_errors,
+            "sockets_opened": self.sockets_opened,
+        }
+
+    def close(self):
+        for sock in (self._unicast_sock, self._broadcast_sock):
+            if sock is not None:
+                sock.close()
+        self._unicast_sock = None
+        self._broadcast_sock = None
+        self.transport = None
@@ -0,0 +1,74 @@
+import heapq
+
+
+class DeadlineHeap:
+    def __init__(self):
+        """
+        Expiry scheduler - min-heap of deadlines with lazy deletion.
+        Refreshing a key only overwrites its deadline (O(1)), the heap entry is moved when it reaches the top.
+        """
+        self._heap = []
+        # key -> current deadline
+        self._deadlines = {}
+        # key -> deadline of the key's live heap entry
+        self._queued = {}
+
+    def refresh(self, key, deadline):
+        """
+        Sets new deadline of the key (adds the key if needed)
+        """
+        self._deadlines[key] = deadline
+        queued = self._queued.get(key)
+        if queued is None or deadline < queued:
+            heapq.heappush(self._heap, (deadline, key))
+            self._queued[key] = deadline
+
+    def remove(self, key):
+        """
+        Stops tracking the key, its heap entry is dropped when it reaches the top
+        """
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline which has to be checked (or None if there is nothing to check)
+        """
+        while self._heap:
+            deadline, key = self._heap[0]
+            if self._queued.get(key) == deadline and key in self._deadlines:
+                return deadline
+            # Stale entry
+            heapq.heappop(self._heap)
+            if self._queued.get(key) == deadline:
+                del self._queued[key]
+        return None
+
+    def pop_expired(self, now):
+        """
+        Removes and returns all keys with deadline lower or equal to now
+        """
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._queued.get(key) != deadline:
+                # Superseded by an earlier entry of the same key
+                continue
+            current = self._deadlines.get(key)
+            if current is None:
+                del self._queued[key]
+            elif current <= now:
+                del self._queued[key]
+                del self._deadlines[key]
+                expired.append(key)
+            else:
+                # Key was refreshed since this entry was pushed
+                heapq.heappush(heap, (current, key))
+                self._queued[key] = current
+        return expired
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
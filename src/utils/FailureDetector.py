@@ -0,0 +1,152 @@
+import math
+from array import array
+
+from src import config
+
+
+def _phi(y):
+    """
+    Suspicion level of a heartbeat delayed by y standard deviations after the expected arrival
+    (logistic approximation of the normal CDF)
+    """
+    # Bounded so that exp() can't overflow (phi is above 100 at the bound anyway)
+    y = min(max(y, -15.0), 15.0)
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if y > 0:
+        return -math.log10(e / (1 + e))
+    return -math.log10(1 - 1 / (1 + e))
+
+
+def _threshold_delay(threshold):
+    """
+    :return: Delay y (in standard deviations) at which _phi(y) reaches the threshold (bisection, done once)
+    """
+    low, high = 0.0, 15.0
+    for _ in range(60):
+        middle = (low + high) / 2
+        if _phi(middle) < threshold:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+#################################################################################
+# FixedTimeoutDetector
+#################################################################################
+
+class FixedTimeoutDetector:
+    def __init__(self, timeout):
+        """
+        Original failure detection - peer is dead after a fixed time without a heartbeat
+        :param timeout: Nanoseconds (config.NODE_DEAD_AFTER / config.LEADER_DEAD_AFTER)
+        """
+        self.timeout = timeout
+        # peer -> time of its last heartbeat (monotonic ns)
+        self.last = {}
+
+    def heartbeat(self, peer, now):
+        """
+        Records a heartbeat (keepalive) of the peer
+        :return: Time (monotonic ns) at which the peer is considered dead unless another heartbeat comes
+        """
+        self.last[peer] = now
+        return now + self.timeout
+
+    def phi(self, peer, now):
+        """
+        :return: Suspicion level of the peer - 0 while it is alive, infinity once it is dead
+        """
+        return 0.0 if now - self.last[peer] <= self.timeout else math.inf
+
+    def remove(self, peer):
+        self.last.pop(peer, None)
+
+
+#################################################################################
+# PhiAccrualDetector
+#################################################################################
+
+class _History:
+    __slots__ = ("intervals", "index", "count", "total", "squares", "last")
+
+    def __init__(self, now):
+        # Ring buffer of the last config.PHI_WINDOW inter-arrival times (ns) with their sum and sum of squares
+        self.intervals = array("q", bytes(8 * config.PHI_WINDOW))
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self.squares = 0
+        self.last = now
+
+
+class PhiAccrualDetector:
+    def __init__(self, timeout):
+        """
+        Phi-accrual failure detector (Hayashibara et al.) - inter-arrival times of every peer's heartbeats
+        are assumed normally distributed, phi = -log10(probability that the next heartbeat comes even later).
+        Peer is dead when phi exceeds config.PHI_THRESHOLD, the detection time follows the observed jitter.
+        Every heartbeat costs O(1), memory is config.PHI_WINDOW samples per peer.
+        :param timeout: Fixed timeout (ns) used until the peer has config.PHI_MIN_SAMPLES samples
+        """
+        self.timeout = timeout
+        self.histories = {}
+        self.min_std = int(config.PHI_MIN_STD * 1e9)
+        self.pause = int(config.PHI_ACCEPTABLE_PAUSE * 1e9)
+        self.threshold_delay = _threshold_delay(config.PHI_THRESHOLD)
+
+    def heartbeat(self, peer, now):
+        """
+        Records a heartbeat (keepalive) of the peer
+        :return: Time (monotonic ns) at which phi of the peer reaches the threshold unless another heartbeat comes
+        """
+        history = self.histories.get(peer)
+        if history is None:
+            self.histories[peer] = _History(now)
+            return now + self.timeout
+        interval = now - history.last
+        history.last = now
+        old = history.intervals[history.index]
+        if history.count == len(history.intervals):
+            history.total -= old
+            history.squares -= old * old
+        else:
+            history.count += 1
+        history.intervals[history.index] = interval
+        history.index = (history.index + 1) % len(history.intervals)
+        history.total += interval
+        history.squares += interval * interval
+        if history.count < config.PHI_MIN_SAMPLES:
+            return now + self.timeout
+        mean, std = self.distribution(history)
+        return now + int(mean + self.threshold_delay * std)
+
+    def distribution(self, history):
+        """
+        :return: Expected interval (acceptable pause included) and its standard deviation (ns)
+        """
+        count = history.count
+        variance = (history.squares * count - history.total * history.total) / (count * count)
+        return history.total / count + self.pause, max(math.sqrt(max(variance, 0)), self.min_std)
+
+    def phi(self, peer, now):
+        """
+        :return: Suspicion level of the peer (config.PHI_THRESHOLD and above = dead)
+        """
+        history = self.histories[peer]
+        elapsed = now - history.last
+        if history.count < config.PHI_MIN_SAMPLES:
+            return 0.0 if elapsed <= self.timeout else math.inf
+        mean, std = self.distribution(history)
+        return _phi((elapsed - mean) / std)
+
+    def remove(self, peer):
+        self.histories.pop(peer, None)
+
+
+# Detectors selectable by config.FAILURE_DETECTOR
+DETECTORS = {"fixed": FixedTimeoutDetector, "phi": PhiAccrualDetector}
+
+
+def create_detector(timeout):
+    return DETECTORS[config.FAILURE_DETECTOR](timeout)
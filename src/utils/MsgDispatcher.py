@@ -0,0 +1,87 @@
+import logging
+import time
+
+from src.utils import log, metrics
+from src.utils.protocol_msgs import MONITORING_TYPES, DecodeError, MsgType, decode_msg
+
+_logger = log.get_logger("dispatch")
+
+# Dispatch tables are indexed by message type code
+_TABLE_SIZE = max(msg_type.value for msg_type in MsgType) + 1
+_TYPE_NAMES = [None] * _TABLE_SIZE
+# Handler latency histogram name of every message type
+_HANDLER_METRICS = ["handler_ns"] * _TABLE_SIZE
+# Types whose sender is a cluster member (on_receive is called), monitoring traffic is not
+_MEMBER_TRAFFIC = [False] * _TABLE_SIZE
+for _msg_type in MsgType:
+    _TYPE_NAMES[_msg_type.value] = _msg_type.name
+    _HANDLER_METRICS[_msg_type.value] = f"handler_ns.{_msg_type.name}"
+    _MEMBER_TRAFFIC[_msg_type.value] = _msg_type not in MONITORING_TYPES
+
+
+class MsgDispatcher:
+    def __init__(self, modes, resolve_local_ip, on_receive=None):
+        """
+        Per message type and mode handler registry, shared prologue of message processing
+        (dropping own messages, decoding, logging, metrics)
+        :param modes: Modes the node can operate in, every mode has its own table
+        :param resolve_local_ip: Returns our IP (messages from it are ignored)
+        :param on_receive: Called with sender IP before handlers of protocol messages (e.g. membership liveness),
+                           not for monitoring traffic (MONITORING_TYPES)
+        """
+        self.resolve_local_ip = resolve_local_ip
+        self.on_receive = on_receive
+        self.tables = {mode: [None] * _TABLE_SIZE for mode in modes}
+        self.mode = None
+        # Table of the current mode
+        self.active = None
+
+    def register(self, msg_type: MsgType, handler, *modes):
+        """
+        :param handler: Called with (sender IP, decoded data)
+        :param modes: Modes in which the handler is used (all modes if none is given)
+        """
+        for mode in modes or self.tables:
+            self.tables[mode][msg_type.value] = handler
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.active = self.tables[mode]
+
+    def handled_types(self):
+        """
+        :return: Type codes which have a handler in at least one mode (see UDPServer.set_processing_func())
+        """
+        return frozenset(code for table in self.tables.values() for code, handler in enumerate(table)
+                         if handler is not None)
+
+    def process_msg(self, sender_addr, msg, parsed=None):
+        """
+        :param parsed: JSON message already parsed by the ingress stage (UDPServer), if any
+        """
+        sender_ip = sender_addr[0]
+        if sender_ip == self.resolve_local_ip():
+            return
+        start = time.perf_counter_ns()
+        try:
+            msg_code, data = decode_msg(msg, sender_ip, parsed)
+        except DecodeError as e:
+            metrics.registry.incr("decode_errors")
+            log.warning(_logger, "decode_failed", peer=sender_ip, error=str(e))
+            return
+        known = 0 <= msg_code < _TABLE_SIZE
+        if _logger.isEnabledFor(logging.DEBUG) and known and _TYPE_NAMES[msg_code] is not None:
+            if log.sampled(MsgType(msg_code)):
+                _logger.debug("recv", extra={"type": _TYPE_NAMES[msg_code], "peer": sender_ip})
+        if self.on_receive is not None and known and _MEMBER_TRAFFIC[msg_code]:
+            self.on_receive(sender_ip)
+
+        handler = self.active[msg_code] if known else None
+        if handler is not None:
+            handler(sender_ip, data)
+        elif not known or _TYPE_NAMES[msg_code] is None:
+            log.warning(_logger, "unknown_msg_type", type=msg_code, peer=sender_ip)
+
+        registry = metrics.registry
+        registry.count_received(msg_code)
+        registry.record(_HANDLER_METRICS[msg_code] if known else "handler_ns", time.perf_counter_ns() - start)
@@ -0,0 +1,39 @@
+#################################################################################
+# PageAssembler
+#################################################################################
+
+class PageAssembler:
+    def __init__(self, limit):
+        """
+        Collects pages of snapshots and deltas split by protocol_msgs.paginate() until all pages of one arrive
+        :param limit: Max number of incomplete messages kept, the oldest is dropped (its sender sends it again)
+        """
+        self.limit = limit
+        # Key of the paged message -> [number of missing pages, items of every page (None = missing)]
+        self.partial = {}
+
+    def add(self, key, page, pages, items):
+        """
+        :param key: Identifies the paged message (e.g. its version)
+        :return: Items of all pages in order once the last missing page arrived, None otherwise
+        """
+        if pages == 1:
+            return items
+        if not 0 <= page < pages:
+            return None
+        entry = self.partial.get(key)
+        if entry is None or len(entry[1]) != pages:
+            entry = self.partial[key] = [pages, [None] * pages]
+            while len(self.partial) > self.limit:
+                del self.partial[next(iter(self.partial))]
+        parts = entry[1]
+        if parts[page] is None:
+            entry[0] -= 1
+        parts[page] = items
+        if entry[0]:
+            return None
+        del self.partial[key]
+        return [item for part in parts for item in part]
+
+    def clear(self):
+        self.partial.clear()
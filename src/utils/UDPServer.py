@@ -1,24 +1,181 @@
 import asyncio
+from collections import deque
+
+from src import config
+from src.utils import event_loop, log, metrics
+from src.utils.protocol_msgs import INGRESS_CLASS_NAMES, INGRESS_CONTROL, INGRESS_KEEPALIVE, ingress_class, \
+    keepalive_payload, peek_binary_type
+
+_logger = log.get_logger("udp")
+
+# Size of the receive buffer (largest UDP payload)
+_MAX_DATAGRAM = 65535
+
 
 class UDPServer(asyncio.DatagramProtocol):
     def __init__(self):
         self.msg_processing_ptr = None
+        self.transport = None
+        self._raw_sock = None
+        # Drained datagrams are received into this buffer, handlers get a memoryview of it (no copy per datagram)
+        self._buffer = bytearray(_MAX_DATAGRAM)
+        self._view = memoryview(self._buffer)
+        # Datagrams from this IP are dropped before the processing function is called
+        self.local_ip = None
+        # Message type codes passed to the processing function (None = all)
+        self.accepted_types = None
+        # Ingress queues per priority class (config.INGRESS_PRIORITY) - (data, addr, coalescing key, parsed JSON)
+        self.queues = [deque() for _ in INGRESS_CLASS_NAMES]
+        # (sender IP, payload) of queued keepalives - identical keepalives of one sender are queued once
+        self.queued_keepalives = set()
+        # Control messages processed right away since the last process_queued() - they use up its budget
+        self.processed_inline = 0
+        self._process_handle = None
+        # Counters
+        self.wakeups = 0
+        self.datagrams_received = 0
+        self.datagrams_dropped = 0
+        self.datagrams_coalesced = 0
+        self.datagrams_shed = [0] * len(INGRESS_CLASS_NAMES)
 
     def connection_made(self, transport):
         self.transport = transport
-        print("UDP server is listening for packets...")
+        if config.RECV_BATCH_SIZE > 1:
+            # Own handle of the transport's socket, used to drain pending datagrams on every wakeup
+            self._raw_sock = event_loop.dup_transport_socket(transport)
+        log.info(_logger, "listening", port=config.DEFAULT_LISTENING_PORT)
 
     def datagram_received(self, data, addr):
-        message = data.decode()
-        #print("Received:", addr, data)
-        if self.msg_processing_ptr is not None:
-            self.msg_processing_ptr(addr, message)
+        self.wakeups += 1
+        self.process_datagram(data, addr)
+        if self._raw_sock is None:
+            return
+        # Drain the socket, so a burst costs one loop wakeup instead of one per datagram
+        for _ in range(config.RECV_BATCH_SIZE - 1):
+            try:
+                size, addr = self._raw_sock.recvfrom_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.error_received(exc)
+                return
+            self.process_datagram(self._view[:size], addr)
+
+    def process_datagram(self, data, addr):
+        """
+        Passes the datagram to the processing function (or queues it, see enqueue()) unless it is our own
+        or of a type nobody handles here
+        The processing function gets bytes or a memoryview valid only until it returns (it must not keep it),
+        from the ingress queue also the JSON message parsed by ingress_class() (None for binary messages).
+        """
+        self.datagrams_received += 1
+        if addr[0] == self.local_ip or len(data) < 2:
+            self.datagrams_dropped += 1
+            return
+        if self.accepted_types is not None:
+            msg_code = peek_binary_type(data)
+            # JSON messages (older nodes) are passed on, their type is known only after parsing
+            if msg_code is not None and msg_code not in self.accepted_types:
+                self.datagrams_dropped += 1
+                return
+        # Raw bytes are passed on, protocol_msgs.decode_msg() handles both JSON and binary format
+        if self.msg_processing_ptr is None:
+            return
+        if config.INGRESS_PRIORITY:
+            self.enqueue(data, addr)
+        else:
+            self.msg_processing_ptr(addr, data)
+
+    def enqueue(self, data, addr):
+        """
+        Queues the datagram by its priority class and makes sure the queues get processed.
+        A control message is processed right away if no other waits (nothing queued would go first) and
+        the INGRESS_BUDGET of this iteration is not used up - it is not copied, only queued datagrams are copied
+        out of the receive buffer. A burst of control messages is queued (and shed) like any other class.
+        """
+        msg_class, parsed = ingress_class(data)
+        if msg_class == INGRESS_CONTROL and not self.queues[INGRESS_CONTROL] \
+                and self.processed_inline < config.INGRESS_BUDGET:
+            self.processed_inline += 1
+            # Next process_queued() starts a new budget
+            self.schedule_processing()
+            self.msg_processing_ptr(addr, data, parsed)
+            return
+        key = None
+        if msg_class == INGRESS_KEEPALIVE:
+            payload = keepalive_payload(data)
+            if payload is not None:
+                key = (addr[0], payload)
+                if key in self.queued_keepalives:
+                    # The queued keepalive carries the same information
+                    self.datagrams_coalesced += 1
+                    metrics.registry.incr("ingress_coalesced")
+                    return
+        queue = self.queues[msg_class]
+        name = INGRESS_CLASS_NAMES[msg_class]
+        if len(queue) >= config.INGRESS_QUEUE_LIMITS[name]:
+            # Overload - newest datagrams of the class are shed, other classes are not affected
+            self.datagrams_shed[msg_class] += 1
+            metrics.registry.incr(f"ingress_shed_{name}")
+            return
+        if key is not None:
+            self.queued_keepalives.add(key)
+        # Receive buffer is reused for the next datagram
+        queue.append((bytes(data), addr, key, parsed))
+        self.schedule_processing()
+
+    def schedule_processing(self):
+        if self._process_handle is None:
+            self._process_handle = asyncio.get_running_loop().call_soon(self.process_queued)
+
+    def process_queued(self):
+        """
+        Processes queued datagrams in priority order, at most config.INGRESS_BUDGET of them (less the control
+        messages processed right away meanwhile) - the rest waits for the next event loop iteration, so datagrams
+        received meanwhile are classified first (a control message overtakes queued keepalives)
+        """
+        self._process_handle = None
+        budget = config.INGRESS_BUDGET - self.processed_inline
+        self.processed_inline = 0
+        try:
+            for _ in range(budget):
+                queue = next((queue for queue in self.queues if queue), None)
+                if queue is None:
+                    return
+                data, addr, key, parsed = queue.popleft()
+                if key is not None:
+                    self.queued_keepalives.discard(key)
+                self.msg_processing_ptr(addr, data, parsed)
+        finally:
+            # Also when a handler raised (the loop's exception handler reports it) - the rest must not get stuck
+            if any(self.queues):
+                self.schedule_processing()
+
+    def ingress_stats(self):
+        """
+        :return: Queue lengths and shed datagrams per class, coalesced keepalives
+        """
+        return {"queued": {name: len(queue) for name, queue in zip(INGRESS_CLASS_NAMES, self.queues)},
+                "shed": dict(zip(INGRESS_CLASS_NAMES, self.datagrams_shed)),
+                "coalesced": self.datagrams_coalesced}
 
     def error_received(self, exc):
-        print(f"Error received: {exc}")
+        log.warning(_logger, "socket_error", error=str(exc))
 
     def connection_lost(self, exc):
-        print("Closing UDP server")
+        if self._process_handle is not None:
+            self._process_handle.cancel()
+            self._process_handle = None
+        if self._raw_sock is not None:
+            self._raw_sock.close()
+            self._raw_sock = None
+        log.info(_logger, "closed")
 
-    def set_processing_func(self, processing_func):
-        self.msg_processing_ptr = processing_func
\ No newline at end of file
+    def set_processing_func(self, processing_func, local_ip=None, accepted_types=None):
+        """
+        :param local_ip: Our IP, datagrams sent by us (broadcasts) are dropped
+        :param accepted_types: Collection of message type codes the node handles, others are dropped by the type byte
+        """
+        self.msg_processing_ptr = processing_func
+        self.local_ip = local_ip
+        self.accepted_types = frozenset(accepted_types) if accepted_types is not None else None
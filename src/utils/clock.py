@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+
+def now_ns():
+    """
+    Monotonic time in nanoseconds (not affected by wall-clock changes)
+    """
+    return time.monotonic_ns()
+
+
+def call_later(delay, callback, *args):
+    """
+    Schedules callback on the running event loop after delay seconds
+    :return: Handle with cancel() method
+    """
+    return asyncio.get_running_loop().call_later(delay, callback, *args)
+
+
+def call_soon(callback, *args):
+    """
+    Schedules callback on the running event loop, it runs after the current loop iteration's callbacks
+    :return: Handle with cancel() method
+    """
+    return asyncio.get_running_loop().call_soon(callback, *args)
+
+
+def sleep(delay):
+    """
+    Awaitable pause of a timer task
+    """
+    return asyncio.sleep(delay)
+
+
+def install(now_ns_func, call_later_func, call_soon_func, sleep_func):
+    """
+    Replaces the time source and scheduler (used by the simulator to run nodes on virtual time)
+    """
+    global now_ns, call_later, call_soon, sleep
+    now_ns = now_ns_func
+    call_later = call_later_func
+    call_soon = call_soon_func
+    sleep = sleep_func
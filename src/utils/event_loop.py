@@ -0,0 +1,59 @@
+import asyncio
+import socket
+
+from src import config
+from src.utils import log
+
+_logger = log.get_logger("loop")
+
+
+def _loop_factory():
+    """
+    :return: Factory of the event loop selected by config.EVENT_LOOP (None = default asyncio loop)
+    """
+    if config.EVENT_LOOP == "asyncio":
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        if config.EVENT_LOOP == "uvloop":
+            log.warning(_logger, "uvloop_missing")
+        return None
+    return uvloop.new_event_loop
+
+
+def run(main):
+    """
+    Runs the coroutine on the selected event loop (like asyncio.run())
+    Works on Python 3.7+ (asyncio.Runner, which takes a loop factory, needs 3.11).
+    """
+    factory = _loop_factory()
+    if factory is None:
+        return asyncio.run(main)
+    loop = factory()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def dup_transport_socket(transport):
+    """
+    Own non-blocking handle of a datagram transport's socket, used for batched reads
+    Works with loops which expose only a socket-like object (uvloop), the file descriptor is duplicated.
+    :return: socket.socket or None if the transport has no socket
+    """
+    sock = transport.get_extra_info('socket')
+    if sock is None:
+        return None
+    try:
+        raw_sock = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    except (AttributeError, OSError):
+        return None
+    raw_sock.setblocking(False)
+    return raw_sock
@@ -0,0 +1,86 @@
+import functools
+import ipaddress
+
+from src import config
+
+
+@functools.lru_cache(maxsize=None)
+def _networks(groups):
+    return tuple(ipaddress.ip_network(group, strict=False) for group in groups)
+
+
+def networks():
+    """
+    :return: Networks of the groups (config.HIERARCHY_GROUPS), empty if the cluster is flat
+    """
+    return _networks(tuple(config.HIERARCHY_GROUPS))
+
+
+def group_of(ip):
+    """
+    :return: Index of the group the IP belongs to, None if it isn't in any group (or the cluster is flat)
+    """
+    if ip is None:
+        return None
+    address = ipaddress.ip_address(ip)
+    return next((index for index, network in enumerate(networks()) if address in network), None)
+
+
+def group_of_broadcast(ip):
+    """
+    :return: Index of the group whose broadcast address the IP is, None otherwise
+    """
+    address = ipaddress.ip_address(ip)
+    return next((index for index, network in enumerate(networks()) if address == network.broadcast_address), None)
+
+
+@functools.lru_cache(maxsize=None)
+def _broadcast_addrs(groups, index, exclude):
+    network = _networks(groups)[index]
+    if network.is_loopback:
+        # Loopback has no broadcast - nodes on one machine (127.x.y.z) get a unicast each
+        return tuple(((str(host), config.DEFAULT_LISTENING_PORT), False) for host in network.hosts()
+                     if str(host) != exclude)
+    return (((str(network.broadcast_address), config.DEFAULT_LISTENING_PORT), True),)
+
+
+def broadcast_addrs(index, exclude=None):
+    """
+    Where a broadcast to the group goes
+    :param exclude: Our IP (not sent to ourselves)
+    :return: Tuple of (address, broadcast) - the network's broadcast address, every host of a loopback network
+    """
+    return _broadcast_addrs(tuple(config.HIERARCHY_GROUPS), index, exclude)
+
+
+def split_quota(total, sizes):
+    """
+    Splits nodes of a color between groups in proportion to their sizes (largest remainder method).
+    Every group gets at least 1 (its leader has the first color) and at most its size.
+    :param total: Number of nodes (total weight) of the color in the whole cluster
+    :param sizes: Group index -> size of the group (leader included)
+    :return: Group index -> quota (sums to total unless there are more groups than total)
+    """
+    count = sum(sizes.values())
+    if not count:
+        return {}
+    shares = {group: total * size / count for group, size in sizes.items()}
+    quotas = {group: min(max(int(share), 1), sizes[group]) for group, share in shares.items()}
+    remaining = total - sum(quotas.values())
+    while remaining > 0:
+        # Group most below its share gets one more (ties by group index, every top leader computes the same split)
+        group = min((group for group in sizes if quotas[group] < sizes[group]),
+                    key=lambda group: (quotas[group] - shares[group], group), default=None)
+        if group is None:
+            break
+        quotas[group] += 1
+        remaining -= 1
+    while remaining < 0:
+        # Groups raised to 1 took more than their share - the group most above its share gives one back
+        group = max((group for group in sizes if quotas[group] > 1),
+                    key=lambda group: (quotas[group] - shares[group], -group), default=None)
+        if group is None:
+            break
+        quotas[group] -= 1
+        remaining += 1
+    return quotas
@@ -1,19 +1,69 @@
-import subprocess
+import fcntl
 import socket
 import struct
+from collections import namedtuple
 
+from src import config
 
-def get_ip(prefix):
+# Linux ioctl requests (see netdevice(7))
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891b
+
+InterfaceAddress = namedtuple("InterfaceAddress", ["name", "ip", "netmask"])
+
+_interfaces = None
+
+
+def _ioctl_ipv4(sock, request, name):
+    ifreq = fcntl.ioctl(sock.fileno(), request, struct.pack("256s", name.encode()[:15]))
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+def _discover_interfaces():
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            for _, name in socket.if_nameindex():
+                try:
+                    addresses.append(InterfaceAddress(name, _ioctl_ipv4(sock, _SIOCGIFADDR, name),
+                                                      _ioctl_ipv4(sock, _SIOCGIFNETMASK, name)))
+                except OSError:
+                    # Interface without IPv4 address
+                    continue
+        except (AttributeError, OSError):
+            pass
+        if not addresses:
+            # No ioctl support - ask the routing table which address would be used for the broadcast
+            # (connect() on UDP socket sends nothing)
+            try:
+                sock.connect((config.BROADCAST_IP, config.DEFAULT_LISTENING_PORT))
+                addresses.append(InterfaceAddress(None, sock.getsockname()[0], None))
+            except OSError:
+                pass
+    return addresses
+
+
+def get_interfaces(refresh=False):
+    """
+    IPv4 addresses of local interfaces, discovered once (no subprocess) and cached
+    :param refresh: Discover again (e.g. when waiting for an interface to come up)
+    :return: List of InterfaceAddress(name, ip, netmask)
+    """
+    global _interfaces
+    if _interfaces is None or refresh:
+        _interfaces = _discover_interfaces()
+    return _interfaces
+
+
+def get_ip(prefix, refresh=False):
     """
     Gets an ip with a given prefix
     (Use this to get Vagrant IP)
-    :param prefix:
+    :param prefix: Prefix string or tuple of prefixes (nodes on several subnets)
+    :param refresh: Discover interfaces again instead of using the cached list
     :return: IP of given prefix
     """
-    command = "ifconfig | awk '/inet / {print $2}'"
-    output = subprocess.check_output(command, shell=True, text=True)
-    ip_addresses = output.strip().split("\n")
-    return next((s for s in ip_addresses if s.startswith(prefix)), None)
+    return next((address.ip for address in get_interfaces(refresh) if address.ip.startswith(prefix)), None)
 
 
 def ip_to_long(ip):
@@ -24,6 +74,28 @@ def ip_to_long(ip):
     return struct.unpack("!L", packedIP)[0]
 
 
+def long_to_ip(ip_long):
+    """
+    Convert long back to an IP string
+    """
+    return socket.inet_ntoa(struct.pack("!L", ip_long))
+
+
+def prefix_range(prefix):
+    """
+    Addresses an IP prefix can match - only its complete octets are fixed ("10.0.1." or "10.0.1" -> 10.0.1.0/24 or
+    10.0.0.0/16)
+    :return: Lowest and highest address as longs
+    """
+    octets = [int(octet) for octet in prefix.split(".")[:-1]]
+    free_bits = 32 - 8 * len(octets)
+    low = 0
+    for octet in octets:
+        low = (low << 8) | octet
+    low <<= free_bits
+    return low, low | ((1 << free_bits) - 1)
+
+
 def get_ip_distance(ip1, ip2):
     """
     Compare IP addresses
@@ -0,0 +1,132 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+from src import config
+
+# All loggers of the application are children of this one
+_ROOT_NAME = "dsa"
+_root = logging.getLogger(_ROOT_NAME)
+_root.setLevel(config.LOG_LEVEL)
+_root.propagate = False
+# Nothing is written until setup() is called (e.g. the simulator never calls it)
+_root.addHandler(logging.NullHandler())
+
+_listener = None
+_queue_handler = None
+# Number of records received per message type, used for sampling
+_sample_counters = {}
+
+# Record attributes which are not user fields
+_RESERVED = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, record_queue):
+        """
+        Puts records to a bounded queue, records which don't fit are dropped (logging never blocks the loop)
+        """
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is done by the writer thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        """
+        One compact JSON object per record - time, level, logger, event and the record's fields
+        """
+        entry = {"t": round(record.created, 3), "lvl": record.levelname, "src": record.name[len(_ROOT_NAME) + 1:],
+                 "ev": record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+def get_logger(name):
+    return logging.getLogger(f"{_ROOT_NAME}.{name}")
+
+
+def setup(level=None, stream=None):
+    """
+    Starts the background writer, records are passed to it through a bounded queue
+    :param level: Log level name, config.LOG_LEVEL by default
+    :param stream: Output stream, stdout by default
+    """
+    global _listener, _queue_handler
+    stop()
+    if level is not None:
+        _root.setLevel(level)
+    record_queue = queue.Queue(config.LOG_QUEUE_SIZE)
+    writer = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    writer.setFormatter(StructuredFormatter())
+    _listener = logging.handlers.QueueListener(record_queue, writer)
+    _queue_handler = _DroppingQueueHandler(record_queue)
+    _root.handlers = [_queue_handler]
+    _listener.start()
+
+
+def stop():
+    """
+    Writes the queued records and stops the background writer
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _queue_handler is not None:
+        _root.removeHandler(_queue_handler)
+        _queue_handler = None
+        _root.addHandler(logging.NullHandler())
+
+
+def dropped():
+    """
+    :return: Number of records dropped because the queue was full
+    """
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def sampled(msg_type, direction="recv"):
+    """
+    Per message type sampling, only every n-th message of a type (config.LOG_SAMPLE_EVERY) is logged
+    :param msg_type: MsgType
+    :param direction: "recv" or "send", both directions are sampled separately
+    :return: True if this message should be logged
+    """
+    every = config.LOG_SAMPLE_EVERY.get(msg_type.name, 1)
+    if every <= 1:
+        return True
+    key = (direction, msg_type)
+    count = _sample_counters.get(key, 0)
+    _sample_counters[key] = count + 1
+    return count % every == 0
+
+
+def debug(logger, event, **fields):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(event, extra=fields)
+
+
+def info(logger, event, **fields):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(event, extra=fields)
+
+
+def warning(logger, event, **fields):
+    if logger.isEnabledFor(logging.WARNING):
+        logger.warning(event, extra=fields)
@@ -0,0 +1,206 @@
+import asyncio
+
+# Histogram buckets - values below 2^_SUB_BITS are exact, above that every power of two is split
+# into 2^_SUB_BITS buckets (relative error of a recorded value is at most 1 / 2^_SUB_BITS)
+_SUB_BITS = 3
+_SUB_COUNT = 1 << _SUB_BITS
+
+# Message type names used when rendering per-type counters (filled by protocol_msgs)
+_type_names = {}
+
+
+def register_type_names(names):
+    """
+    :param names: Dictionary message type value -> name
+    """
+    _type_names.update(names)
+
+
+def _bucket_of(value):
+    if value < 2 * _SUB_COUNT:
+        return value
+    shift = value.bit_length() - _SUB_BITS - 1
+    return ((shift + 1) << _SUB_BITS) + (value >> shift) - _SUB_COUNT
+
+
+def _bucket_high(bucket):
+    """
+    Highest value which falls into given bucket
+    """
+    if bucket < 2 * _SUB_COUNT:
+        return bucket
+    shift = (bucket >> _SUB_BITS) - 1
+    return (((bucket & (_SUB_COUNT - 1)) + _SUB_COUNT + 1) << shift) - 1
+
+
+class Histogram:
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        """
+        HDR-style histogram of non-negative integers - O(1) record, constant relative precision, mergeable
+        """
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        bucket = _bucket_of(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """
+        :param q: Quantile between 0 and 1
+        :return: Upper bound of the bucket containing the quantile (0 if the histogram is empty)
+        """
+        if self.count == 0:
+            return 0
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(_bucket_high(bucket), self.max)
+        return self.max
+
+    def to_snapshot(self):
+        return {"n": self.count, "sum": self.total, "max": self.max,
+                "b": [[bucket, count] for bucket, count in self.buckets.items()]}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        histogram = cls()
+        histogram.buckets = {bucket: count for bucket, count in snapshot["b"]}
+        histogram.count = snapshot["n"]
+        histogram.total = snapshot["sum"]
+        histogram.max = snapshot["max"]
+        return histogram
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Counters and histograms of one node
+        """
+        # Messages received and sent per message type value
+        self.received = {}
+        self.sent = {}
+        # Named event counters (recolors, elections, ...)
+        self.counters = {}
+        # Named histograms, name "<metric>.<label>" is rendered as metric with label type="<label>"
+        self.histograms = {}
+
+    def count_received(self, type_value):
+        self.received[type_value] = self.received.get(type_value, 0) + 1
+
+    def count_sent(self, type_value):
+        self.sent[type_value] = self.sent.get(type_value, 0) + 1
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(value)
+
+    def snapshot(self):
+        """
+        :return: JSON-serializable state (payload of METRICS_RESPONSE)
+        """
+        return {"recv": {_type_names.get(key, str(key)): value for key, value in self.received.items()},
+                "sent": {_type_names.get(key, str(key)): value for key, value in self.sent.items()},
+                "counters": dict(self.counters),
+                "hist": {name: histogram.to_snapshot() for name, histogram in self.histograms.items()}}
+
+
+# Metrics of this node (the simulator swaps it per simulated node)
+registry = Metrics()
+
+
+def merge_snapshots(snapshots):
+    """
+    Aggregates snapshots of several nodes - counters are summed, histograms merged
+    """
+    merged = {"recv": {}, "sent": {}, "counters": {}, "hist": {}}
+    histograms = {}
+    for snapshot in snapshots:
+        for section in ("recv", "sent", "counters"):
+            target = merged[section]
+            for key, value in snapshot.get(section, {}).items():
+                target[key] = target.get(key, 0) + value
+        for name, histogram in snapshot.get("hist", {}).items():
+            if name in histograms:
+                histograms[name].merge(Histogram.from_snapshot(histogram))
+            else:
+                histograms[name] = Histogram.from_snapshot(histogram)
+    merged["hist"] = {name: histogram.to_snapshot() for name, histogram in histograms.items()}
+    return merged
+
+
+def render_text(snapshot, labels=""):
+    """
+    Text exposition of a snapshot (one "name{labels} value" line per value)
+    :param labels: Extra labels added to every line, e.g. 'node="10.0.1.5"'
+    """
+    def fmt(name, value, *pairs):
+        pairs = [pair for pair in (labels,) + pairs if pair]
+        return f"dsa_{name}{{{','.join(pairs)}}} {value}" if pairs else f"dsa_{name} {value}"
+
+    lines = []
+    for section, name in (("recv", "received_total"), ("sent", "sent_total")):
+        for key, value in sorted(snapshot[section].items()):
+            lines.append(fmt(name, value, f'type="{key}"'))
+    for key, value in sorted(snapshot["counters"].items()):
+        lines.append(fmt(f"{key}_total", value))
+    for full_name, data in sorted(snapshot["hist"].items()):
+        name, _, label = full_name.partition(".")
+        label = f'type="{label}"' if label else ""
+        histogram = Histogram.from_snapshot(data)
+        for q in (0.5, 0.9, 0.99):
+            lines.append(fmt(name, histogram.percentile(q), label, f'quantile="{q}"'))
+        lines.append(fmt(f"{name}_max", histogram.max, label))
+        lines.append(fmt(f"{name}_sum", histogram.total, label))
+        lines.append(fmt(f"{name}_count", histogram.count, label))
+    return "\n".join(lines) + "\n"
+
+
+async def serve_text(render, port, host="127.0.0.1"):
+    """
+    Local text endpoint - every connection gets the output of render() (with HTTP header if it sent a GET request)
+    :param render: Function returning the text
+    :return: asyncio Server
+    """
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 1.0)
+        except (asyncio.TimeoutError, ConnectionError):
+            request = b""
+        body = render().encode()
+        try:
+            if request.startswith(b"GET"):
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n" % len(body))
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -1,8 +1,13 @@
 from enum import Enum
-import socket
 import json
+import logging
+import struct
 
 from src import config
+from src.utils import groups, ip_tools, log, metrics
+from src.utils.DatagramSender import DatagramSender
+
+_logger = log.get_logger("protocol")
 
 
 class MsgType(Enum):
@@ -15,31 +20,385 @@ class MsgType(Enum):
     KEEPALIVE = 7
     MONITOR_COLOR_REQUEST = 8
     MONITOR_COLOR_RESPONSE = 9
+    HEARTBEAT = 10  # Periodic leader broadcast (epoch, digest, base epoch, color changes since base epoch)
+    STATE_REQUEST = 11  # Slave asks leader for its assignment
+    STATE_RESPONSE = 12  # Leader's answer (epoch, digest, color)
+    SWIM_PING = 13  # SWIM membership engine (seq, target, piggybacked updates)
+    SWIM_PING_REQ = 14
+    SWIM_ACK = 15
+    METRICS_REQUEST = 16  # Monitor asks nodes for their metrics
+    METRICS_RESPONSE = 17  # Metrics snapshot (see metrics.Metrics.snapshot())
+    MONITOR_SUBSCRIBE = 18  # Monitor subscribes to leader's changes (version of its view)
+    MONITOR_SNAPSHOT = 19  # Leader's whole view, one page of it (version, page, pages, [(node IP as long, color)])
+    MONITOR_DELTA = 20  # Changes between two versions (base version, version, page, pages, [(node IP as long, color)]),
+                        # color 0 = removed
+    SET_COLOR = 21  # Any color (value of NodeColor), RED and GREEN are still sent as SET_TO_RED/SET_TO_GREEN
+    COLOR_COMMAND = 22  # Acknowledged color change (command sequence number, color, leader's incarnation)
+    COLOR_ACK = 23  # Slave received the command (command sequence number)
+    REPLICA_SNAPSHOT = 24  # Leader's table replicated to the standby, one page (epoch, page, pages, [(node IP, color)])
+    REPLICA_DELTA = 25  # Changes of one recolor step (base epoch, epoch, page, pages, [(node IP, color)]), 0 = removed
+    REPLICA_ACK = 26  # Epoch of the standby's copy
+    GROUP_SUMMARY = 27  # Group leader's report to the top leader (group index, group size, number of RED nodes)
+    GROUP_QUOTA = 28  # Top leader's answer (group index, RED quota of the group)
+
+
+# Traffic of the monitor and its answers - it isn't part of the algorithm, its sender is not a cluster member
+MONITORING_TYPES = frozenset((MsgType.MONITOR_COLOR_REQUEST, MsgType.MONITOR_COLOR_RESPONSE, MsgType.METRICS_REQUEST,
+                              MsgType.METRICS_RESPONSE, MsgType.MONITOR_SUBSCRIBE, MsgType.MONITOR_SNAPSHOT,
+                              MsgType.MONITOR_DELTA))
+
+metrics.register_type_names({msg_type.value: msg_type.name for msg_type in MsgType})
+
+
+#################################################################################
+# Wire format
+#################################################################################
 
+# Original format - JSON object {"type": ..., "data": ...} (upgraded nodes add "v" with their highest version)
+WIRE_VERSION_JSON = 1
+# Binary format - header (version, type, sequence number, sender id) followed by typed payload
+# The version byte is the sender's highest version (older binary nodes only remember it)
+WIRE_VERSION_BINARY = 2
+# Binary format, color changes are sent as COLOR_COMMAND and acknowledged (older peers get SET_TO_RED/...)
+WIRE_VERSION_COLOR_ACK = 3
+# Leader replicates its table to the standby (REPLICA_SNAPSHOT/REPLICA_DELTA)
+WIRE_VERSION_REPLICA = 4
+
+_JSON_FIRST_BYTE = ord('{')
+_HEADER = struct.Struct("!BBII")
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+# Max number of (node, color) items in one page of MONITOR_SNAPSHOT / MONITOR_DELTA / REPLICA_SNAPSHOT /
+# REPLICA_DELTA - larger tables and deltas are split (see paginate()), a binary page fits into one Ethernet frame
+PAGE_NODES = 256
+
+
+def _struct_codec(payload_struct):
+    if len(payload_struct.unpack(bytes(payload_struct.size))) == 1:
+        return (payload_struct.pack,
+                lambda buffer, offset: payload_struct.unpack_from(buffer, offset)[0])
+    return (lambda data: payload_struct.pack(*data),
+            payload_struct.unpack_from)
+
+
+def _json_codec():
+    """
+    Payload of variable structure (diagnostics only) - compact JSON
+    """
+    return (lambda data: json.dumps(data, separators=(",", ":")).encode('utf-8'),
+            lambda buffer, offset: json.loads(bytes(buffer[offset:])))
+
+
+def _list_codec(head_struct, item_struct):
+    """
+    Payload made of fixed fields followed by a list of fixed-size items - data is (*fields, [items])
+    """
+    def pack(data):
+        items = data[-1]
+        return (head_struct.pack(*data[:-1]) + _U16.pack(len(items))
+                + b"".join(item_struct.pack(*item) for item in items))
+
+    def unpack(buffer, offset):
+        head = head_struct.unpack_from(buffer, offset)
+        offset += head_struct.size
+        (count,) = _U16.unpack_from(buffer, offset)
+        offset += _U16.size
+        items = [item_struct.unpack_from(buffer, offset + i * item_struct.size) for i in range(count)]
+        return head + (items,)
+
+    return pack, unpack
+
+
+def _color_command_codec():
+    """
+    Sequence number, color and the leader's incarnation - the incarnation is appended, older nodes don't read it
+    and commands of older leaders are decoded with incarnation None
+    """
+    command_struct = struct.Struct("!IBI")
+    legacy_struct = struct.Struct("!IB")
+
+    def unpack(buffer, offset):
+        if len(buffer) - offset >= command_struct.size:
+            return command_struct.unpack_from(buffer, offset)
+        return legacy_struct.unpack_from(buffer, offset) + (None,)
+
+    return (lambda data: command_struct.pack(*data)), unpack
+
+
+# Payload codecs (pack(data) -> bytes, unpack(buffer, offset) -> data) of message types which carry data
+# Empty data ("") is sent as a message without payload
+_PAYLOAD_CODECS = {
+    MsgType.KEEPALIVE.value: _struct_codec(_U8),  # Color of the slave (empty from leader)
+    MsgType.MONITOR_COLOR_RESPONSE.value: _struct_codec(_U8),
+    MsgType.SET_COLOR.value: _struct_codec(_U8),
+    MsgType.COLOR_COMMAND.value: _color_command_codec(),
+    MsgType.COLOR_ACK.value: _struct_codec(struct.Struct("!I")),
+    # Epoch, digest, base epoch, [(node IP as long, color)]
+    MsgType.HEARTBEAT.value: _list_codec(struct.Struct("!III"), struct.Struct("!IB")),
+    MsgType.STATE_REQUEST.value: _struct_codec(_U8),  # Current color of the slave
+    MsgType.STATE_RESPONSE.value: _struct_codec(struct.Struct("!IIB")),  # Epoch, digest, color
+    MsgType.METRICS_RESPONSE.value: _json_codec(),
+    MsgType.MONITOR_SUBSCRIBE.value: _struct_codec(struct.Struct("!I")),
+    MsgType.MONITOR_SNAPSHOT.value: _list_codec(struct.Struct("!IHH"), struct.Struct("!IB")),
+    MsgType.MONITOR_DELTA.value: _list_codec(struct.Struct("!IIHH"), struct.Struct("!IB")),
+    MsgType.REPLICA_SNAPSHOT.value: _list_codec(struct.Struct("!IHH"), struct.Struct("!IB")),
+    MsgType.REPLICA_DELTA.value: _list_codec(struct.Struct("!IIHH"), struct.Struct("!IB")),
+    MsgType.REPLICA_ACK.value: _struct_codec(struct.Struct("!I")),
+    MsgType.GROUP_SUMMARY.value: _struct_codec(struct.Struct("!HII")),
+    MsgType.GROUP_QUOTA.value: _struct_codec(struct.Struct("!HI")),
+}
+# Seq, target (IP as long), [(member IP as long, state, incarnation)]
+_SWIM_CODEC = _list_codec(struct.Struct("!II"), struct.Struct("!IBI"))
+_PAYLOAD_CODECS[MsgType.SWIM_PING.value] = _SWIM_CODEC
+_PAYLOAD_CODECS[MsgType.SWIM_PING_REQ.value] = _SWIM_CODEC
+_PAYLOAD_CODECS[MsgType.SWIM_ACK.value] = _SWIM_CODEC
+
+
+class WireState:
+    def __init__(self):
+        """
+        Per-node state of the wire protocol
+        """
+        # Sender id put into binary headers (our IP converted by ip_tools.ip_to_long())
+        self.local_id = 0
+        self.seq = 0
+        # Highest wire version each peer has announced (peer IP -> version)
+        self.peer_versions = {}
+        # Number of known peers per version (version -> count), broadcast_version() doesn't scan all peers
+        self.version_counts = {}
+        # Where broadcasts go - (address, broadcast) pairs, None = config.BROADCAST_IP (see set_local_ip())
+        self.broadcast_addrs = None
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return self.seq
+
+    def note_peer_version(self, peer, version):
+        if peer is None:
+            return
+        previous = self.peer_versions.get(peer)
+        if previous != version:
+            if previous is not None:
+                self._uncount(previous)
+            self.peer_versions[peer] = version
+            self.version_counts[version] = self.version_counts.get(version, 0) + 1
+
+    def forget_peer(self, peer):
+        """
+        Peer was dropped (dead) - its version no longer holds broadcasts back
+        """
+        version = self.peer_versions.pop(peer, None)
+        if version is not None:
+            self._uncount(version)
+
+    def _uncount(self, version):
+        count = self.version_counts[version] - 1
+        if count:
+            self.version_counts[version] = count
+        else:
+            del self.version_counts[version]
+
+    def version_for(self, peer):
+        """
+        Version used for unicast - peers are addressed in JSON until they announce binary support
+        """
+        return min(self.peer_versions.get(peer, WIRE_VERSION_JSON), config.WIRE_VERSION)
+
+    def broadcast_version(self):
+        """
+        Version used for broadcast - binary only once every known peer supports it (rolling upgrade)
+        """
+        if not self.version_counts:
+            return WIRE_VERSION_JSON
+        # Only a few distinct versions, independent of the number of peers
+        return min(min(self.version_counts), config.WIRE_VERSION)
+
+
+wire = WireState()
+
+
+def set_local_ip(ip):
+    """
+    Sets sender id put into binary headers, broadcasts of a node in a group (config.HIERARCHY_GROUPS)
+    reach only its group
+    """
+    wire.local_id = ip_tools.ip_to_long(ip) if ip is not None else 0
+    group = groups.group_of(ip)
+    wire.broadcast_addrs = groups.broadcast_addrs(group, ip) if group is not None else None
+
+
+def forget_peer(ip):
+    """
+    Node was dropped as dead (by the leader, the membership engine or a slave losing its leader)
+    """
+    wire.forget_peer(ip)
+
+
+def peek_msg_type(msg):
+    """
+    Returns message type code without decoding the payload
+    """
+    if msg[0] == _JSON_FIRST_BYTE:
+        return json.loads(bytes(msg))['type']
+    return msg[1]
+
+
+def peek_binary_type(msg):
+    """
+    Returns message type code of a binary message straight from its header (type byte), None for JSON messages
+    """
+    if msg[0] == _JSON_FIRST_BYTE:
+        return None
+    return msg[1]
 
-def encode_msg(msg_type: MsgType, data=""):
-    return json.dumps({"type": msg_type.value, "data": data}).encode('utf-8')
 
+#################################################################################
+# Ingress priority
+#################################################################################
 
-def decode_msg(msg):
-    decoded = json.loads(msg)
-    return decoded['type'], decoded['data']
+# Priority classes of received datagrams - UDPServer processes queued control messages (election, leader,
+# colors, ...) before liveness traffic (keepalives) and that before monitoring traffic
+INGRESS_CONTROL = 0
+INGRESS_KEEPALIVE = 1
+INGRESS_MONITOR = 2
+INGRESS_CLASS_NAMES = ("control", "keepalive", "monitor")
+# Message type code -> class, types not listed are control messages
+_INGRESS_CLASSES = bytearray(256)
+for _msg_type in (MsgType.KEEPALIVE, MsgType.HEARTBEAT, MsgType.SWIM_PING, MsgType.SWIM_PING_REQ, MsgType.SWIM_ACK):
+    _INGRESS_CLASSES[_msg_type.value] = INGRESS_KEEPALIVE
+for _msg_type in MONITORING_TYPES:
+    _INGRESS_CLASSES[_msg_type.value] = INGRESS_MONITOR
+
+
+def ingress_class(msg):
+    """
+    :return: Priority class of a received datagram (INGRESS_CONTROL, INGRESS_KEEPALIVE or INGRESS_MONITOR) and
+             the parsed message if it is JSON (None otherwise) - decode_msg() takes it, so JSON is parsed once
+    """
+    if msg[0] != _JSON_FIRST_BYTE:
+        return _INGRESS_CLASSES[msg[1]], None
+    try:
+        parsed = json.loads(bytes(msg))
+        msg_code = int(parsed['type'])
+    except (ValueError, KeyError, TypeError):
+        # Broken message - the processing function rejects it
+        return INGRESS_CONTROL, None
+    return _INGRESS_CLASSES[msg_code] if 0 <= msg_code < len(_INGRESS_CLASSES) else INGRESS_CONTROL, parsed
+
+
+def keepalive_payload(msg):
+    """
+    :return: Payload of a binary KEEPALIVE (keepalives of one sender differ only in the header's sequence number),
+             None for other messages
+    """
+    if msg[0] != _JSON_FIRST_BYTE and msg[1] == MsgType.KEEPALIVE.value:
+        return bytes(msg[_HEADER.size:])
+    return None
+
+
+def paginate(items):
+    """
+    Splits items of a snapshot or delta into pages of at most PAGE_NODES (reassembled by PageAssembler)
+    :return: List of (page, pages, items), at least one (possibly empty) page
+    """
+    pages = max((len(items) + PAGE_NODES - 1) // PAGE_NODES, 1)
+    return [(page, pages, items[page * PAGE_NODES:(page + 1) * PAGE_NODES]) for page in range(pages)]
+
+
+def encode_msg(msg_type: MsgType, data="", version=WIRE_VERSION_JSON):
+    if version >= WIRE_VERSION_BINARY:
+        header = _HEADER.pack(config.WIRE_VERSION, msg_type.value, wire.next_seq(), wire.local_id)
+        if data == "":
+            return header
+        return header + _PAYLOAD_CODECS[msg_type.value][0](data)
+
+    msg = {"type": msg_type.value, "data": data}
+    if config.WIRE_VERSION > WIRE_VERSION_JSON:
+        # Announce that we understand the binary format
+        msg["v"] = config.WIRE_VERSION
+    return json.dumps(msg).encode('utf-8')
+
+
+class DecodeError(ValueError):
+    """
+    Datagram is not a message (shorter than the header, broken JSON or payload)
+    """
+
+
+def decode_msg(msg, sender_ip=None, parsed=None):
+    """
+    Decodes message in any supported wire format
+    :param msg: bytes (or memoryview) of the datagram
+    :param sender_ip: If given, version announced by the sender is remembered for replies
+    :param parsed: The JSON message already parsed by ingress_class(), if any
+    :return: message type code, data (None for a binary type this version doesn't know - sent by a newer node)
+    :raise DecodeError: Datagram can't be decoded
+    """
+    if msg[0] == _JSON_FIRST_BYTE:
+        try:
+            decoded = parsed if parsed is not None else json.loads(bytes(msg))
+            msg_code, data = int(decoded['type']), decoded['data']
+        except (ValueError, KeyError, TypeError) as e:
+            raise DecodeError(f"broken JSON message: {e}") from None
+        wire.note_peer_version(sender_ip, decoded.get("v", WIRE_VERSION_JSON))
+        return msg_code, data
+
+    if len(msg) < _HEADER.size:
+        raise DecodeError(f"{len(msg)} B is shorter than the header")
+    version, msg_code, _seq, _sender_id = _HEADER.unpack_from(msg)
+    wire.note_peer_version(sender_ip, version)
+    if len(msg) == _HEADER.size:
+        return msg_code, ""
+    codec = _PAYLOAD_CODECS.get(msg_code)
+    if codec is None:
+        return msg_code, None
+    try:
+        return msg_code, codec[1](msg, _HEADER.size)
+    except (struct.error, ValueError) as e:
+        raise DecodeError(f"broken payload of type {msg_code}: {e}") from None
 
 
 #################################################################################
 # Generic functions
 #################################################################################
 
+# All sends of this node go through one sender (see main.py - it is attached to the UDP server transport)
+sender = DatagramSender()
+
+
+def _log_send(msg_type, peer):
+    if _logger.isEnabledFor(logging.DEBUG) and log.sampled(msg_type, "send"):
+        _logger.debug("send", extra={"type": msg_type.name, "peer": peer})
+
+
 def send_broadcast(msg_type: MsgType, data=""):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.sendto(encode_msg(msg_type, data), (config.BROADCAST_IP, config.DEFAULT_LISTENING_PORT))
+    _log_send(msg_type, config.BROADCAST_IP)
+    metrics.registry.count_sent(msg_type.value)
+    payload = encode_msg(msg_type, data, wire.broadcast_version())
+    if wire.broadcast_addrs is None:
+        sender.sendto(payload, (config.BROADCAST_IP, config.DEFAULT_LISTENING_PORT), broadcast=True)
+        return
+    for addr, broadcast in wire.broadcast_addrs:
+        sender.sendto(payload, addr, broadcast=broadcast)
+
+
+def send_tier_broadcast(msg_type: MsgType, data=""):
+    """
+    Broadcast to all groups (config.HIERARCHY_GROUPS) - reaches the leaders of all groups
+    """
+    _log_send(msg_type, "tier")
+    metrics.registry.count_sent(msg_type.value)
+    payload = encode_msg(msg_type, data, wire.broadcast_version())
+    local_ip = ip_tools.long_to_ip(wire.local_id)
+    for index in range(len(config.HIERARCHY_GROUPS)):
+        for addr, broadcast in groups.broadcast_addrs(index, local_ip):
+            sender.sendto(payload, addr, broadcast=broadcast)
 
 
 def send_unicast(msg_type: MsgType, peer, data=""):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.sendto(encode_msg(msg_type, data), (peer, config.DEFAULT_LISTENING_PORT))
+    _log_send(msg_type, peer)
+    metrics.registry.count_sent(msg_type.value)
+    sender.sendto(encode_msg(msg_type, data, wire.version_for(peer)), (peer, config.DEFAULT_LISTENING_PORT))
 
 
 #################################################################################
@@ -47,50 +406,136 @@ def send_unicast(msg_type: MsgType, peer, data=""):
 #################################################################################
 
 def send_election_broadcast():
-    print("Sending election broadcast")
     send_broadcast(MsgType.ELECTION)
 
 
 def send_election_unicast(peer):
-    print("Sending election unicast:", peer)
     send_unicast(MsgType.ELECTION, peer)
 
 
 def send_victory_broadcast():
-    print("Sending victory broadcast")
     send_broadcast(MsgType.VICTORY)
 
 
+def send_victory_unicast(peer):
+    send_unicast(MsgType.VICTORY, peer)
+
+
 def send_leader_request_broadcast():
-    print("Sending leader request broadcast")
     send_broadcast(MsgType.LEADER_REQUEST)
 
 
 def send_leader_response_unicast(peer):
-    print("Sending leader response unicast:", peer)
     send_unicast(MsgType.LEADER_RESPONSE, peer)
 
 
 def send_set_to_red_unicast(peer):
-    print("Sending set to red unicast:", peer)
     send_unicast(MsgType.SET_TO_RED, peer)
 
 
 def send_set_to_green_unicast(peer):
-    print("Sending set to green unicast:", peer)
     send_unicast(MsgType.SET_TO_GREEN, peer)
 
 
+def send_set_color_unicast(peer, color):
+    send_unicast(MsgType.SET_COLOR, peer, color)
+
+
+def send_color_command_unicast(peer, data):
+    send_unicast(MsgType.COLOR_COMMAND, peer, data)
+
+
+def send_color_ack_unicast(peer, seq):
+    send_unicast(MsgType.COLOR_ACK, peer, seq)
+
+
 def send_keepalive_unicast(peer, data=""):
-    print("Sending keepalive unicast:", peer)
     send_unicast(MsgType.KEEPALIVE, peer, data)
 
 
 def send_monitor_color_request_broadcast():
-    # print("Sending monitor color request broadcast")
     send_broadcast(MsgType.MONITOR_COLOR_REQUEST)
 
 
 def send_monitor_color_response_unicast(peer, data):
-    # print("Sending monitor color response unicast:", peer)
     send_unicast(MsgType.MONITOR_COLOR_RESPONSE, peer, data)
+
+
+def send_heartbeat_broadcast(data):
+    send_broadcast(MsgType.HEARTBEAT, data)
+
+
+def send_state_request_unicast(peer, data):
+    send_unicast(MsgType.STATE_REQUEST, peer, data)
+
+
+def send_state_response_unicast(peer, data):
+    send_unicast(MsgType.STATE_RESPONSE, peer, data)
+
+
+def send_swim_ping_broadcast(data):
+    send_broadcast(MsgType.SWIM_PING, data)
+
+
+def send_swim_ping_unicast(peer, data):
+    send_unicast(MsgType.SWIM_PING, peer, data)
+
+
+def send_swim_ping_req_unicast(peer, data):
+    send_unicast(MsgType.SWIM_PING_REQ, peer, data)
+
+
+def send_swim_ack_unicast(peer, data):
+    send_unicast(MsgType.SWIM_ACK, peer, data)
+
+
+def send_metrics_request_broadcast():
+    send_broadcast(MsgType.METRICS_REQUEST)
+
+
+def send_metrics_response_unicast(peer, data):
+    send_unicast(MsgType.METRICS_RESPONSE, peer, data)
+
+
+def send_monitor_subscribe_broadcast(data):
+    send_broadcast(MsgType.MONITOR_SUBSCRIBE, data)
+
+
+def send_monitor_subscribe_unicast(peer, data):
+    send_unicast(MsgType.MONITOR_SUBSCRIBE, peer, data)
+
+
+def send_monitor_snapshot_unicast(peer, version, nodes):
+    for page, pages, items in paginate(nodes):
+        send_unicast(MsgType.MONITOR_SNAPSHOT, peer, (version, page, pages, items))
+
+
+def send_monitor_delta_unicast(peer, base_version, version, changes):
+    for page, pages, items in paginate(changes):
+        send_unicast(MsgType.MONITOR_DELTA, peer, (base_version, version, page, pages, items))
+
+
+def send_replica_snapshot_unicast(peer, epoch, nodes):
+    for page, pages, items in paginate(nodes):
+        send_unicast(MsgType.REPLICA_SNAPSHOT, peer, (epoch, page, pages, items))
+
+
+def send_replica_delta_unicast(peer, base_epoch, epoch, changes):
+    for page, pages, items in paginate(changes):
+        send_unicast(MsgType.REPLICA_DELTA, peer, (base_epoch, epoch, page, pages, items))
+
+
+def send_replica_ack_unicast(peer, version):
+    send_unicast(MsgType.REPLICA_ACK, peer, version)
+
+
+def send_group_summary_unicast(peer, data):
+    send_unicast(MsgType.GROUP_SUMMARY, peer, data)
+
+
+def send_group_summary_tier(data):
+    send_tier_broadcast(MsgType.GROUP_SUMMARY, data)
+
+
+def send_group_quota_unicast(peer, data):
+    send_unicast(MsgType.GROUP_QUOTA, peer, data)
@@ -1,13 +1,166 @@
-import heapq
+import random
+
+# Enough levels for 2^32 keys (the whole IPv4 space)
+_MAX_LEVEL = 32
+
+
+class _SkipNode:
+    __slots__ = ("key", "value", "next", "width", "alive")
+
+    def __init__(self, key, value, level):
+        self.key = key
+        self.value = value
+        # Forward pointer and number of level 0 nodes skipped by it, for every level of the node
+        self.next = [None] * level
+        self.width = [1] * level
+        self.alive = True
+
+
+class _IndexableSkipList:
+    def __init__(self):
+        """
+        Skip list with span counters on every link
+        Insert, delete, rank and select are O(log n), in-order walk follows the level 0 links
+        """
+        self._head = _SkipNode(None, None, _MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+        self._random = random.Random()
+
+    def _random_level(self):
+        level = 1
+        while level < _MAX_LEVEL and self._random.random() < 0.5:
+            level += 1
+        return level
+
+    def _find_path(self, key, inclusive):
+        """
+        For every level returns the last node with key lower than the given key (or lower or equal if inclusive)
+        and the rank of that node (head has rank -1)
+        """
+        path = [self._head] * _MAX_LEVEL
+        ranks = [-1] * _MAX_LEVEL
+        node = self._head
+        rank = -1
+        for level in range(self._level - 1, -1, -1):
+            nxt = node.next[level]
+            while nxt is not None and (nxt.key < key or (inclusive and nxt.key == key)):
+                rank += node.width[level]
+                node = nxt
+                nxt = node.next[level]
+            path[level] = node
+            ranks[level] = rank
+        return path, ranks
+
+    def insert(self, key, value):
+        """
+        Inserts a new node after all nodes with equal key, returns the node
+        """
+        path, ranks = self._find_path(key, True)
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                path[i] = self._head
+                ranks[i] = -1
+                self._head.width[i] = self._size + 1
+            self._level = level
+
+        new_node = _SkipNode(key, value, level)
+        new_rank = ranks[0] + 1
+        for i in range(level):
+            prev = path[i]
+            new_node.next[i] = prev.next[i]
+            prev.next[i] = new_node
+            # Split the span of the previous link between the previous node and the new node
+            skipped = new_rank - ranks[i]
+            new_node.width[i] = prev.width[i] - skipped + 1
+            prev.width[i] = skipped
+        # Links above the node's level now skip one more node
+        for i in range(level, self._level):
+            path[i].width[i] += 1
+
+        self._size += 1
+        return new_node
+
+    def remove_first(self, key):
+        """
+        Unlinks the first node with given key, returns it (or None if there is no such key)
+        """
+        path, _ = self._find_path(key, False)
+        node = path[0].next[0]
+        if node is None or node.key != key:
+            return None
+        self._unlink(node, path)
+        return node
+
+    def remove_node(self, node):
+        """
+        Unlinks the given node, it has to be the first node with its key
+        """
+        path, _ = self._find_path(node.key, False)
+        self._unlink(node, path)
+
+    def _unlink(self, node, path):
+        for i in range(self._level):
+            prev = path[i]
+            if prev.next[i] is node:
+                prev.width[i] += node.width[i] - 1
+                prev.next[i] = node.next[i]
+            else:
+                prev.width[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        # The node keeps its forward pointers, so an iterator standing on it can continue
+        node.alive = False
+        self._size -= 1
+
+    def rank(self, key):
+        """
+        Returns the number of keys lower than the given key
+        """
+        _, ranks = self._find_path(key, False)
+        return ranks[0] + 1
+
+    def node_at(self, index):
+        """
+        Returns the node at given position (0 is the lowest key)
+        """
+        if index < 0:
+            index += self._size
+        if index < 0 or index >= self._size:
+            raise IndexError("index out of range")
+        node = self._head
+        rank = -1
+        for level in range(self._level - 1, -1, -1):
+            while node.next[level] is not None and rank + node.width[level] <= index:
+                rank += node.width[level]
+                node = node.next[level]
+        return node
+
+    def first(self):
+        return self._head.next[0]
+
+    def iter_nodes(self):
+        node = self._head.next[0]
+        while node is not None:
+            if node.alive:
+                yield node
+            node = node.next[0]
+
+    def __len__(self):
+        return self._size
+
 
 class SortedDict:
     def __init__(self, mapping=None):
         """
         Initializes the SortedDict.
+        Keys are kept in an indexable skip list - insert, delete, rank and select are O(log n).
+        Node tables use NodeRegistry, this is the previous layout the benchmarks compare it with.
         :param mapping: Optional dictionary to initialize the sorted dict.
         """
-        self._dict = {}
-        self._keys = []
+        self._nodes = {}
+        self._list = _IndexableSkipList()
         if mapping:
             for key, value in mapping.items():
                 self[key] = value
@@ -16,78 +169,108 @@ class SortedDict:
         """
         Sets a key-value pair and maintains sorted order by key.
         """
-        if key not in self._dict:
-            heapq.heappush(self._keys, key)
-        self._dict[key] = value
+        node = self._nodes.get(key)
+        if node is None:
+            self._nodes[key] = self._list.insert(key, value)
+        else:
+            node.value = value
 
     def __delitem__(self, key):
         """
         Removes a key from the dictionary.
         """
-        if key in self._dict:
-            self._keys.remove(key)
-            heapq.heapify(self._keys)
-            del self._dict[key]
-        else:
+        node = self._nodes.pop(key, None)
+        if node is None:
             raise KeyError(f"Key {key} not found in SortedDict.")
+        self._list.remove_node(node)
 
     def __getitem__(self, key):
         """
         Retrieves a value by key.
         """
-        return self._dict[key]
+        return self._nodes[key].value
+
+    def get(self, key, default=None):
+        """
+        Retrieves a value by key, returns default if the key doesn't exist.
+        """
+        node = self._nodes.get(key)
+        return default if node is None else node.value
 
     def pop(self):
         """
         Removes and returns the key with the smallest key.
         """
-        if not self._keys:
+        node = self._list.first()
+        if node is None:
             raise KeyError("pop from empty SortedDict")
-        key = heapq.heappop(self._keys)
-        value = self._dict.pop(key)
-        return key, value
+        del self[node.key]
+        return node.key, node.value
+
+    def rank(self, key):
+        """
+        Returns the number of keys lower than the given key (position of the key if it exists).
+        """
+        return self._list.rank(key)
+
+    def select(self, index):
+        """
+        Returns the key at given position in sorted order (0 is the lowest key, negative indexes count from the end).
+        """
+        return self._list.node_at(index).key
+
+    def peekitem(self, index):
+        """
+        Returns the (key, value) pair at given position in sorted order.
+        """
+        node = self._list.node_at(index)
+        return node.key, node.value
 
     def items(self):
         """
         Returns sorted (key, value) pairs.
         """
-        return [(key, self._dict[key]) for key in sorted(self._keys)]
+        return ((node.key, node.value) for node in self._list.iter_nodes())
 
     def keys(self):
         """
         Returns keys in sorted order.
         """
-        return sorted(self._keys)
+        return (node.key for node in self._list.iter_nodes())
 
     def values(self):
         """
         Returns values sorted by their corresponding keys.
         """
-        return [self._dict[key] for key in sorted(self._keys)]
+        return (node.value for node in self._list.iter_nodes())
 
     def __len__(self):
         """
         Returns the number of items in the dictionary.
         """
-        return len(self._dict)
+        return len(self._nodes)
 
     def __iter__(self):
         """
-        Returns an iterator over keys sorted by their values.
+        Returns an iterator over keys in sorted order.
+        Keys may be deleted while iterating.
         """
-        return iter(self.keys())
+        return self.keys()
+
+    def __contains__(self, key):
+        return key in self._nodes
 
     def __repr__(self):
         """
         Returns a string representation of the sorted dictionary.
         """
-        return f"SortedDict({self.items()})"
+        return f"SortedDict({list(self.items())})"
 
     def contains_key(self, key):
         """
         Checks if the key exists in the dictionary.
         """
-        return key in self._dict
+        return key in self._nodes
 
 
 class SortedList:
@@ -96,57 +279,62 @@ class SortedList:
         Initializes the SortedList.
         :param iterable: Optional initial iterable to populate the list.
         """
-        self._heap = []
+        self._list = _IndexableSkipList()
         if iterable:
             for item in iterable:
-                heapq.heappush(self._heap, item)
+                self.add(item)
 
     def add(self, item):
         """
         Adds an item to the sorted list.
         :param item: The item to add.
         """
-        heapq.heappush(self._heap, item)
+        self._list.insert(item, None)
 
     def remove(self, item):
         """
         Removes an item from the sorted list.
         :param item: The item to remove.
         """
-        try:
-            self._heap.remove(item)
-            heapq.heapify(self._heap)  # Reorder the heap after removal
-        except ValueError:
+        if self._list.remove_first(item) is None:
             raise ValueError(f"Item {item} not found in SortedList.")
 
     def pop(self):
         """
         Removes and returns the smallest item from the sorted list.
         """
-        if not self._heap:
+        node = self._list.first()
+        if node is None:
             raise IndexError("pop from empty SortedList")
-        return heapq.heappop(self._heap)
+        self._list.remove_node(node)
+        return node.key
+
+    def rank(self, item):
+        """
+        Returns the number of items lower than the given item.
+        """
+        return self._list.rank(item)
 
     def __getitem__(self, index):
         """
         Allows indexing to retrieve sorted elements.
         """
-        return sorted(self._heap)[index]
+        return self._list.node_at(index).key
 
     def __len__(self):
         """
         Returns the number of elements in the sorted list.
         """
-        return len(self._heap)
+        return len(self._list)
 
     def __iter__(self):
         """
         Returns an iterator over the sorted elements.
         """
-        return iter(sorted(self._heap))
+        return (node.key for node in self._list.iter_nodes())
 
     def __repr__(self):
         """
         Returns a string representation of the sorted list.
         """
-        return f"SortedList({sorted(self._heap)})"
+        return f"SortedList({list(self)})"
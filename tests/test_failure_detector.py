@@ -0,0 +1,67 @@
+import math
+import unittest
+
+from src import config
+from src.utils.FailureDetector import FixedTimeoutDetector, PhiAccrualDetector
+
+SECOND = 10 ** 9
+
+
+class FixedTimeoutDetectorTest(unittest.TestCase):
+    def test_dead_after_timeout(self):
+        detector = FixedTimeoutDetector(2 * SECOND)
+        self.assertEqual(detector.heartbeat("a", 10 * SECOND), 12 * SECOND)
+        self.assertEqual(detector.phi("a", 12 * SECOND), 0.0)
+        self.assertEqual(detector.phi("a", 12 * SECOND + 1), math.inf)
+
+
+class PhiAccrualDetectorTest(unittest.TestCase):
+    def beat(self, detector, count, interval):
+        deadline = None
+        for i in range(count):
+            deadline = detector.heartbeat("a", i * interval)
+        return (count - 1) * interval, deadline
+
+    def test_fixed_timeout_until_enough_samples(self):
+        detector = PhiAccrualDetector(20 * SECOND)
+        now, deadline = self.beat(detector, config.PHI_MIN_SAMPLES, SECOND)
+        self.assertEqual(deadline, now + 20 * SECOND)
+        self.assertEqual(detector.phi("a", deadline), 0.0)
+        self.assertEqual(detector.phi("a", deadline + 1), math.inf)
+
+    def test_deadline_is_where_phi_reaches_threshold(self):
+        detector = PhiAccrualDetector(20 * SECOND)
+        now, deadline = self.beat(detector, 10, SECOND)
+        self.assertLess(deadline, now + 20 * SECOND)
+        self.assertAlmostEqual(detector.phi("a", deadline), config.PHI_THRESHOLD, places=3)
+        self.assertLess(detector.phi("a", deadline - SECOND // 10), config.PHI_THRESHOLD)
+        self.assertGreater(detector.phi("a", deadline + SECOND // 10), config.PHI_THRESHOLD)
+
+    def test_phi_grows_with_silence(self):
+        detector = PhiAccrualDetector(20 * SECOND)
+        now, _ = self.beat(detector, 10, SECOND)
+        levels = [detector.phi("a", now + seconds * SECOND) for seconds in range(1, 12)]
+        self.assertEqual(levels, sorted(levels))
+
+    def test_jitter_delays_the_deadline(self):
+        deadlines = []
+        # Same mean interval (2 s), the second peer's keepalives alternate 1 s and 3 s
+        for intervals in ([2] * 8, [1, 3] * 4):
+            detector = PhiAccrualDetector(20 * SECOND)
+            now = 0
+            detector.heartbeat("a", now)
+            for interval in intervals:
+                now += interval * SECOND
+                deadline = detector.heartbeat("a", now)
+            deadlines.append(deadline)
+        self.assertGreater(deadlines[1], deadlines[0])
+
+    def test_remove(self):
+        detector = PhiAccrualDetector(20 * SECOND)
+        self.beat(detector, 10, SECOND)
+        detector.remove("a")
+        self.assertEqual(detector.heartbeat("a", 100 * SECOND), 120 * SECOND)
+
+
+if __name__ == "__main__":
+    unittest.main()
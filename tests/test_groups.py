@@ -0,0 +1,42 @@
+import random
+import unittest
+
+from src.utils.groups import split_quota
+
+
+class SplitQuotaTest(unittest.TestCase):
+    def check(self, total, sizes):
+        quotas = split_quota(total, sizes)
+        self.assertEqual(set(quotas), set(sizes))
+        for group, quota in quotas.items():
+            self.assertGreaterEqual(quota, 1)
+            self.assertLessEqual(quota, sizes[group])
+        if len(sizes) <= total <= sum(sizes.values()):
+            self.assertEqual(sum(quotas.values()), total)
+        return quotas
+
+    def test_proportional(self):
+        self.assertEqual(self.check(50, {0: 50, 1: 30, 2: 20}), {0: 25, 1: 15, 2: 10})
+
+    def test_largest_remainder_ties_by_index(self):
+        self.assertEqual(self.check(2, {0: 3, 1: 3, 2: 3}), {0: 1, 1: 1, 2: 1})
+        self.assertEqual(self.check(4, {0: 3, 1: 3, 2: 3}), {0: 2, 1: 1, 2: 1})
+
+    def test_every_group_gets_at_least_one(self):
+        self.check(10, {0: 1000, 1: 1, 2: 1})
+
+    def test_more_groups_than_total(self):
+        self.assertEqual(self.check(1, {0: 5, 1: 5}), {0: 1, 1: 1})
+
+    def test_empty(self):
+        self.assertEqual(split_quota(10, {}), {})
+
+    def test_random_sizes(self):
+        rng = random.Random(3)
+        for _ in range(500):
+            sizes = {group: rng.randint(1, 200) for group in range(rng.randint(1, 8))}
+            self.check(rng.randint(0, sum(sizes.values())), sizes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import random
+import unittest
+
+from src.nodes.NodeRegistry import NodeRegistry
+from src.nodes.node_types import NodeColor
+from src.utils import ip_tools
+
+
+class NodeRegistryTest(unittest.TestCase):
+    def check(self, registry, reference):
+        ids = sorted(reference)
+        self.assertEqual(list(registry.ids), ids)
+        self.assertEqual(list(registry.colors), [reference[node_id][0].value for node_id in ids])
+        self.assertEqual(list(registry.last_seen), [reference[node_id][1] for node_id in ids])
+        self.assertEqual(len(registry.epochs), len(ids))
+
+    def test_random_inserts_and_deletes(self):
+        rng = random.Random(4)
+        registry, reference = NodeRegistry(), {}
+        for _ in range(2000):
+            node_id = rng.randrange(0x0A000000, 0x0A000200)
+            if node_id in reference:
+                del registry[node_id], reference[node_id]
+            else:
+                color, last_seen = rng.choice(list(NodeColor)), rng.randrange(10 ** 12)
+                registry.add(node_id, color, last_seen)
+                reference[node_id] = (color, last_seen)
+            self.assertEqual(node_id in registry, node_id in reference)
+        self.check(registry, reference)
+        ids = sorted(reference)
+        for index in (0, len(ids) // 2, -1):
+            self.assertEqual(registry.select(index), ids[index])
+            self.assertEqual(registry.rank(ids[index]), ids.index(ids[index]))
+
+    def test_duplicate_insert_and_missing_delete(self):
+        registry = NodeRegistry()
+        registry.add(5, NodeColor.RED, 1)
+        with self.assertRaises(KeyError):
+            registry.add(5, NodeColor.GREEN, 2)
+        with self.assertRaises(KeyError):
+            del registry[6]
+        self.assertEqual(registry[5].color, NodeColor.RED)
+        self.assertIsNone(registry.get(6))
+
+    def test_view_writes_its_row(self):
+        registry = NodeRegistry()
+        for node_id in (30, 10, 20):
+            registry.add(node_id, NodeColor.GREEN, node_id)
+        view = registry[20]
+        view.color = NodeColor.RED
+        view.last_seen = 99
+        view.epoch = 7
+        # Insert before the node moves its row, the view still finds it
+        registry.add(15, NodeColor.GREEN, 15)
+        self.assertEqual((view.color, view.last_seen, view.epoch), (NodeColor.RED, 99, 7))
+        self.assertEqual(registry.color_items(), [(10, NodeColor.GREEN.value), (15, NodeColor.GREEN.value),
+                                                  (20, NodeColor.RED.value), (30, NodeColor.GREEN.value)])
+        self.assertEqual(registry.color_counts(), {NodeColor.GREEN.value: 3, NodeColor.RED.value: 1})
+
+    def test_iteration_over_a_copy(self):
+        registry = NodeRegistry()
+        for node_id in range(10):
+            registry.add(node_id, NodeColor.GREEN, 0)
+        for node_id in registry:
+            if node_id % 2:
+                del registry[node_id]
+        self.assertEqual(list(registry), [0, 2, 4, 6, 8])
+
+    def test_from_colors(self):
+        nodes = [(ip_tools.ip_to_long(f"10.0.1.{host}"), NodeColor.RED.value) for host in (9, 3, 200)]
+        registry = NodeRegistry.from_colors(nodes)
+        self.assertEqual(registry.color_items(), sorted(nodes))
+        self.assertEqual(registry[ip_tools.ip_to_long("10.0.1.3")].ip, "10.0.1.3")
+
+
+if __name__ == "__main__":
+    unittest.main()
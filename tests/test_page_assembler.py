@@ -0,0 +1,53 @@
+import unittest
+
+from src.utils.PageAssembler import PageAssembler
+from src.utils.protocol_msgs import PAGE_NODES, paginate
+
+
+class PageAssemblerTest(unittest.TestCase):
+    def test_single_page(self):
+        self.assertEqual(PageAssembler(4).add(1, 0, 1, [(1, 2)]), [(1, 2)])
+
+    def test_pages_in_any_order(self):
+        items = [(node_id, node_id % 3) for node_id in range(3 * PAGE_NODES + 5)]
+        pages = paginate(items)
+        self.assertEqual(len(pages), 4)
+        assembler = PageAssembler(4)
+        for page, count, page_items in reversed(pages[1:]):
+            self.assertIsNone(assembler.add(7, page, count, page_items))
+        page, count, page_items = pages[0]
+        self.assertEqual(assembler.add(7, page, count, page_items), items)
+        self.assertEqual(assembler.partial, {})
+
+    def test_duplicate_page(self):
+        assembler = PageAssembler(4)
+        self.assertIsNone(assembler.add(1, 0, 2, [(1, 1)]))
+        self.assertIsNone(assembler.add(1, 0, 2, [(1, 1)]))
+        self.assertEqual(assembler.add(1, 1, 2, [(2, 2)]), [(1, 1), (2, 2)])
+
+    def test_page_out_of_range(self):
+        assembler = PageAssembler(4)
+        self.assertIsNone(assembler.add(1, 2, 2, []))
+        self.assertIsNone(assembler.add(1, -1, 2, []))
+        self.assertEqual(assembler.partial, {})
+
+    def test_different_page_count_starts_again(self):
+        assembler = PageAssembler(4)
+        assembler.add(1, 0, 3, [(1, 1)])
+        self.assertIsNone(assembler.add(1, 0, 2, [(5, 5)]))
+        self.assertEqual(assembler.add(1, 1, 2, [(6, 6)]), [(5, 5), (6, 6)])
+
+    def test_oldest_incomplete_message_dropped(self):
+        assembler = PageAssembler(2)
+        for key in (1, 2, 3):
+            assembler.add(key, 0, 2, [(key, 1)])
+        self.assertEqual(list(assembler.partial), [2, 3])
+        self.assertIsNone(assembler.add(1, 1, 2, [(1, 2)]))
+
+    def test_empty_table(self):
+        self.assertEqual(paginate([]), [(0, 1, [])])
+        self.assertEqual(PageAssembler(4).add(1, 0, 1, []), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import struct
+import unittest
+
+from src.utils import protocol_msgs
+from src.utils.protocol_msgs import DecodeError, MsgType, decode_msg, encode_msg
+
+ITEMS = [(0x0A000001, 1), (0x0A000002, 2), (0x0A0000FE, 0)]
+
+# Message type -> data of a typical message ("" = no payload)
+SAMPLES = {
+    MsgType.ELECTION: "",
+    MsgType.VICTORY: "",
+    MsgType.LEADER_REQUEST: "",
+    MsgType.LEADER_RESPONSE: "",
+    MsgType.SET_TO_RED: "",
+    MsgType.SET_TO_GREEN: "",
+    MsgType.KEEPALIVE: 2,
+    MsgType.MONITOR_COLOR_REQUEST: "",
+    MsgType.MONITOR_COLOR_RESPONSE: 1,
+    MsgType.HEARTBEAT: (100, 0xDEADBEEF, 99, ITEMS),
+    MsgType.STATE_REQUEST: 1,
+    MsgType.STATE_RESPONSE: (100, 0xDEADBEEF, 2),
+    MsgType.SWIM_PING: (7, 0x0A000001, [(0x0A000002, 1, 3), (0x0A000003, 2, 0)]),
+    MsgType.SWIM_PING_REQ: (8, 0x0A000002, []),
+    MsgType.SWIM_ACK: (7, 0x0A000001, [(0x0A000004, 0, 1)]),
+    MsgType.METRICS_REQUEST: "",
+    MsgType.METRICS_RESPONSE: {"counters": {"recolors": 10}, "hist": {"election_ms": [1, 2]}},
+    MsgType.MONITOR_SUBSCRIBE: 42,
+    MsgType.MONITOR_SNAPSHOT: (100, 0, 2, ITEMS),
+    MsgType.MONITOR_DELTA: (99, 100, 1, 2, ITEMS),
+    MsgType.SET_COLOR: 3,
+    MsgType.COLOR_COMMAND: (12345, 1, 0x5EED),
+    MsgType.COLOR_ACK: 12345,
+    MsgType.REPLICA_SNAPSHOT: (100, 0, 1, ITEMS),
+    MsgType.REPLICA_DELTA: (99, 100, 0, 1, ITEMS),
+    MsgType.REPLICA_ACK: 100,
+    MsgType.GROUP_SUMMARY: (1, 250, 125),
+    MsgType.GROUP_QUOTA: (1, 120),
+}
+
+
+def plain(data):
+    """
+    Tuples as lists (JSON has only lists)
+    """
+    if isinstance(data, (tuple, list)):
+        return [plain(item) for item in data]
+    return data
+
+
+class CodecRoundTripTest(unittest.TestCase):
+    def test_every_type_has_a_sample(self):
+        self.assertEqual(set(MsgType), set(SAMPLES))
+
+    def test_binary(self):
+        for msg_type, data in SAMPLES.items():
+            with self.subTest(msg_type=msg_type.name):
+                msg_code, decoded = decode_msg(encode_msg(msg_type, data, protocol_msgs.WIRE_VERSION_REPLICA))
+                self.assertEqual(msg_code, msg_type.value)
+                self.assertEqual(plain(decoded), plain(data))
+
+    def test_json(self):
+        for msg_type, data in SAMPLES.items():
+            with self.subTest(msg_type=msg_type.name):
+                msg_code, decoded = decode_msg(encode_msg(msg_type, data, protocol_msgs.WIRE_VERSION_JSON))
+                self.assertEqual(msg_code, msg_type.value)
+                self.assertEqual(decoded, plain(data))
+
+    def test_json_parsed_by_ingress_class(self):
+        msg = encode_msg(MsgType.KEEPALIVE, 2, protocol_msgs.WIRE_VERSION_JSON)
+        ingress, parsed = protocol_msgs.ingress_class(msg)
+        self.assertEqual(ingress, protocol_msgs.INGRESS_KEEPALIVE)
+        self.assertEqual(decode_msg(msg, parsed=parsed), (MsgType.KEEPALIVE.value, 2))
+
+    def test_color_command_of_older_leader(self):
+        header = encode_msg(MsgType.COLOR_COMMAND, "", protocol_msgs.WIRE_VERSION_COLOR_ACK)
+        self.assertEqual(decode_msg(header + struct.pack("!IB", 5, 2)), (MsgType.COLOR_COMMAND.value, (5, 2, None)))
+
+    def test_unknown_type_from_newer_node(self):
+        msg = bytearray(encode_msg(MsgType.KEEPALIVE, 1, protocol_msgs.WIRE_VERSION_BINARY))
+        msg[1] = 200
+        self.assertEqual(decode_msg(bytes(msg)), (200, None))
+
+    def test_broken_datagrams(self):
+        keepalive = encode_msg(MsgType.KEEPALIVE, 1, protocol_msgs.WIRE_VERSION_BINARY)
+        heartbeat = encode_msg(MsgType.HEARTBEAT, SAMPLES[MsgType.HEARTBEAT], protocol_msgs.WIRE_VERSION_BINARY)
+        for msg in (keepalive[:5], heartbeat[:-3], b'{"type": 7', json.dumps({"data": 1}).encode()):
+            with self.subTest(msg=msg):
+                with self.assertRaises(DecodeError):
+                    decode_msg(msg)
+
+
+if __name__ == "__main__":
+    unittest.main()
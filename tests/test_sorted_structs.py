@@ -0,0 +1,55 @@
+import random
+import unittest
+
+from src.utils.sorted_structs import SortedDict
+
+
+class SortedDictFuzzTest(unittest.TestCase):
+    def check(self, table, reference):
+        keys = sorted(reference)
+        self.assertEqual(len(table), len(keys))
+        self.assertEqual(list(table.keys()), keys)
+        self.assertEqual(list(table.items()), [(key, reference[key]) for key in keys])
+
+    def test_random_operations_match_sorted(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            table, reference = SortedDict(), {}
+            for _ in range(500):
+                key = rng.randrange(300)
+                operation = rng.random()
+                if operation < 0.5:
+                    table[key] = reference[key] = rng.random()
+                elif operation < 0.8:
+                    if key in reference:
+                        del table[key], reference[key]
+                    else:
+                        with self.assertRaises(KeyError):
+                            del table[key]
+                elif reference:
+                    keys = sorted(reference)
+                    index = rng.randrange(-len(keys), len(keys))
+                    self.assertEqual(table.select(index), keys[index])
+                    self.assertEqual(table.peekitem(index), (keys[index], reference[keys[index]]))
+                    self.assertEqual(table.rank(key), sum(1 for other in keys if other < key))
+                self.assertEqual(key in table, key in reference)
+            self.check(table, reference)
+
+    def test_pop_returns_lowest(self):
+        keys = random.Random(2).sample(range(10000), 1000)
+        table = SortedDict({key: str(key) for key in keys})
+        popped = [table.pop() for _ in range(len(keys))]
+        self.assertEqual(popped, [(key, str(key)) for key in sorted(keys)])
+        with self.assertRaises(KeyError):
+            table.pop()
+
+    def test_delete_while_iterating(self):
+        table = SortedDict({key: None for key in range(100)})
+        for key in table:
+            if key % 3:
+                del table[key]
+        self.assertEqual(list(table), list(range(0, 100, 3)))
+
+
+if __name__ == "__main__":
+    unittest.main()